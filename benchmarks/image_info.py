@@ -0,0 +1,81 @@
+""" Benchmark building the phenotype map of every image of a sample.
+
+Compares run_tool._get_sample_image_info, which orders the cells of a sample
+once and slices them by image, to the per image filtering it replaced.  A
+pandas DataFrame with get_measured_regions stands in for the pythologist
+CellDataFrame so only pythologist_schemas and pandas need to be installed.
+
+    python benchmarks/image_info.py --cells 5000000 --images 500
+
+"""
+import argparse, json, time
+from collections import OrderedDict
+from pythologist_schemas.cli import run_tool
+
+def _sample_frame(cell_count,image_count,seed):
+    # a synthetic sample with the columns the phenotype maps are built from
+    import numpy as np
+    import pandas as pd
+    class _SampleFrame(pd.DataFrame):
+        @property
+        def _constructor(self):
+            return _SampleFrame
+        def get_measured_regions(self):
+            _frames = self.drop_duplicates(subset=['sample_name','frame_name'])
+            return pd.DataFrame([{'frame_name':x,'region_label':k,'region_area_pixels':v} \
+                                 for x, regions in zip(_frames['frame_name'],_frames['regions']) for k, v in regions.items()])
+    rng = np.random.RandomState(seed)
+    image_names = ['S_['+str(i)+']' for i in range(image_count)]
+    frames = rng.randint(0,image_count,cell_count)
+    scored_calls = [{'PD1':int(a),'PDL1':int(b)} for a, b in zip(rng.randint(0,2,cell_count),rng.randint(0,2,cell_count))]
+    regions = [{'Tumor':1000+i,'Stroma':2000+i} for i in range(image_count)]
+    return _SampleFrame(OrderedDict([
+        ('sample_name','S'),
+        ('frame_name',[image_names[x] for x in frames]),
+        ('cell_index',np.arange(cell_count)),
+        ('x',rng.randint(0,1000,cell_count)),
+        ('y',rng.randint(0,1000,cell_count)),
+        ('region_label',np.array(['Tumor','Stroma'])[rng.randint(0,2,cell_count)]),
+        ('phenotype_label',np.array(['CD8+','TUMOR','OTHER'])[rng.randint(0,3,cell_count)]),
+        ('scored_calls',scored_calls),
+        ('frame_shape',[(1000,1000)]*cell_count),
+        ('regions',[regions[x] for x in frames])
+    ])), image_names
+
+def _per_image_info(image_name,sample_name,cdf):
+    # the per image implementation _get_sample_image_info replaced
+    subset = cdf.loc[(cdf['sample_name']==sample_name)&(cdf['frame_name']==image_name)].copy()
+    rows = []
+    for k,v in subset.loc[:,['cell_index','x','y','region_label','phenotype_label','scored_calls']].\
+        set_index(['cell_index','x','y','region_label','phenotype_label'])['scored_calls'].to_dict().items():
+        rows.append(list(k)+[[(k0,v0) for k0,v0 in v.items()]])
+    return ['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'], \
+           rows, \
+           dict(zip(('y','x'),subset.iloc[0]['frame_shape'])), \
+           [x for x in subset.get_measured_regions()[['region_label','region_area_pixels']].\
+              rename(columns={'region_label':'region_name'}).T.to_dict().values()]
+
+def main(args):
+    cdf, image_names = _sample_frame(args.cells,args.images,args.seed)
+    print("sample of "+str(args.cells)+" cells in "+str(args.images)+" images")
+    start = time.perf_counter()
+    image_info = run_tool._get_sample_image_info('S',cdf,image_names)
+    print("  _get_sample_image_info: "+str(round(time.perf_counter()-start,1))+"s")
+    if args.skip_per_image: return
+    start = time.perf_counter()
+    per_image = dict([(x,_per_image_info(x,'S',cdf)) for x in image_names])
+    print("  per image filtering:    "+str(round(time.perf_counter()-start,1))+"s")
+    same = all([json.dumps(image_info[x]) == json.dumps(per_image[x]) for x in image_names])
+    print("  the json of every image is "+("identical" if same else "DIFFERENT"))
+
+def do_inputs():
+    parser = argparse.ArgumentParser(description="Benchmark building the phenotype maps of a sample",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cells',type=int,default=5000000,help="number of cells in the sample")
+    parser.add_argument('--images',type=int,default=500,help="number of images the cells are spread over")
+    parser.add_argument('--seed',type=int,default=0,help="seed of the synthetic sample")
+    parser.add_argument('--skip_per_image',action='store_true',help="only time _get_sample_image_info, the per image filtering takes minutes at the default size")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(do_inputs())
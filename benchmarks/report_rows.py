@@ -0,0 +1,106 @@
+""" Benchmark converting pythologist count and percentage frames to report rows.
+
+Compares run_tool._report_rows to the _organize_* functions it replaced,
+once for each of the six report tables on one large frame, and for the
+image tables of many images where the old functions filtered the frame
+again for each image.
+
+    python benchmarks/report_rows.py --rows 200000 --images 500 --image_rows 20000
+
+"""
+import argparse, time
+from collections import OrderedDict
+from pythologist_schemas.cli import run_tool
+
+# the minimums each table was converted with, None for the tables whose rule has its own
+MINIMUMS = OrderedDict([
+    ('image_count_densities',20),
+    ('image_count_percentages',2),
+    ('sample_cumulative_count_densities',20),
+    ('sample_aggregate_count_densities',None),
+    ('sample_cumulative_count_percentages',20),
+    ('sample_aggregate_count_percentages',None)
+])
+
+# the qc rule of each of the replaced functions, the column checked and a fixed minimum or None to use the one passed in
+_OLD_QC = {
+    'image_count_densities':('region_area_pixels',None),
+    'image_count_percentages':('denominator_count',None),
+    'sample_cumulative_count_densities':('cumulative_region_area_pixels',None),
+    'sample_aggregate_count_densities':('aggregate_measured_image_count',1),
+    'sample_cumulative_count_percentages':('cumulative_denominator_count',None),
+    'sample_aggregate_count_percentages':('aggregate_measured_image_count',1)
+}
+
+def _organize(frame,table_name,minimum):
+    # what each of the replaced _organize_* functions did, rename, set measure_qc_pass and iterrows
+    import pandas as pd
+    conv = run_tool.REPORT_CONVERSIONS[table_name]['columns']
+    qc_column, qc_minimum = _OLD_QC[table_name]
+    if qc_minimum is None: qc_minimum = minimum
+    report = frame.rename(columns=conv).loc[:,list(conv.values())]
+    report['measure_qc_pass'] = True
+    report.loc[report[qc_column] < qc_minimum,'measure_qc_pass'] = False
+    report = report.where(pd.notnull(report), None)
+    return [row.to_dict() for index,row in report.iterrows()]
+
+def _frame(row_count,image_count,seed):
+    # every pythologist column of the six tables, with a tenth of the measures missing
+    import numpy as np
+    import pandas as pd
+    rng = np.random.RandomState(seed)
+    frame = pd.DataFrame(OrderedDict([
+        ('frame_name',['S_['+str(x)+']' for x in rng.randint(0,image_count,row_count)]),
+        ('region_label',np.array(['Tumor','Stroma','Any'])[rng.randint(0,3,row_count)]),
+        ('phenotype_label',np.array(['CD8+','PD1+ CD8+','TUMOR'])[rng.randint(0,3,row_count)])
+    ]))
+    columns = set([x for conversion in run_tool.REPORT_CONVERSIONS.values() for x in conversion['columns']])
+    for column in sorted(columns - set(frame.columns)):
+        if 'count' in column or 'pixels' in column or column in ['numerator','denominator']:
+            frame[column] = rng.randint(0,100,row_count)
+        else:
+            values = rng.random_sample(row_count)*100
+            values[rng.random_sample(row_count) < 0.1] = np.nan
+            frame[column] = values
+    return frame
+
+def _missing_as_none(rows):
+    # the old functions can leave NaN in float columns on newer pandas where the new rows have None
+    return [dict([(k,None if v != v else v) for k, v in row.items()]) for row in rows]
+
+def main(args):
+    frame = _frame(args.rows,args.images,args.seed)
+    print("one frame of "+str(args.rows)+" rows for each table")
+    for table_name, minimum in MINIMUMS.items():
+        start = time.perf_counter()
+        old = _organize(frame,table_name,minimum)
+        old_seconds = time.perf_counter()-start
+        start = time.perf_counter()
+        new = run_tool._report_rows(frame,table_name,minimum)
+        new_seconds = time.perf_counter()-start
+        same = _missing_as_none(old) == new
+        print("  "+table_name+": "+str(round(old_seconds,2))+"s -> "+str(round(new_seconds,2))+"s"+("" if same else " DIFFERENT"))
+    frame = _frame(args.image_rows,args.images,args.seed)
+    image_names = sorted(set(frame['frame_name']))
+    print("image tables of "+str(len(image_names))+" images over "+str(args.image_rows)+" rows")
+    for table_name in ['image_count_densities','image_count_percentages']:
+        start = time.perf_counter()
+        old = OrderedDict([(x,_organize(frame.loc[frame['frame_name']==x],table_name,MINIMUMS[table_name])) for x in image_names])
+        old_seconds = time.perf_counter()-start
+        start = time.perf_counter()
+        new = run_tool._report_rows(frame,table_name,MINIMUMS[table_name],group_by='frame_name')
+        new_seconds = time.perf_counter()-start
+        same = all([_missing_as_none(old[x]) == new[x] for x in image_names])
+        print("  "+table_name+": "+str(round(old_seconds,2))+"s -> "+str(round(new_seconds,2))+"s"+("" if same else " DIFFERENT"))
+
+def do_inputs():
+    parser = argparse.ArgumentParser(description="Benchmark converting count and percentage frames to report rows",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rows',type=int,default=200000,help="rows of the frame each table is converted from")
+    parser.add_argument('--images',type=int,default=500,help="number of images the rows are spread over")
+    parser.add_argument('--image_rows',type=int,default=20000,help="rows of the frame the image tables are split from")
+    parser.add_argument('--seed',type=int,default=0,help="seed of the synthetic frames")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(do_inputs())
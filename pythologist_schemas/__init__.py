@@ -1,7 +1,88 @@
-import argparse, json, os, sys
-from jsonschema import Draft7Validator, RefResolver, SchemaError
+import argparse, json, os, sys, threading, weakref
 
-def get_validator(filename, base_uri=''):
+class _ValidatorCache(dict):
+    # a dict that can be weakly referenced, so the cache of a finished thread is released,
+    # and compares by identity so the caches of two threads are never the same set member
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+# Per-thread caches of checked validators keyed on (resolved path, mtime, base_uri, engine, pointer).
+# A RefResolver pushes and pops scopes while following $refs, so one validator is never shared
+# between threads.  Every thread's cache is registered so clear_validator_cache reaches them all.
+_validator_cache = threading.local()
+_validator_caches = weakref.WeakSet()
+_validator_cache_lock = threading.Lock()
+
+VALIDATOR_ENGINES = ['jsonschema','compiled']
+
+def get_validator(filename, base_uri='', use_cache=True, engine='jsonschema', pointer=''):
+    """Return a checked validator for the schema in filename.
+
+    Validators are cached for each thread keyed on the resolved path, the
+    modification time of the schema file and the base_uri, so repeated
+    calls from a thread hand back the same already-checked validator.
+    Threads never share a validator because resolving $refs is not thread
+    safe.  A schema file that changes on disk gets a new cache entry.  Set
+    use_cache=False to always build a fresh validator.
+
+    engine 'jsonschema' returns a Draft7Validator.  engine 'compiled'
+    returns a pythologist_schemas.compiler.CompiledValidator that runs
+    python code generated from the schema and raises the same errors.
+
+    pointer is a json pointer such as '/properties/sample_outputs/items'
+    to validate against just that part of the schema, with the rest of
+    the schema document still in scope for its $refs.
+    """
+    if engine not in VALIDATOR_ENGINES:
+        raise ValueError("unknown validator engine "+str(engine)+" must be one of "+str(VALIDATOR_ENGINES))
+    if not use_cache:
+        return _build_validator(filename, base_uri, engine, pointer)
+    key = _validator_cache_key(filename, base_uri, engine, pointer)
+    cache = _thread_validator_cache()
+    with _validator_cache_lock:
+        validator = cache.get(key)
+    if validator is not None:
+        return validator
+    if engine == 'compiled':
+        from pythologist_schemas.compiler import CompiledValidator
+        validator = CompiledValidator(get_validator(filename, base_uri, pointer=pointer))
+    else:
+        validator = _build_validator(filename, base_uri, pointer=pointer)
+    with _validator_cache_lock:
+        # drop entries for older versions of the same schema file
+        for _key in [x for x in cache if x[0]==key[0] and x[2:]==key[2:]]:
+            del cache[_key]
+        validator = cache.setdefault(key, validator)
+    return validator
+
+def clear_validator_cache(filename=None):
+    """Invalidate cached validators.
+
+    With no filename the cache of every thread is cleared, otherwise only
+    the entries for that schema file (under any base_uri) are removed.
+    """
+    path = None if filename is None else os.path.realpath(str(filename))
+    with _validator_cache_lock:
+        for cache in list(_validator_caches):
+            if path is None:
+                cache.clear()
+                continue
+            for _key in [x for x in cache if x[0]==path]:
+                del cache[_key]
+
+def _thread_validator_cache():
+    cache = getattr(_validator_cache, 'validators', None)
+    if cache is None:
+        cache = _validator_cache.validators = _ValidatorCache()
+        with _validator_cache_lock:
+            _validator_caches.add(cache)
+    return cache
+
+def _validator_cache_key(filename, base_uri, engine, pointer=''):
+    path = os.path.realpath(str(filename))
+    return (path, os.stat(path).st_mtime_ns, base_uri, engine, pointer)
+
+def _build_validator(filename, base_uri='', engine='jsonschema', pointer=''):
 	# Adapated from https://www.programcreek.com/python/example/83374/jsonschema.RefResolver
 	# referencing code from HumanCellAtlas Apache License
 
@@ -17,6 +98,8 @@ def get_validator(filename, base_uri=''):
         with open(filename,'rt') as f:
             output = f.read()
         return json.loads(output)
+    # jsonschema is imported here so importing the package stays cheap
+    from jsonschema import Draft7Validator, RefResolver, SchemaError
     schema = get_json_from_file(filename)
     try:
         # Check schema via class method call. Works, despite IDE complaining
@@ -25,13 +108,29 @@ def get_validator(filename, base_uri=''):
     except SchemaError:
         raise
         sys.exit(1)
+    if pointer:
+        _node = schema
+        for part in pointer.split('/')[1:]:
+            part = part.replace('~1','/').replace('~0','~')
+            try:
+                _node = _node[int(part)] if isinstance(_node, list) else _node[part]
+            except (KeyError, IndexError, ValueError):
+                raise ValueError("json pointer "+str(pointer)+" is not in schema "+str(filename))
+        # In draft 7 a $ref overrides its sibling keywords, so the document
+        # now validates only the pointed to part while keeping its definitions
+        schema = dict(schema)
+        schema['$ref'] = '#'+pointer
     if base_uri:
         resolver = RefResolver(base_uri=base_uri,
                                referrer=filename)
     else:
         resolver = None
-    return Draft7Validator(schema=schema,
-                           resolver=resolver) 
+    validator = Draft7Validator(schema=schema,
+                                resolver=resolver)
+    if engine == 'compiled':
+        from pythologist_schemas.compiler import CompiledValidator
+        return CompiledValidator(validator)
+    return validator
 
 def do_inputs():
     parser=argparse.ArgumentParser(description="Check assumptions of image pipeline inputs.",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
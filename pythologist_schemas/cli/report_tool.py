@@ -5,8 +5,8 @@ Input is an output_json prepared by the run tool.
 
 from importlib_resources import files
 from pythologist_schemas import get_validator
-import logging, argparse, json
-import pandas as pd
+from pythologist_schemas.compression import open_json
+import logging, argparse, json, os
 from collections import OrderedDict
 
 def cli():
@@ -21,18 +21,169 @@ def _append(d,input_key,input_value):
     d2 = d2+[(input_key,input_value)]
     return OrderedDict(d2)
 
+def read_phenotype_map(phenotype_map,columns=None,base_directory=''):
+    """
+    Read the phenotype map of an image in any encoding into a DataFrame
+
+    Args:
+        phenotype_map (dict): a phenotype_map from report_output, as rows, columnar or parquet
+        columns (list): only return these columns, a Parquet sidecar only reads these from disk
+        base_directory (str): the folder of the run output that Parquet sidecar paths are relative to
+    Returns:
+        cells (pandas.DataFrame): cell_index, x, y, region_name and mutually_exclusive_phenotype
+                                  then a 0/1 column for each binary phenotype
+    """
+    import numpy as np
+    import pandas as pd
+    basics = ['cell_index','x','y','region_name','mutually_exclusive_phenotype']
+    if phenotype_map.get('encoding') == 'parquet':
+        import pyarrow.parquet as pq
+        if columns is None: columns = basics+phenotype_map['binary_phenotype_names']
+        cells = pq.read_table(os.path.join(base_directory,phenotype_map['file_path']),columns=columns,
+                              filters=[('image_name','==',phenotype_map['image_name'])]).to_pandas()
+        for column in [x for x in columns if x in phenotype_map['binary_phenotype_names']]:
+            cells[column] = cells[column].astype(np.int64)
+        return cells
+    if columns is not None: return read_phenotype_map(phenotype_map).loc[:,columns]
+    if phenotype_map.get('encoding') == 'columnar':
+        cells = pd.DataFrame(OrderedDict([
+            ('cell_index',np.asarray(phenotype_map['cell_index'],dtype=np.int64)),
+            ('x',np.asarray(phenotype_map['x'],dtype=np.int64)),
+            ('y',np.asarray(phenotype_map['y'],dtype=np.int64)),
+            ('region_name',np.asarray(phenotype_map['region_names'],dtype=object)[np.asarray(phenotype_map['region_codes'],dtype=np.int64)]),
+            ('mutually_exclusive_phenotype',np.asarray(phenotype_map['phenotype_names'],dtype=object)[np.asarray(phenotype_map['phenotype_codes'],dtype=np.int64)])
+        ]),columns=basics)
+        # more than 63 markers don't fit in int64 so leave those bitmasks as python integers
+        bits = np.asarray(phenotype_map['binary_phenotype_bits'],dtype=np.int64 if len(phenotype_map['binary_phenotype_names']) < 64 else object)
+        for i, target_name in enumerate(phenotype_map['binary_phenotype_names']):
+            cells[target_name] = ((bits >> i) & 1).astype(np.int64)
+        return cells
+    cells = pd.DataFrame([row[0:5] for row in phenotype_map['rows']],columns=basics)
+    binary_phenotypes = pd.DataFrame([OrderedDict(row[5]) for row in phenotype_map['rows']],index=cells.index)
+    return pd.concat([cells,binary_phenotypes],axis=1)
+
+def read_sidecar_table(sidecar_file,columns=None,base_directory=''):
+    """
+    Read a report table the run stored in a Parquet file
+
+    Args:
+        sidecar_file (dict): the file_path and sha256_hash of the table
+        columns (list): only read these columns, if None read them all
+        base_directory (str): the folder of the run output the file_path is relative to
+    Returns:
+        table (pandas.DataFrame)
+    """
+    import pyarrow.parquet as pq
+    return pq.read_table(os.path.join(base_directory,sidecar_file['file_path']),columns=columns).to_pandas()
+
+# fields of each image the report does not use, they are skipped over without being decoded
+SKIPPED_IMAGE_KEYS = ['phenotype_map']
+
+def iter_sample_outputs(inf,header=None,skip_image_keys=SKIPPED_IMAGE_KEYS,chunk_size=None):
+    """
+    Read the sample outputs of a run output one at a time
+
+    Only one sample output is decoded at a time, and the fields of each image
+    in skip_image_keys are passed over without being decoded at all.  A
+    ValueError is raised once the document is read if it has no
+    sample_outputs or anything follows it.
+
+    Args:
+        inf (file): the run output json open as text
+        header (dict): filled in with every field of the run output other than sample_outputs,
+                       it is complete once the sample outputs have all been read
+        skip_image_keys (list): fields of each image to leave out
+        chunk_size (int): number of characters to read at a time, if None use the reader default
+    Yields:
+        sample_output (dict): a sample output without the skipped image fields
+    """
+    from pythologist_schemas.json_stream import JSONStreamReader
+    reader = JSONStreamReader(inf) if chunk_size is None else JSONStreamReader(inf,chunk_size)
+    if header is None: header = {}
+    has_sample_outputs = False
+    for key in reader.items():
+        if key != 'sample_outputs':
+            header[key] = reader.value()
+            continue
+        has_sample_outputs = True
+        for _ in reader.elements():
+            yield _read_sample_output(reader,skip_image_keys)
+    reader.end()
+    if not has_sample_outputs: raise ValueError("run output has no sample_outputs")
+
+def _read_sample_output(reader,skip_image_keys):
+    sample_output = OrderedDict()
+    for key in reader.items():
+        if key != 'images':
+            sample_output[key] = reader.value()
+            continue
+        sample_output['images'] = []
+        for _ in reader.elements():
+            image = OrderedDict()
+            for image_key in reader.items():
+                if image_key in skip_image_keys:
+                    reader.skip()
+                else:
+                    image[image_key] = reader.value()
+            sample_output['images'].append(image)
+    return sample_output
+
+def sample_output_validator(skip_image_keys=SKIPPED_IMAGE_KEYS):
+    """
+    Return a compiled validator for the sample outputs iter_sample_outputs yields
+
+    The image fields in skip_image_keys are not required, otherwise the
+    schema is the sample output schema of the run output.
+
+    Args:
+        skip_image_keys (list): fields of each image that were left out
+    Returns:
+        validator (pythologist_schemas.compiler.CompiledValidator)
+    """
+    from jsonschema import Draft7Validator
+    from pythologist_schemas.compiler import CompiledValidator
+    reference = get_validator(files('schema_data').joinpath('report_output.json'),pointer='/properties/sample_outputs/items')
+    schema = _without_required(json.loads(json.dumps(reference.schema)),set(skip_image_keys))
+    return CompiledValidator(Draft7Validator(schema))
+
+def _without_required(schema,keys):
+    # drop keys from the required fields of every image schema, those requiring an image_name
+    if isinstance(schema,list):
+        for x in schema: _without_required(x,keys)
+    if not isinstance(schema,dict): return schema
+    if 'image_name' in schema.get('required',[]):
+        schema['required'] = [x for x in schema['required'] if x not in keys]
+    for x in schema.values(): _without_required(x,keys)
+    return schema
+
+def _sample_table(sample,table_name,base_directory):
+    import pandas as pd
+    if table_name in sample.get('sidecar_files',{}):
+        return read_sidecar_table(sample['sidecar_files'][table_name],base_directory=base_directory)
+    return pd.DataFrame([row for row in sample['sample_reports'][table_name]])
+
+def _image_table(sample,image,table_name,sidecar_tables,base_directory):
+    # image tables in a sidecar hold every image of the sample so read each once
+    import pandas as pd
+    if table_name not in sample.get('sidecar_files',{}):
+        return pd.DataFrame([row for row in image['image_reports'][table_name]])
+    if table_name not in sidecar_tables:
+        sidecar_tables[table_name] = read_sidecar_table(sample['sidecar_files'][table_name],base_directory=base_directory)
+    table = sidecar_tables[table_name]
+    return table.loc[table['image_name']==image['image_name']].drop(columns=['image_name']).reset_index(drop=True)
+
 def main(args):
     "We need to take the platform and return an appropriate input template"
+    import pandas as pd
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARNING)
     logger = logging.getLogger("report extraction")
-    report = json.loads(open(args.report_json,'rt').read())
-    logger.info("check report json format")
-    get_validator(files('schema_data').joinpath('report_output.json')).\
-        validate(report)
-    logger.info("report json validated")
+    report_output = files('schema_data').joinpath('report_output.json')
+    _validator = sample_output_validator(SKIPPED_IMAGE_KEYS)
+    # Parquet sidecars are stored relative to the run output
+    base_directory = os.path.dirname(os.path.abspath(args.report_json))
 
     # Lets start formulating the dataframes
 
@@ -46,61 +197,71 @@ def main(args):
         'img_pct_lf':[]
     })
     info = {}
-    for sample in report['sample_outputs']:
-        sample_name = sample['sample_name']
-        _df = pd.DataFrame([row for row in sample['sample_reports']['sample_cumulative_count_densities']])
-        _df['sample_name'] = sample_name
-        sheets['smp_cnt_cumulative_lf'].append(_df)
-        info['smp_cnt_cumulative_lf'] = {
-            'index':False,
-            'description':'sample-level count density measurements treating all ROIs as a single large image in long table format.'
-        }
-
-        _df = pd.DataFrame([row for row in sample['sample_reports']['sample_aggregate_count_densities']])
-        _df['sample_name'] = sample_name
-        sheets['smp_cnt_aggregate_lf'].append(_df)
-        info['smp_cnt_aggregate_lf'] = {
-            'index':False,
-            'description':'sample-level count density measurements averaging the measures from ROIs in long table format.'
-        }
-
-        _df = pd.DataFrame([row for row in sample['sample_reports']['sample_cumulative_count_percentages']])
-        _df['sample_name'] = sample_name
-        sheets['smp_pct_cumulative_lf'].append(_df)
-        info['smp_pct_cumulative_lf'] = {
-            'index':False,
-            'description':'sample-level percentage measurements treating all ROIs as a single large image in long table format.'
-        }
-
-        _df = pd.DataFrame([row for row in sample['sample_reports']['sample_aggregate_count_percentages']])
-        _df['sample_name'] = sample_name
-        sheets['smp_pct_aggregate_lf'].append(_df)
-        info['smp_pct_aggregate_lf'] = {
-            'index':False,
-            'description':'sample-level percentage measurements averaging the measures from ROIs in long table format.'
-        }
-
-        # Now get the images
-        for image in sample['images']:
-            image_name = image['image_name']
-            _df = pd.DataFrame([row for row in image['image_reports']['image_count_densities']])
+    # read the run output one sample at a time and keep only the report tables
+    header = OrderedDict()
+    with open_json(args.report_json,'rt') as inf:
+        for sample in iter_sample_outputs(inf,header):
+            logger.info("check sample output json format "+str(sample['sample_name']))
+            _validator.validate(sample)
+            sample_name = sample['sample_name']
+            sidecar_tables = {}
+            _df = _sample_table(sample,'sample_cumulative_count_densities',base_directory)
+            _df['sample_name'] = sample_name
+            sheets['smp_cnt_cumulative_lf'].append(_df)
+            info['smp_cnt_cumulative_lf'] = {
+                'index':False,
+                'description':'sample-level count density measurements treating all ROIs as a single large image in long table format.'
+            }
+
+            _df = _sample_table(sample,'sample_aggregate_count_densities',base_directory)
             _df['sample_name'] = sample_name
-            _df['image_name'] = image_name
-            sheets['img_cnt_lf'].append(_df)
-            info['img_cnt_lf'] = {
+            sheets['smp_cnt_aggregate_lf'].append(_df)
+            info['smp_cnt_aggregate_lf'] = {
                 'index':False,
-                'description':'image-level count density measurements in long table format.'
+                'description':'sample-level count density measurements averaging the measures from ROIs in long table format.'
             }
 
-            _df = pd.DataFrame([row for row in image['image_reports']['image_count_percentages']])
+            _df = _sample_table(sample,'sample_cumulative_count_percentages',base_directory)
             _df['sample_name'] = sample_name
-            _df['image_name'] = image_name
-            sheets['img_pct_lf'].append(_df)
-            info['img_pct_lf'] = {
+            sheets['smp_pct_cumulative_lf'].append(_df)
+            info['smp_pct_cumulative_lf'] = {
                 'index':False,
-                'description':'image-level percentage measurements in long table format.'
+                'description':'sample-level percentage measurements treating all ROIs as a single large image in long table format.'
             }
 
+            _df = _sample_table(sample,'sample_aggregate_count_percentages',base_directory)
+            _df['sample_name'] = sample_name
+            sheets['smp_pct_aggregate_lf'].append(_df)
+            info['smp_pct_aggregate_lf'] = {
+                'index':False,
+                'description':'sample-level percentage measurements averaging the measures from ROIs in long table format.'
+            }
+
+            # Now get the images
+            for image in sample['images']:
+                image_name = image['image_name']
+                _df = _image_table(sample,image,'image_count_densities',sidecar_tables,base_directory)
+                _df['sample_name'] = sample_name
+                _df['image_name'] = image_name
+                sheets['img_cnt_lf'].append(_df)
+                info['img_cnt_lf'] = {
+                    'index':False,
+                    'description':'image-level count density measurements in long table format.'
+                }
+
+                _df = _image_table(sample,image,'image_count_percentages',sidecar_tables,base_directory)
+                _df['sample_name'] = sample_name
+                _df['image_name'] = image_name
+                sheets['img_pct_lf'].append(_df)
+                info['img_pct_lf'] = {
+                    'index':False,
+                    'description':'image-level percentage measurements in long table format.'
+                }
+
+    logger.info("check report json format")
+    get_validator(report_output,engine='compiled').validate(dict(header,sample_outputs=[]))
+    logger.info("report json validated")
+
     # move the sheets to dataframes
     for sheet_name in sheets:
         sheets[sheet_name] = pd.concat(sheets[sheet_name])
@@ -194,7 +355,7 @@ def do_inputs():
     parser = argparse.ArgumentParser(
             description = "Run the pipeline",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--report_json',required=True,help="The report json that was output but the run")
+    parser.add_argument('--report_json',required=True,help="The report json that was output but the run, compressed or not")
     parser.add_argument('--output_excel',required=True,help="The path to write the output excel report")
     parser.add_argument('--verbose',action='store_true',help="Show more about the run")
     args = parser.parse_args()
@@ -5,14 +5,12 @@ Input is a json prepared by the staging tool.
 
 from importlib_resources import files
 from pythologist_schemas import get_validator
-from pythologist_reader.formats.inform import read_standard_format_sample_to_project
-from pythologist import CellDataFrame, SubsetLogic as SL, PercentageLogic as PL
-import logging, argparse, json, uuid
+from pythologist_schemas.compression import open_json, compression_from_extension, COMPRESSIONS
+import logging, argparse, json, uuid, traceback, hashlib, itertools, re
 from collections import OrderedDict
-import pandas as pd
 from datetime import datetime
-import gzip, os
-from tempfile import NamedTemporaryFile
+import os, shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 
 
 def cli():
@@ -25,6 +23,15 @@ def main(args):
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARNING)
+    if args.parquet_sidecar and not args.output_json:
+        raise ValueError("parquet_sidecar writes files beside the output_json so it needs one")
+    if args.recompute_from:
+        if args.resume: raise ValueError("resume can not be used with recompute_from")
+        if not args.report_json: raise ValueError("recompute_from needs a report_json to measure")
+    elif not args.input_json:
+        raise ValueError("input_json is required unless a report is recomputed with recompute_from")
+    if args.resume and not args.cache_directory:
+        raise ValueError("resume needs the cache_directory of the run being resumed")
     if args.cache_directory:
         if not os.path.exists(args.cache_directory):
             os.makedirs(args.cache_directory)
@@ -34,7 +41,17 @@ def main(args):
     run_id = str(uuid.uuid4())
     logger.info("run_id "+run_id)
 
-    inputs = json.loads(open(args.input_json,'rt').read())
+    if args.recompute_from:
+        with open_json(args.report_json,'rt') as inf:
+            report = json.loads(inf.read())
+        with open_json(args.recompute_from,'rt') as inf:
+            headers, sample_outputs = _recompute_samples(inf,report,run_id,verbose=args.verbose,workers=args.workers,
+                                                         phenotype_map_encoding=args.phenotype_map_encoding)
+            _write_outputs(args,headers,sample_outputs)
+        return
+
+    with open_json(args.input_json,'rt') as inf:
+        inputs = json.loads(inf.read())
 
     # Lets start by checking our inputs
     logger.info("check project json format")
@@ -44,71 +61,594 @@ def main(args):
     get_validator(files('schema_data.inputs.platforms.InForm').joinpath('analysis.json')).\
         validate(inputs['analysis'])
     logger.info("check report json format")
-    get_validator(files('schema_data.inputs').joinpath('report.json')).\
-        validate(inputs['report'])
+    _check_reports(_reports(inputs))
     logger.info("check panel json format")
     get_validator(files('schema_data.inputs').joinpath('panel.json')).\
         validate(inputs['panel'])
-    _validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('files.json'))
+    _validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('files.json'),engine='compiled')
     for sample_input_json in inputs['sample_files']:
         logger.info("check sample files json format "+str(sample_input_json['sample_name']))
         _validator.validate(sample_input_json)
 
-    # Now lets step through sample-by-sample executing the pipeline
-    output = {
-        'run_id':run_id,
-        'time':str(datetime.now()),
+    # Now lets step through sample-by-sample executing the pipeline, every report is measured in the same pass
+    headers = []
+    for report in _reports(inputs):
+        headers.append(OrderedDict([
+            ('run_id',run_id),
+            ('time',str(datetime.now())),
+            ('project_name',inputs['project']['parameters']['project_name']),
+            ('report_name',report['parameters']['report_name']),
+            ('report_version',report['parameters']['report_version']),
+            ('analysis_name',inputs['analysis']['parameters']['analysis_name']),
+            ('analysis_version',inputs['analysis']['parameters']['analysis_version']),
+            ('panel_name',inputs['panel']['parameters']['panel_name']),
+            ('panel_version',inputs['panel']['parameters']['panel_version'])
+        ]))
+    sample_outputs = _iter_samples(inputs,run_id,verbose=args.verbose,cache_directory=args.cache_directory,
+                                   workers=args.workers,resume=args.resume,
+                                   phenotype_map_encoding=args.phenotype_map_encoding)
+    _write_outputs(args,headers,_output_lists(inputs['report'],sample_outputs))
+    return 
+
+def _check_reports(reports):
+    # validate each report, several reports are written to files named after them so the names have to differ
+    _validator = get_validator(files('schema_data.inputs').joinpath('report.json'))
+    for report in reports:
+        _validator.validate(report)
+    report_names = [x['parameters']['report_name'] for x in reports]
+    if len(report_names) == 0: raise ValueError("at least one report is needed")
+    if len(set(report_names)) < len(report_names):
+        raise ValueError("report names must be unique to run several reports together "+str(report_names))
+
+def _output_lists(report,sample_outputs):
+    # the outputs of a sample as a list in report order whether one report or a list of them was run
+    if isinstance(report,list): return sample_outputs
+    return ([x] for x in sample_outputs)
+
+def _report_output_paths(output_json,report_names):
+    """
+    Return the path of the run output of each report
+
+    One report is written to output_json.  Several reports are written beside
+    it with the report name before the extension, run.json becoming
+    run.<report name>.json, and run.json.gz becoming run.<report name>.json.gz.
+    """
+    if len(report_names) == 1: return [output_json]
+    base, compression_extension = output_json, ''
+    if compression_from_extension(base) != 'none': base, compression_extension = os.path.splitext(base)
+    base, extension = os.path.splitext(base)
+    output_paths = [base+'.'+re.sub(r'[^A-Za-z0-9_.-]+','_',x)+extension+compression_extension for x in report_names]
+    if len(set(output_paths)) < len(output_paths):
+        raise ValueError("report names "+str(report_names)+" give the same output file name")
+    return output_paths
+
+def _write_outputs(args,headers,sample_outputs):
+    """
+    Write the run output of each report, and their parquet sidecars if asked for, as the sample outputs are produced
+
+    Args:
+        headers (list): the header of the run output of each report
+        sample_outputs (iterable): a list for each sample of its output for each report in the order of headers
+    """
+    logger = logging.getLogger("write output")
+    output_paths = _report_output_paths(args.output_json,[x['report_name'] for x in headers]) if args.output_json else [None]*len(headers)
+    sidecar_directories = [None]*len(headers)
+    if args.parquet_sidecar:
+        output_directory = os.path.dirname(os.path.abspath(args.output_json))
+        sidecar_directories = []
+        for output_path in output_paths:
+            output_base = os.path.abspath(output_path)
+            if compression_from_extension(output_base) != 'none': output_base = os.path.splitext(output_base)[0]
+            sidecar_directory = os.path.splitext(output_base)[0]+'_sidecar'
+            if not os.path.exists(sidecar_directory): os.makedirs(sidecar_directory)
+            sidecar_directories.append(sidecar_directory)
+    writers = []
+    complete = False
+    try:
+        for header, output_path in zip(headers,output_paths):
+            writers.append(_RunOutputWriter(output_path,header,compression=args.compression,level=args.compression_level))
+        for outputs in sample_outputs:
+            for writer, sample_output, sidecar_directory in zip(writers,outputs,sidecar_directories):
+                if sidecar_directory is not None:
+                    sample_output = _write_parquet_sidecar(sample_output,sidecar_directory,output_directory,tables=args.parquet_sidecar=='all')
+                writer.write(sample_output)
+        complete = True
+    finally:
+        for writer in writers: writer.close(complete)
+    for writer in writers:
+        logger.info("Validated and wrote "+str(writer.sample_count)+" sample outputs for "+str(writer.output_json))
+
+def _recompute_samples(inf,report,run_id,verbose=False,workers=1,function=None,phenotype_map_encoding='rows'):
+    """
+    Measure a new report, or several, for the samples of an earlier run output
+
+    The earlier run output is read one sample output at a time without its
+    phenotype maps, and each sample is measured from the CellDataFrame the
+    earlier run saved with recompute_sample.
+
+    Args:
+        inf (file): the earlier run output open as text
+        report (dict): the report to measure, or a list of reports to measure together
+        workers (int): number of samples to measure at once in separate processes
+    Returns:
+        headers (list): for each report every field of its run output except sample_outputs
+        sample_outputs (generator): a list for each sample of its new outputs in report order, in the order of the earlier run
+    """
+    from pythologist_schemas.cli.report_tool import iter_sample_outputs
+    logger = logging.getLogger("recompute report")
+    logger.info("check report json format")
+    reports = _reports({'report':report})
+    _check_reports(reports)
+    if function is None: function = recompute_sample
+    if phenotype_map_encoding != 'rows': function = _PhenotypeMapEncoding(function,phenotype_map_encoding)
+    previous_header = {}
+    previous_outputs = iter_sample_outputs(inf,previous_header)
+    # the fields of a run output are written before its sample outputs so they are read with the first one
+    first = next(previous_outputs,None)
+    _missing = [x for x in ['project_name','analysis_name','analysis_version','panel_name','panel_version'] if x not in previous_header]
+    if len(_missing) > 0: raise ValueError("earlier run output is missing "+str(_missing))
+    logger.info("recomputing the samples of run "+str(previous_header.get('run_id'))+" for reports "+\
+                str([x['parameters']['report_name'] for x in reports]))
+    headers = []
+    for _report in reports:
+        headers.append(OrderedDict([
+            ('run_id',run_id),
+            ('time',str(datetime.now())),
+            ('project_name',previous_header['project_name']),
+            ('report_name',_report['parameters']['report_name']),
+            ('report_version',_report['parameters']['report_version']),
+            ('analysis_name',previous_header['analysis_name']),
+            ('analysis_version',previous_header['analysis_version']),
+            ('panel_name',previous_header['panel_name']),
+            ('panel_version',previous_header['panel_version'])
+        ]))
+    previous_outputs = itertools.chain([] if first is None else [first],previous_outputs)
+    return headers, _output_lists(report,_execute_samples(previous_outputs,{'report':report},run_id,verbose=verbose,workers=workers,function=function))
+
+class _RunOutputWriter(object):
+    """
+    Validate and write a run output as its sample outputs are handed over
+
+    The header fields are written first and then each sample output is
+    validated against the sample_outputs items of the report output schema and
+    written as soon as it is handed over, so only one sample output is held in
+    memory at once.  The json is written to a temporary file beside output_json
+    and compressed as it is written.  Several run outputs can be written side
+    by side, one sample at a time each.  close has to be called, with complete
+    False if the run failed so the temporary file is removed rather than
+    renamed into place and a failed run leaves no partial output.
+
+    Args:
+        output_json (str): path to write to, if None the sample outputs are only validated
+        header (dict): every field of the run output except sample_outputs
+        compression (str): gzip, xz, zstd or none, if None use the extension of output_json
+        level (int): compression level, if None use the default of the compression
+    """
+    def __init__(self,output_json,header,compression=None,level=None):
+        report_output = files('schema_data').joinpath('report_output.json')
+        get_validator(report_output,engine='compiled').validate(dict(header,sample_outputs=[]))
+        self._validator = get_validator(report_output,engine='compiled',pointer='/properties/sample_outputs/items')
+        self.output_json = output_json
+        self.sample_count = 0
+        self._of = None
+        if output_json:
+            self._ntf = NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output_json)),delete=False,
+                                           prefix='.'+os.path.basename(output_json)+'-',suffix='.partial')
+            self._ntf.close()
+            try:
+                self._of = open_json(self._ntf.name,'wt',compression if compression is not None else compression_from_extension(output_json),level)
+                self._of.write('{'+''.join([json.dumps(k)+': '+json.dumps(v,allow_nan=False)+', ' for k, v in header.items()])+'"sample_outputs": [')
+            except Exception:
+                if self._of is not None: self._of.close()
+                os.remove(self._ntf.name)
+                raise
+    def write(self,sample_output):
+        logging.getLogger("write output").info("validate output format of "+str(sample_output['sample_name']))
+        self._validator.validate(sample_output)
+        if self._of is not None:
+            self._of.write((', ' if self.sample_count > 0 else '')+json.dumps(sample_output,allow_nan=False))
+        self.sample_count += 1
+    def close(self,complete=True):
+        if self._of is None: return
+        of, self._of = self._of, None
+        try:
+            if complete: of.write(']}')
+        except Exception:
+            complete = False
+            raise
+        finally:
+            of.close()
+            if complete:
+                os.replace(self._ntf.name,self.output_json)
+            else:
+                os.remove(self._ntf.name)
+
+def _iter_samples(inputs,run_id,verbose=False,cache_directory=None,workers=1,resume=False,function=None,phenotype_map_encoding='rows'):
+    """
+    Yield the sample outputs of a run in manifest order
+
+    With a cache_directory each sample output is saved as a shard as soon as
+    the sample finishes.  A shard is keyed on the sha256 of the sample files and
+    the project, analysis, panel and report it was run with.  With resume, samples
+    that already have a shard for the same key are not run again.  Shards keep
+    the phenotype maps as rows and they are encoded as phenotype_map_encoding
+    once a sample is done.
+
+    Only the sample being yielded is held here, shards being resumed are read
+    again when it is their turn.
+    """
+    logger = logging.getLogger("run samples")
+    if function is None: function = execute_sample
+    resumed = set()
+    if resume:
+        for files_json in inputs['sample_files']:
+            if _read_shard(cache_directory,files_json,inputs) is not None:
+                resumed.add(files_json['sample_name'])
+        logger.info("resuming with "+str(len(resumed))+" of "+str(len(inputs['sample_files']))+" samples already run")
+    pending = [x for x in inputs['sample_files'] if x['sample_name'] not in resumed]
+    if cache_directory: function = _Checkpoint(function)
+    if phenotype_map_encoding != 'rows': function = _PhenotypeMapEncoding(function,phenotype_map_encoding)
+    executed = _execute_samples(pending,inputs,run_id,verbose=verbose,cache_directory=cache_directory,workers=workers,function=function)
+    try:
+        for files_json in inputs['sample_files']:
+            if files_json['sample_name'] not in resumed:
+                yield next(executed)
+                continue
+            sample_output = _read_shard(cache_directory,files_json,inputs)
+            if sample_output is None:
+                raise ValueError("shard of "+str(files_json['sample_name'])+" changed while resuming")
+            yield _encode_phenotype_maps(sample_output,phenotype_map_encoding)
+    finally:
+        executed.close()
+
+def _shard_key(files_json,inputs):
+    # everything a sample output depends on, the files json includes the sha256 of every input file
+    _key = {'sample_files':files_json}
+    for name in ['project','analysis','panel','report']: _key[name] = inputs[name]
+    return hashlib.sha256(json.dumps(_key,sort_keys=True).encode('utf-8')).hexdigest()
+
+def _shard_path(cache_directory,files_json,inputs):
+    return os.path.join(cache_directory,'SAMPLE-'+_shard_key(files_json,inputs)+'.json')
+
+def _read_shard(cache_directory,files_json,inputs):
+    # the saved output of a sample, or None if there isn't a complete one for these inputs
+    logger = logging.getLogger("resume")
+    shard_path = _shard_path(cache_directory,files_json,inputs)
+    if not os.path.exists(shard_path): return None
+    try:
+        with open(shard_path,'rt') as inf:
+            shard = json.loads(inf.read())
+    except ValueError:
+        logger.warning("ignoring unreadable shard "+str(shard_path))
+        return None
+    if shard.get('key') != _shard_key(files_json,inputs) or shard.get('sample_name') != files_json['sample_name']:
+        logger.warning("ignoring shard for different inputs "+str(shard_path))
+        return None
+    sample_output = shard['sample_output']
+    # a run of several reports saves the list of their sample outputs
+    _missing = [x for y in (sample_output if isinstance(sample_output,list) else [sample_output]) \
+                  for x in y.get('intermediate_files',{}).values() if x is not None and not os.path.exists(x)]
+    if len(_missing) > 0:
+        logger.warning("ignoring shard with missing intermediate files "+str(_missing))
+        return None
+    logger.info("reusing "+str(files_json['sample_name'])+" from "+str(shard_path))
+    return sample_output
+
+def _write_shard(cache_directory,files_json,inputs,sample_output):
+    # write then rename so an interrupted run never leaves a partial shard behind
+    shard = {'key':_shard_key(files_json,inputs),'sample_name':files_json['sample_name'],'sample_output':sample_output}
+    ntf = NamedTemporaryFile(dir=cache_directory,delete=False,prefix='.SAMPLE-',suffix='.json',mode='wt')
+    with ntf as of:
+        of.write(json.dumps(shard,allow_nan=False))
+    os.replace(ntf.name,_shard_path(cache_directory,files_json,inputs))
+
+EXPORT_CACHE_VERSION = 1
+EXPORT_READING_PARAMETERS = ['region_annotation_strategy','region_annotation_custom_label','unannotated_region_label',
+                             'expanded_margin_width_um','draw_margin_width']
+
+def _export_cache_key(files_json,inputs):
+    # the digests of the files the reader parses and the parameters that change how it parses them.
+    # the report and the rest of the analysis only matter after reading so a change to them keeps the cache.
+    _exports = []
+    for export in files_json['exports']:
+        _images = []
+        for image in export['images']:
+            _images.append({
+                'image_name':image['image_name'],
+                'image_data':dict([(x,[os.path.basename(y['file_path']),y['sha256_hash']]) for x, y in image['image_data'].items()]),
+                'image_annotations':[[x['mask_label'],os.path.basename(x['file_path']),x['sha256_hash']] for x in image['image_annotations']]
+            })
+        _exports.append({'export_name':export['export_name'],'images':_images})
+    _key = {
+        'version':EXPORT_CACHE_VERSION,
+        'sample_name':files_json['sample_name'],
+        'exports':_exports,
+        'channel_abbreviations':sorted([[x['full_name'],x['marker_name']] for x in inputs['panel']['markers']]),
         'project_name':inputs['project']['parameters']['project_name'],
-        'report_name':inputs['report']['parameters']['report_name'],
-        'report_version':inputs['report']['parameters']['report_version'],
-        'analysis_name':inputs['analysis']['parameters']['analysis_name'],
-        'analysis_version':inputs['analysis']['parameters']['analysis_version'],
-        'panel_name':inputs['panel']['parameters']['panel_name'],
-        'panel_version':inputs['panel']['parameters']['panel_version'],
-        'sample_outputs':[execute_sample(x,inputs,run_id,verbose=args.verbose,cache_directory=args.cache_directory) for x in inputs['sample_files']]
+        'microns_per_pixel':inputs['project']['parameters']['microns_per_pixel'],
+        'analysis':dict([(x,inputs['analysis']['parameters'][x]) for x in EXPORT_READING_PARAMETERS])
     }
-    logger.info("Finished reading creating output. Validate output format.")
-    _validator = get_validator(files('schema_data').joinpath('report_output.json'))
-    _validator.validate(output)
-    logger.info("Validated output schema against schema")
-    if args.output_json:
-        with open(args.output_json,'wt') as of:
-            of.write(json.dumps(output,allow_nan=False))
-    return 
+    return hashlib.sha256(json.dumps(_key,sort_keys=True).encode('utf-8')).hexdigest()
+
+def _export_cache_path(cache_directory,files_json,inputs):
+    return os.path.join(cache_directory,'EXPORTS-'+_export_cache_key(files_json,inputs))
+
+def _read_export_cache(cache_directory,files_json,inputs):
+    """
+    Read the CellDataFrames of the exports of a sample parsed by an earlier run
+
+    Returns:
+        cdfs (OrderedDict): the CellDataFrame of each export in the order the reader gave them
+        project_h5 (str): the saved project of the primary export
+        or None if there isn't a complete entry for these input files
+    """
+    logger = logging.getLogger("export cache")
+    cache_path = _export_cache_path(cache_directory,files_json,inputs)
+    manifest_path = os.path.join(cache_path,'manifest.json')
+    if not os.path.exists(manifest_path): return None
+    try:
+        with open(manifest_path,'rt') as inf:
+            manifest = json.loads(inf.read())
+    except ValueError:
+        logger.warning("ignoring unreadable export cache "+str(cache_path))
+        return None
+    if manifest.get('key') != _export_cache_key(files_json,inputs):
+        logger.warning("ignoring export cache for different inputs "+str(cache_path))
+        return None
+    from pythologist import CellDataFrame
+    cdfs = OrderedDict()
+    try:
+        for export_name, file_name in manifest['exports']:
+            cdfs[export_name] = CellDataFrame.read_hdf(os.path.join(cache_path,file_name),'data')
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning("ignoring export cache that can't be read "+str(cache_path)+" "+str(e))
+        return None
+    project_h5 = os.path.join(cache_path,manifest['project_h5'])
+    if not os.path.exists(project_h5):
+        logger.warning("ignoring export cache with a missing project "+str(project_h5))
+        return None
+    logger.info("reusing the parsed exports of "+str(files_json['sample_name'])+" from "+str(cache_path))
+    return cdfs, project_h5
+
+def _write_export_cache(cache_directory,files_json,inputs,cdfs,cpi):
+    """
+    Save the CellDataFrames of the exports of a sample so a later run with the same input files skips the reader
+
+    The entry is written to a hidden folder and renamed into place so an
+    interrupted run, or another worker writing the same sample, never leaves
+    a partial entry behind.
+
+    Args:
+        cdfs (OrderedDict): the CellDataFrame of each export
+        cpi (pythologist_reader CellProjectInForm): the project of the primary export
+    """
+    cache_path = _export_cache_path(cache_directory,files_json,inputs)
+    if os.path.exists(cache_path): return
+    temporary_path = mkdtemp(dir=cache_directory,prefix='.EXPORTS-')
+    try:
+        manifest = {'key':_export_cache_key(files_json,inputs),'exports':[],'project_h5':'project.h5'}
+        for i, export_name in enumerate(cdfs):
+            file_name = 'EXPORT-'+str(i)+'.h5'
+            cdfs[export_name].to_hdf(os.path.join(temporary_path,file_name),key='data')
+            manifest['exports'].append([export_name,file_name])
+        cpi.to_hdf(os.path.join(temporary_path,'project.h5'),overwrite=True)
+        with open(os.path.join(temporary_path,'manifest.json'),'wt') as of:
+            of.write(json.dumps(manifest))
+        os.rename(temporary_path,cache_path)
+    except OSError:
+        # another worker saved the same exports first
+        if not os.path.exists(os.path.join(cache_path,'manifest.json')): raise
+    finally:
+        if os.path.exists(temporary_path): shutil.rmtree(temporary_path)
+
+class _Checkpoint(object):
+    # run a sample and save its output as a shard, picklable so it can be sent to a worker process
+    def __init__(self,function):
+        self.function = function
+    def __call__(self,files_json,inputs,run_id,verbose=False,cache_directory=None):
+        sample_output = self.function(files_json,inputs,run_id,verbose=verbose,cache_directory=cache_directory)
+        _write_shard(cache_directory,files_json,inputs,sample_output)
+        return sample_output
+
+class _PhenotypeMapEncoding(object):
+    # run a sample and encode its phenotype maps on the worker that ran it
+    def __init__(self,function,encoding):
+        self.function = function
+        self.encoding = encoding
+    def __call__(self,files_json,inputs,run_id,verbose=False,cache_directory=None):
+        return _encode_phenotype_maps(self.function(files_json,inputs,run_id,verbose=verbose,cache_directory=cache_directory),self.encoding)
+
+def _encode_phenotype_maps(sample_output,encoding,_encoded=None):
+    # set the phenotype map of each image in a sample output, or a list of them, to rows or columnar
+    if encoding not in ['rows','columnar']:
+        raise ValueError('phenotype map encoding must be "rows" or "columnar" not '+str(encoding))
+    if encoding == 'rows': return sample_output
+    if isinstance(sample_output,list):
+        # the outputs of several reports share their phenotype maps so each is encoded once
+        _encoded = {}
+        return [_encode_phenotype_maps(x,encoding,_encoded) for x in sample_output]
+    for image in sample_output['images']:
+        rows_map = image['phenotype_map']
+        if 'rows' not in rows_map: continue
+        if _encoded is None or id(rows_map) not in _encoded:
+            phenotype_map = _columnar_phenotype_map(rows_map)
+            if phenotype_map is None:
+                logging.getLogger(str(sample_output['sample_name'])).warning("keeping rows for the phenotype map of "+str(image['image_name'])+\
+                                                                              " because its cells do not share the same binary phenotypes")
+            # keep the rows map so its id is not reused while encoding
+            if _encoded is not None: _encoded[id(rows_map)] = (rows_map,phenotype_map)
+        else:
+            phenotype_map = _encoded[id(rows_map)][1]
+        if phenotype_map is not None: image['phenotype_map'] = phenotype_map
+    return sample_output
+
+def _columnar_phenotype_map(phenotype_map):
+    """
+    Encode a phenotype map of rows as parallel columns
+
+    Region and phenotype names become integer codes into lists of the names, and
+    the binary phenotypes of each cell become a bitmask over a list of the
+    binary phenotype names.
+
+    Returns:
+        phenotype_map (dict): the columnar phenotype map, None if the cells do not all have the same
+                              binary phenotypes because a bitmask can not tell a missing marker from a negative one
+    """
+    rows = phenotype_map['rows']
+    binary_phenotype_names = [x[0] for x in rows[0][5]] if len(rows) > 0 else []
+    masks = dict([(x,1<<i) for i, x in enumerate(binary_phenotype_names)])
+    every_mask = (1<<len(masks))-1
+    region_names = {}
+    phenotype_names = {}
+    columns = {'cell_index':[],'x':[],'y':[],'region_codes':[],'phenotype_codes':[],'binary_phenotype_bits':[]}
+    for cell_index, x, y, region_name, phenotype_name, binary_phenotypes in rows:
+        if len(binary_phenotypes) != len(masks): return None
+        bits = 0
+        present = 0
+        for target_name, value in binary_phenotypes:
+            if target_name not in masks: return None
+            present |= masks[target_name]
+            if value: bits |= masks[target_name]
+        if present != every_mask: return None
+        columns['cell_index'].append(cell_index)
+        columns['x'].append(x)
+        columns['y'].append(y)
+        columns['region_codes'].append(region_names.setdefault(region_name,len(region_names)))
+        columns['phenotype_codes'].append(phenotype_names.setdefault(phenotype_name,len(phenotype_names)))
+        columns['binary_phenotype_bits'].append(bits)
+    return {
+        'encoding':'columnar',
+        'cell_index':columns['cell_index'],
+        'x':columns['x'],
+        'y':columns['y'],
+        'region_names':list(region_names),
+        'region_codes':columns['region_codes'],
+        'phenotype_names':list(phenotype_names),
+        'phenotype_codes':columns['phenotype_codes'],
+        'binary_phenotype_names':binary_phenotype_names,
+        'binary_phenotype_bits':columns['binary_phenotype_bits'],
+        'mutually_exclusive_phenotypes':phenotype_map['mutually_exclusive_phenotypes']
+    }
+
+def _execute_samples(sample_files,inputs,run_id,verbose=False,cache_directory=None,workers=1,function=None):
+    """
+    Yield execute_sample for each sample in manifest order, on a process pool when workers is more than 1
+
+    A worker holds the log records of the sample it is running and they are
+    emitted together once the sample is done, so the logs of samples never
+    interleave.  A sample that fails on a worker raises a ValueError naming the
+    sample with the traceback from the worker.
+    """
+    if function is None: function = execute_sample
+    if workers is None or workers <= 1:
+        for files_json in sample_files:
+            yield function(files_json,inputs,run_id,verbose=verbose,cache_directory=cache_directory)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    # keep a few samples queued per worker so workers stay busy while the
+    # next sample in order finishes, without holding every finished output
+    window = 2*workers
+    with ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,
+                             initargs=(function,inputs,run_id,verbose,cache_directory)) as executor:
+        futures = []
+        try:
+            for files_json in sample_files:
+                futures.append((files_json,executor.submit(_execute_sample_in_worker,files_json)))
+                if len(futures) >= window:
+                    yield _worker_result(*futures.pop(0))
+            while len(futures) > 0:
+                yield _worker_result(*futures.pop(0))
+        finally:
+            # dont start samples that are still waiting if we stopped early
+            for files_json, future in futures: future.cancel()
+
+def _worker_result(files_json,future):
+    # emit the log records of a sample from a worker and return its output or raise its error
+    output, records, error = future.result()
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+    if error is not None:
+        raise ValueError('sample "'+str(files_json['sample_name'])+'" failed\n'+error)
+    return output
+
+class _RecordBuffer(logging.Handler):
+    # keep log records in a list in a form that can be sent back from a worker process
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+_worker = {}
+def _init_worker(function,inputs,run_id,verbose,cache_directory):
+    # inputs are sent to each worker once rather than with every sample
+    _worker.update({'function':function,'inputs':inputs,'run_id':run_id,'verbose':verbose,'cache_directory':cache_directory})
+    root = logging.getLogger()
+    for handler in list(root.handlers): root.removeHandler(handler)
+    _worker['buffer'] = _RecordBuffer()
+    root.addHandler(_worker['buffer'])
+    root.setLevel(logging.DEBUG if verbose else logging.WARNING)
+
+def _execute_sample_in_worker(files_json):
+    records = _worker['buffer'].records
+    del records[:]
+    output, error = None, None
+    try:
+        output = _worker['function'](files_json,_worker['inputs'],_worker['run_id'],
+                                     verbose=_worker['verbose'],cache_directory=_worker['cache_directory'])
+    except Exception:
+        error = traceback.format_exc()
+    return output, list(records), error
 
 def execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
+    # pythologist and its readers are heavy so they are only imported once a sample is run
+    from pythologist_reader.formats.inform import read_standard_format_sample_to_project
+
     primary_export = [x['export_name'] for x in inputs['analysis']['inform_exports'] if x['primary_phenotyping']][0]
     mutually_exclusive_phenotypes = [x['phenotype_name'] for x in inputs['analysis']['mutually_exclusive_phenotypes'] if x['export_name']==primary_export]
 
     logger = logging.getLogger(str(files_json['sample_name']))
     logger.info("staging channel abbreviations")
     channel_abbreviations = dict([(x['full_name'],x['marker_name']) for x in inputs['panel']['markers']])
-    logger.info("reading exports to temporary h5")
-    exports = read_standard_format_sample_to_project(files_json['sample_directory'],
-                                                     inputs['analysis']['parameters']['region_annotation_strategy'],
-                                                     channel_abbreviations = channel_abbreviations,
-                                                     sample = files_json['sample_name'],
-                                                     project_name = inputs['project']['parameters']['project_name'],
-                                                     custom_mask_name = inputs['analysis']['parameters']['region_annotation_custom_label'],
-                                                     other_mask_name = inputs['analysis']['parameters']['unannotated_region_label'],
-                                                     microns_per_pixel = inputs['project']['parameters']['microns_per_pixel'],
-                                                     line_pixel_steps = int(round(float(inputs['analysis']['parameters']['expanded_margin_width_um'] / \
-                                                                              inputs['project']['parameters']['microns_per_pixel'])-float(inputs['analysis']['parameters']['draw_margin_width']))),
-                                                     verbose = False
-        )
     logger.info("getting the primary export")
     primary_export_name = [x['export_name'] for x in inputs['analysis']['inform_exports'] if x['primary_phenotyping']]
     if len(primary_export_name) != 1: raise ValueError("didnt find the 1 single expected primary phenotyping in analysis")
     primary_export_name = primary_export_name[0]
 
-    cpi = None
-    cdfs = {}
-    for export_name in exports:
-        logger.info("extract CellDataFrame from h5 objects "+str(export_name))
-        if export_name == primary_export_name:
-            cpi = exports[export_name]
+    # Exports parsed by an earlier run from the same files with the same reading parameters are read back from the cache
+    cached_exports = _read_export_cache(cache_directory,files_json,inputs) if cache_directory else None
+    if cached_exports is not None:
+        export_cdfs, cached_project_h5 = cached_exports
+        cpi = None
+    else:
+        logger.info("reading exports to temporary h5")
+        exports = read_standard_format_sample_to_project(files_json['sample_directory'],
+                                                         inputs['analysis']['parameters']['region_annotation_strategy'],
+                                                         channel_abbreviations = channel_abbreviations,
+                                                         sample = files_json['sample_name'],
+                                                         project_name = inputs['project']['parameters']['project_name'],
+                                                         custom_mask_name = inputs['analysis']['parameters']['region_annotation_custom_label'],
+                                                         other_mask_name = inputs['analysis']['parameters']['unannotated_region_label'],
+                                                         microns_per_pixel = inputs['project']['parameters']['microns_per_pixel'],
+                                                         line_pixel_steps = int(round(float(inputs['analysis']['parameters']['expanded_margin_width_um'] / \
+                                                                                  inputs['project']['parameters']['microns_per_pixel'])-float(inputs['analysis']['parameters']['draw_margin_width']))),
+                                                         verbose = False
+            )
+        logger.info("extract CellDataFrames from h5 objects")
+        export_cdfs = OrderedDict([(x,exports[x].cdf) for x in exports])
+        cpi = exports[primary_export_name]
+        if cache_directory:
+            logger.info("saving the parsed exports to the cache")
+            _write_export_cache(cache_directory,files_json,inputs,export_cdfs,cpi)
 
-        cdfs[export_name] = exports[export_name].cdf
+    cdfs = {}
+    for export_name in export_cdfs:
+        cdfs[export_name] = export_cdfs[export_name]
         cdfs[export_name]['project_id'] = run_id # force them to have the same project_id
         cdfs[export_name]['project_name'] = inputs['project']['parameters']['project_name']
         meps = [x['phenotype_name'] for x in inputs['analysis']['mutually_exclusive_phenotypes'] if x['export_name']==export_name and \
@@ -120,13 +660,10 @@ def execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
     
     cdf = cdfs[primary_export_name]
 
-    for export_name in [x for x in cdfs if x!=primary_export_name]:
-        logger.info("merging in "+str(export_name))
-        _cdf = cdfs[export_name]
-        _cdf['project_id'] = run_id
-        cdf,f = cdf.merge_scores(_cdf,on=['project_name','sample_name','frame_name','x','y','cell_index'])
-        if f.shape[0] > 0:
-            raise ValueError("segmentation mismatch error "+str(f.shape[0]))
+    other_cdfs = OrderedDict([(x,cdfs[x]) for x in cdfs if x!=primary_export_name])
+    for export_name in other_cdfs: other_cdfs[export_name]['project_id'] = run_id
+    logger.info("merging in "+str(list(other_cdfs.keys())))
+    cdf = _merge_export_scores(cdf,other_cdfs)
     logger.info("merging completed")
     # Now cdf contains a CellDataFrame sutiable for data extraction
 
@@ -142,70 +679,175 @@ def execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
 
 
 
-    # For density measurements build our population definitions
-    density_populations = []
-    for population in inputs['report']['population_densities']:
-        _pop = SL(phenotypes = population['mutually_exclusive_phenotypes'], 
-                  scored_calls = dict([(x['target_name'],x['filter_direction']) for x in population['binary_phenotypes']]),
-                  label = population['population_name']
-                 )
-        density_populations.append(_pop)
-
-    percentage_populations = []
-    for population in inputs['report']['population_percentages']:
-        _numerator = SL(phenotypes = population['numerator_mutually_exclusive_phenotypes'], 
-                        scored_calls = dict([(x['target_name'],x['filter_direction']) for x in population['numerator_binary_phenotypes']])
-                       )
-        _denominator = SL(phenotypes = population['denominator_mutually_exclusive_phenotypes'], 
-                          scored_calls = dict([(x['target_name'],x['filter_direction']) for x in population['denominator_binary_phenotypes']])
-                          )
-        _pop = PL(numerator = _numerator,
-                  denominator = _denominator,
-                  label = population['population_name']
-                 )
-        percentage_populations.append(_pop)
-
-    # Now calculate outputs for each region we are working with
-    fcnts = []
-    scnts = []
-    fpcnts = []
-    spcnts = []
-    for report_region_row in inputs['report']['region_selection']:
-        # Iterate over each region combining them to the name specified
-        report_region_name = report_region_row['report_region_name']
-        regions_to_combine = report_region_row['regions_to_combine']
-        logger.info("extracting data for region '"+str(report_region_name)+"' which is made up of "+str(regions_to_combine))
-        _cdf = cdf.combine_regions(regions_to_combine,report_region_name)
-        # Fetch counts based on qc constraints
-        _cnts = _cdf.counts(minimum_region_size_pixels=inputs['report']['parameters']['minimum_density_region_size_pixels'],
-                           minimum_denominator_count=inputs['report']['parameters']['minimum_denominator_count'])
-        logger.info("frame-level densities")
-        _fcnts = _cnts.frame_counts(subsets=density_populations)
-        _fcnts = _fcnts.loc[_fcnts['region_label']==report_region_name,:]
-        fcnts.append(_fcnts)
-        logger.info("sample-level densities")
-        _scnts = _cnts.sample_counts(subsets=density_populations)
-        _scnts = _scnts.loc[_scnts['region_label']==report_region_name,:]
-        scnts.append(_scnts)
-
-
-        logger.info("frame-level percentages")
-        _fpcnts = _cnts.frame_percentages(percentage_logic_list=percentage_populations)
-        _fpcnts = _fpcnts.loc[_fpcnts['region_label']==report_region_name,:]
-        fpcnts.append(_fpcnts)
-        logger.info("sample-level percentages")
-        _spcnts = _cnts.sample_percentages(percentage_logic_list=percentage_populations)
-        _spcnts = _spcnts.loc[_spcnts['region_label']==report_region_name,:]
-        spcnts.append(_spcnts)
-
-    fcnts = pd.concat(fcnts).reset_index(drop=True)
-    scnts = pd.concat(scnts).reset_index(drop=True)
-    fpcnts = pd.concat(fpcnts).reset_index(drop=True)
-    spcnts = pd.concat(spcnts).reset_index(drop=True)
+    # A list of reports is measured together and gives a list of sample outputs in the same order
+    image_names = [x['image_name'] for x in files_json['exports'][0]['images']]
+    outputs = _report_samples(files_json['sample_name'],cdf,_reports(inputs),image_names,mutually_exclusive_phenotypes,
+                              inputs['project']['parameters']['microns_per_pixel'])
+
+    intermediate_files = {}
+    intermediate_files['project_h5'] = None
+    intermediate_files['celldataframe_h5'] = None
+
+    if cache_directory:
+        ntf1 = NamedTemporaryFile(dir=cache_directory,delete=False,prefix='PROJ-',suffix='.h5')
+        logger.info("saving project to "+str(ntf1.name))
+        if cpi is None: shutil.copyfile(cached_project_h5,ntf1.name)
+        else: cpi.to_hdf(ntf1.name,overwrite=True)
+        intermediate_files['project_h5'] = ntf1.name
+        ntf2 = NamedTemporaryFile(dir=cache_directory,delete=False,prefix='CDF-',suffix='.h5')
+        logger.info("saving celldataframe to "+str(ntf2.name))
+        cdf.to_hdf(ntf2.name,'data')
+        intermediate_files['celldataframe_h5'] = ntf2.name
+
+    for output in outputs: output['intermediate_files'] = dict(intermediate_files)
+    return outputs if isinstance(inputs['report'],list) else outputs[0]
+
+def _merge_export_scores(cdf,other_cdfs):
+    """
+    Merge the binary phenotype calls of the other exports of a sample into the primary export
+
+    This gives the CellDataFrame that merging each export in turn with
+    merge_scores(on=['project_name','sample_name','frame_name','x','y','cell_index']) gives.
+    Each cell of the primary export gets one integer key from its frame and
+    cell_index, each export is matched to those keys with one lookup and its
+    x and y checked, and then the calls of every export are combined in a
+    single pass over the cells.  When an export repeats a key or a cell is
+    missing a call the exports are merged with merge_scores.
+
+    Args:
+        cdf (CellDataFrame): the primary export
+        other_cdfs (OrderedDict): the CellDataFrame of each other export in the order they are merged
+    Returns:
+        cdf (CellDataFrame): the primary export with the calls of the other exports
+    """
+    import numpy as np
+    import pandas as pd
+    from pythologist_schemas.measurements import _scored_values
+    if len(other_cdfs) == 0: return cdf
+    frame_columns = ['project_name','sample_name','frame_name']
+    frames = pd.MultiIndex.from_frame(cdf[frame_columns].drop_duplicates())
+    frame_codes = cdf.groupby(frame_columns,sort=False,dropna=False).ngroup().to_numpy()
+    cell_indexes = cdf['cell_index'].to_numpy().astype(np.int64)
+    steps = int(max([cell_indexes.max() if len(cell_indexes) > 0 else 0]+\
+                    [x['cell_index'].max() for x in other_cdfs.values() if x.shape[0] > 0]))+1
+    keys = frame_codes*steps+cell_indexes
+
+    positions = []
+    for export_name, other in other_cdfs.items():
+        # the frames of the export numbered as in the primary export, -1 for a frame it does not have
+        other_frames = frames.get_indexer(pd.MultiIndex.from_frame(other[frame_columns].drop_duplicates()))
+        other_frame_codes = other_frames[other.groupby(frame_columns,sort=False,dropna=False).ngroup().to_numpy()]
+        present = np.flatnonzero(other_frame_codes >= 0)
+        other_keys = pd.Index(other_frame_codes[present]*steps+other['cell_index'].to_numpy().astype(np.int64)[present])
+        if not other_keys.is_unique: return _merge_scores_in_turn(cdf,other_cdfs)
+        found = other_keys.get_indexer(keys)
+        position = np.full(len(keys),-1,dtype=np.int64)
+        position[found >= 0] = present[found[found >= 0]]
+        positions.append(position)
+
+    # a cell is matched when its key is found and its x and y are the same
+    for position, other in zip(positions,other_cdfs.values()):
+        matched = position >= 0
+        for column in ['x','y']:
+            matched[matched] = cdf[column].to_numpy()[matched] == other[column].to_numpy()[position[matched]]
+        if (~matched).sum() > 0:
+            raise ValueError("segmentation mismatch error "+str((~matched).sum()))
+
+    # merge_scores keeps the calls of the cells so far in name order followed by the new names of the export in name order
+    names, values = _scored_values(cdf['scored_calls'].tolist())
+    if (values < 0).any(): return _merge_scores_in_turn(cdf,other_cdfs)
+    columns = OrderedDict([(x,values[:,i]) for i, x in enumerate(names)])
+    for position, other in zip(positions,other_cdfs.values()):
+        other_names, other_values = _scored_values(other['scored_calls'].tolist())
+        if (other_values < 0).any(): return _merge_scores_in_turn(cdf,other_cdfs)
+        columns = OrderedDict([(x,columns[x]) for x in sorted(columns.keys())])
+        for i, x in enumerate(other_names): columns[x] = other_values[position,i]
+    names = list(columns.keys())
+    cdf = cdf.reset_index(drop=True)
+    cdf['scored_calls'] = [dict(zip(names,x)) for x in np.stack(list(columns.values()),axis=1).tolist()] if len(names) > 0 else \
+                          [{} for x in range(cdf.shape[0])]
+    return cdf
+
+def _merge_scores_in_turn(cdf,other_cdfs):
+    # merge each export with merge_scores
+    for export_name, other in other_cdfs.items():
+        cdf,f = cdf.merge_scores(other,on=['project_name','sample_name','frame_name','x','y','cell_index'])
+        if f.shape[0] > 0:
+            raise ValueError("segmentation mismatch error "+str(f.shape[0]))
+    return cdf
+
+def _reports(inputs):
+    # the run input holds one report or a list of them
+    return inputs['report'] if isinstance(inputs['report'],list) else [inputs['report']]
+
+def recompute_sample(previous_output,inputs,run_id,verbose=False,cache_directory=None):
+    """
+    Measure a new report for a sample from the CellDataFrame an earlier run saved
+
+    Only the densities, percentages and phenotype maps are computed again, the
+    exports are not read or merged, so the earlier run needs to have been run
+    with a cache_directory.
+
+    Args:
+        previous_output (dict): the sample output of the earlier run, the phenotype maps are not needed
+        inputs (dict): the report to measure as inputs['report'], or a list of reports
+    Returns:
+        sample_output (dict): the sample output for the new report with the intermediate files of the earlier run,
+                              or a list of them for a list of reports
+    """
+    logger = logging.getLogger(str(previous_output['sample_name']))
+    celldataframe_h5 = previous_output.get('intermediate_files',{}).get('celldataframe_h5')
+    if celldataframe_h5 is None:
+        raise ValueError("sample "+str(previous_output['sample_name'])+" has no saved CellDataFrame, the earlier run needs a cache_directory")
+    if not os.path.exists(celldataframe_h5):
+        raise ValueError("saved CellDataFrame "+str(celldataframe_h5)+" of sample "+str(previous_output['sample_name'])+" does not exist")
+    if len(previous_output['images']) == 0:
+        raise ValueError("sample "+str(previous_output['sample_name'])+" has no images to report")
+    from pythologist import CellDataFrame
+    logger.info("reading the saved CellDataFrame "+str(celldataframe_h5))
+    cdf = CellDataFrame.read_hdf(celldataframe_h5,'data')
+    # the saved CellDataFrame already has every expected phenotype
+    outputs = _report_samples(previous_output['sample_name'],cdf,_reports(inputs),[x['image_name'] for x in previous_output['images']],
+                              cdf.phenotypes,previous_output['images'][0]['microns_per_pixel'])
+    for output in outputs: output['intermediate_files'] = dict(previous_output['intermediate_files'])
+    return outputs if isinstance(inputs['report'],list) else outputs[0]
+
+def _report_samples(sample_name,cdf,reports,image_names,mutually_exclusive_phenotypes,microns_per_pixel):
+    """
+    Measure the reports of a sample from its merged CellDataFrame
+
+    The cells are counted and the phenotype maps are made once for all of the
+    reports, so a population or base region used by several reports is only
+    counted once and the outputs share the same phenotype maps.
+
+    Args:
+        sample_name (str): the sample the CellDataFrame holds
+        cdf (pythologist.CellDataFrame): the cells of every export merged with all of the expected phenotypes
+        reports (list): reports in the report schema
+        image_names (list): the images of the sample in the order to report them
+        mutually_exclusive_phenotypes (list): the phenotypes of the primary export for the phenotype maps
+        microns_per_pixel (float): size of a pixel
+    Returns:
+        sample_outputs (list): the sample output of each report without its intermediate_files
+    """
+    from pythologist_schemas.measurements import SampleMeasurements
+    # Count every population in every frame and base region once, then measure each report region from those counts
+    measurements = SampleMeasurements(cdf,microns_per_pixel,phenotypes=cdf.phenotypes)
+    image_info = _get_sample_image_info(sample_name,cdf,image_names)
+    phenotype_maps = dict([(x,{'column_names':y[0],'rows':y[1],'mutually_exclusive_phenotypes':mutually_exclusive_phenotypes}) \
+                           for x, y in image_info.items()])
+    return [_report_sample(sample_name,measurements,image_info,phenotype_maps,x,image_names,microns_per_pixel) for x in reports]
+
+def _report_sample(sample_name,measurements,image_info,phenotype_maps,report,image_names,microns_per_pixel):
+    # the sample output of one report from the counts and phenotype maps of the sample
+    logger = logging.getLogger(str(sample_name))
+    logger.info("measuring regions "+str([x['report_region_name'] for x in report['region_selection']])+\
+                " for report "+str(report['parameters']['report_name']))
+    fcnts, scnts, fpcnts, spcnts = measurements.report_tables(report)
 
     #prepare an output json 
     output = {
-        "sample_name":files_json['sample_name'],
+        "sample_name":sample_name,
         "sample_reports":{
             'sample_cumulative_count_densities':[],
             'sample_aggregate_count_densities':[],
@@ -216,207 +858,278 @@ def execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
     }
 
     # Now fill in the data
-    for image_name in [x['image_name'] for x in files_json['exports'][0]['images']]:
-        pmap_cnames,pmap_rows,frame_shape, region_sizes = _get_image_info(image_name,files_json['sample_name'],cdf)
+    image_count_densities = _report_rows(fcnts,'image_count_densities',report['parameters']['minimum_density_region_size_pixels'],
+                                         group_by='frame_name')
+    image_count_percentages = _report_rows(fpcnts,'image_count_percentages',report['parameters']['minimum_denominator_count'],
+                                           group_by='frame_name')
+    for image_name in image_names:
+        frame_shape, region_sizes = image_info[image_name][2:]
         output['images'].append({
             'image_name':image_name,
             'image_size_pixels':frame_shape,
-            "microns_per_pixel":inputs['project']['parameters']['microns_per_pixel'],
+            "microns_per_pixel":microns_per_pixel,
             'image_reports':{
-                'image_count_densities':_organize_frame_count_densities(fcnts.loc[fcnts['frame_name']==image_name],inputs['report']['parameters']['minimum_density_region_size_pixels']),
-                'image_count_percentages':_organize_frame_percentages(fpcnts.loc[fpcnts['frame_name']==image_name],inputs['report']['parameters']['minimum_denominator_count'])
-            },
-            'phenotype_map':{
-                'column_names':pmap_cnames,
-                'rows':pmap_rows,
-                'mutually_exclusive_phenotypes':mutually_exclusive_phenotypes
+                'image_count_densities':image_count_densities.get(image_name,[]),
+                'image_count_percentages':image_count_percentages.get(image_name,[])
             },
+            'phenotype_map':phenotype_maps[image_name],
             'region_sizes':region_sizes
         })
 
     # Do sample level densities
     output['sample_reports']['sample_cumulative_count_densities'] = \
-        _organize_sample_cumulative_count_densities(scnts,inputs['report']['parameters']['minimum_density_region_size_pixels'])
+        _report_rows(scnts,'sample_cumulative_count_densities',report['parameters']['minimum_density_region_size_pixels'])
     output['sample_reports']['sample_aggregate_count_densities'] = \
-        _organize_sample_aggregate_count_densities(scnts,inputs['report']['parameters']['minimum_density_region_size_pixels'])
+        _report_rows(scnts,'sample_aggregate_count_densities')
 
     # Now do percentages
     output['sample_reports']['sample_cumulative_count_percentages'] = \
-        _organize_sample_cumulative_percentages(spcnts,inputs['report']['parameters']['minimum_density_region_size_pixels'])
+        _report_rows(spcnts,'sample_cumulative_count_percentages',report['parameters']['minimum_density_region_size_pixels'])
     output['sample_reports']['sample_aggregate_count_percentages'] = \
-        _organize_sample_aggregate_percentages(spcnts,inputs['report']['parameters']['minimum_density_region_size_pixels'])
+        _report_rows(spcnts,'sample_aggregate_count_percentages')
 
-    output['intermediate_files'] = {}
-    output['intermediate_files']['project_h5'] = None
-    output['intermediate_files']['celldataframe_h5'] = None
+    return output
 
-    if cache_directory:
-        ntf1 = NamedTemporaryFile(dir=cache_directory,delete=False,prefix='PROJ-',suffix='.h5')
-        logger.info("saving project to "+str(ntf1.name))
-        cpi.to_hdf(ntf1.name,overwrite=True)
-        output['intermediate_files']['project_h5'] = ntf1.name
-        ntf2 = NamedTemporaryFile(dir=cache_directory,delete=False,prefix='CDF-',suffix='.h5')
-        logger.info("saving celldataframe to "+str(ntf2.name))
-        cdf.to_hdf(ntf2.name,'data')
-        output['intermediate_files']['celldataframe_h5'] = ntf2.name
+SIDECAR_SAMPLE_TABLES = ['sample_cumulative_count_densities','sample_aggregate_count_densities',
+                         'sample_cumulative_count_percentages','sample_aggregate_count_percentages']
+SIDECAR_IMAGE_TABLES = ['image_count_densities','image_count_percentages']
 
-    return output
+def _write_parquet_sidecar(sample_output,sidecar_directory,output_directory,tables=False):
+    """
+    Move the phenotype maps of a sample, and optionally its report tables, to Parquet files
 
-def _get_image_info(image_name,sample_name,cdf):
-    subset = cdf.loc[(cdf['sample_name']==sample_name)&(cdf['frame_name']==image_name)].copy()
-    rows = []
-    for k,v in subset.loc[:,['cell_index','x','y','region_label','phenotype_label','scored_calls']].\
-        set_index(['cell_index','x','y','region_label','phenotype_label'])['scored_calls'].to_dict().items():
-        rows.append(list(k)+[[(k0,v0) for k0,v0 in v.items()]])
-    return ['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'], \
-           rows, \
-           dict(zip(('y','x'),subset.iloc[0]['frame_shape'])), \
-           [x for x in subset.get_measured_regions()[['region_label','region_area_pixels']].\
-              rename(columns={'region_label':'region_name'}).T.to_dict().values()]
-
-
-def _organize_frame_percentages(frame_percentages,min_denominator_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'numerator':'numerator_count',
-        'denominator':'denominator_count',
-        'fraction':'fraction',
-        'percent':'percent'
-    })
-    keeper_columns = list(conv.values())
-    frame_report = frame_percentages.rename(columns=conv).loc[:,keeper_columns]
-    frame_report['measure_qc_pass'] = True
-    frame_report.loc[frame_report['denominator_count'] < min_denominator_count,'measure_qc_pass'] = False
-
-    frame_report = frame_report.where(pd.notnull(frame_report), None)
-    return [row.to_dict() for index,row in frame_report.iterrows()]
-
-def _organize_frame_count_densities(frame_count_densities,min_pixel_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'region_area_pixels':'region_area_pixels',
-        'region_area_mm2':'region_area_mm2',
-        'count':'count',
-        'density_mm2':'density_mm2'
-    })
-    keeper_columns = list(conv.values())
-    #print(keeper_columns)
-    #print(frame_count_densities.rename(columns=conv).columns)
-    frame_report = frame_count_densities.rename(columns=conv).loc[:,keeper_columns]
-    frame_report['measure_qc_pass'] = True
-    frame_report.loc[frame_report['region_area_pixels'] < min_pixel_count,'measure_qc_pass'] = False
-
-    frame_report = frame_report.where(pd.notnull(frame_report), None)
-    return [row.to_dict() for index,row in frame_report.iterrows()]
-def _organize_sample_cumulative_count_densities(sample_count_densities,min_pixel_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'frame_count':'image_count',
-        'cumulative_region_area_pixels':'cumulative_region_area_pixels',
-        'cumulative_region_area_mm2':'cumulative_region_area_mm2',
-        'cumulative_count':'cumulative_count',
-        'cumulative_density_mm2':'cumulative_density_mm2'
-    })
-    keeper_columns = list(conv.values())
-
-    sample_report = sample_count_densities.rename(columns=conv).loc[:,keeper_columns]
-    sample_report['measure_qc_pass'] = True
-    sample_report.loc[sample_report['cumulative_region_area_pixels'] < min_pixel_count,'measure_qc_pass'] = False
-    
-    sample_report = sample_report.where(pd.notnull(sample_report), None)
-    return [row.to_dict() for index,row in sample_report.iterrows()]
-
-def _organize_sample_aggregate_count_densities(sample_count_densities,min_pixel_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'frame_count':'image_count',
-        'measured_frame_count':'aggregate_measured_image_count',
-        'mean_density_mm2':'aggregate_mean_density_mm2',
-        'stddev_density_mm2':'aggregate_stddev_density_mm2',
-        'stderr_density_mm2':'aggregate_stderr_density_mm2'
-    })
-    keeper_columns = list(conv.values())
-
-    sample_report = sample_count_densities.rename(columns=conv).loc[:,keeper_columns]
-    sample_report['measure_qc_pass'] = True
-    sample_report.loc[sample_report['aggregate_measured_image_count'] < 1,'measure_qc_pass'] = False
-    
-    sample_report = sample_report.where(pd.notnull(sample_report), None)
-    return [row.to_dict() for index,row in sample_report.iterrows()]
-
-
-def _organize_sample_cumulative_percentages(sample_count_densities,min_denominator_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'frame_count':'image_count',
-        'cumulative_numerator':'cumulative_numerator_count',
-        'cumulative_denominator':'cumulative_denominator_count',
-        'cumulative_fraction':'cumulative_fraction',
-        'cumulative_percent':'cumulative_percent'
-    })
-    keeper_columns = list(conv.values())
-
-    sample_report = sample_count_densities.rename(columns=conv).loc[:,keeper_columns]
-    sample_report['measure_qc_pass'] = True
-    sample_report.loc[sample_report['cumulative_denominator_count'] < min_denominator_count,'measure_qc_pass'] = False
-    
-    sample_report = sample_report.where(pd.notnull(sample_report), None)
-    return [row.to_dict() for index,row in sample_report.iterrows()]
-
-def _organize_sample_aggregate_percentages(sample_count_densities,min_denominator_count):
-    # Make the list of sample count density features in dictionary format
-
-    # make an object to convert pythologist internal count reports to the expected column names
-    conv = OrderedDict({
-        'region_label':'region_name',
-        'phenotype_label':'population_name',
-        'frame_count':'image_count',
-        'measured_frame_count':'aggregate_measured_image_count',
-        'mean_fraction':'aggregate_mean_fraction',
-        'stdev_fraction':'aggregate_stddev_fraction',
-        'stderr_fraction':'aggregate_stderr_fraction',
-        'mean_percent':'aggregate_mean_percent',
-        'stdev_percent':'aggregate_stddev_percent',
-        'stderr_percent':'aggregate_stderr_percent'
-    })
-    keeper_columns = list(conv.values())
-
-    sample_report = sample_count_densities.rename(columns=conv).loc[:,keeper_columns]
-    sample_report['measure_qc_pass'] = True
-    sample_report.loc[sample_report['aggregate_measured_image_count'] < 1,'measure_qc_pass'] = False
-    
-    sample_report = sample_report.where(pd.notnull(sample_report), None)
-    return [row.to_dict() for index,row in sample_report.iterrows()]
+    The phenotype maps of every image go in one file with one row group per
+    image.  Each file is referenced from the sample output by its path relative
+    to output_directory and its sha256, and a report table that is moved is left
+    empty in the json.
+
+    Args:
+        sample_output (dict): a sample output, changed in place
+        sidecar_directory (str): folder to write the Parquet files to
+        output_directory (str): folder of the run output json
+        tables (bool): also move the sample and image report tables
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pythologist_schemas.hashing import sha256_file
+    from pythologist_schemas.cli.report_tool import read_phenotype_map
+    sample_name = sample_output['sample_name']
+    sidecar_files = OrderedDict()
+    def _write(table_name,df):
+        file_path = os.path.join(sidecar_directory,sample_name+'.'+table_name+'.parquet')
+        pq.write_table(pa.Table.from_pandas(df,preserve_index=False),file_path)
+        sidecar_files[table_name] = {'file_path':os.path.relpath(file_path,output_directory),'sha256_hash':sha256_file(file_path)}
+
+    cells = []
+    binary_phenotype_names = []
+    for image in sample_output['images']:
+        _cells = read_phenotype_map(image['phenotype_map'])
+        binary_phenotype_names.append((list(_cells.columns[5:]),len(_cells)))
+        _cells.insert(0,'image_name',image['image_name'])
+        cells.append(_cells)
+    cells = pd.concat(cells,ignore_index=True) if len(cells) > 0 else \
+            pd.DataFrame(columns=['image_name','cell_index','x','y','region_name','mutually_exclusive_phenotype'])
+    # a marker missing from some images leaves gaps so keep the binary phenotypes as nullable integers
+    for column in cells.columns[6:]: cells[column] = cells[column].astype('Int8')
+    table = pa.Table.from_pandas(cells,preserve_index=False)
+    file_path = os.path.join(sidecar_directory,sample_name+'.phenotype_map.parquet')
+    with pq.ParquetWriter(file_path,table.schema) as writer:
+        start = 0
+        for names, cell_count in binary_phenotype_names:
+            writer.write_table(table.slice(start,cell_count))
+            start += cell_count
+    sidecar_files['phenotype_map'] = {'file_path':os.path.relpath(file_path,output_directory),'sha256_hash':sha256_file(file_path)}
+    for image, (names, cell_count) in zip(sample_output['images'],binary_phenotype_names):
+        image['phenotype_map'] = OrderedDict([('encoding','parquet'),
+                                              ('file_path',sidecar_files['phenotype_map']['file_path']),
+                                              ('sha256_hash',sidecar_files['phenotype_map']['sha256_hash']),
+                                              ('image_name',image['image_name']),
+                                              ('binary_phenotype_names',names),
+                                              ('mutually_exclusive_phenotypes',image['phenotype_map']['mutually_exclusive_phenotypes'])])
+
+    if tables:
+        for table_name in SIDECAR_SAMPLE_TABLES:
+            _write(table_name,pd.DataFrame(sample_output['sample_reports'][table_name]))
+            sample_output['sample_reports'][table_name] = []
+        for table_name in SIDECAR_IMAGE_TABLES:
+            _write(table_name,pd.DataFrame([OrderedDict([('image_name',image['image_name'])]+list(row.items())) \
+                                            for image in sample_output['images'] for row in image['image_reports'][table_name]]))
+            for image in sample_output['images']: image['image_reports'][table_name] = []
+    sample_output['sidecar_files'] = sidecar_files
+    return sample_output
+
+def _get_sample_image_info(sample_name,cdf,image_names):
+    """
+    Build the phenotype map, frame shape and region sizes of every image in a sample at once
+
+    The cells of the sample are ordered by frame in one stable sort, each
+    column is converted to python values once, and every image takes its slice,
+    rather than filtering the whole CellDataFrame again for each image.
+
+    Returns:
+        image_info (dict): keyed by image name the column names, rows, frame shape and region sizes
+    """
+    import numpy as np
+    import pandas as pd
+    subset = cdf.loc[cdf['sample_name']==sample_name]
+    codes, frame_names = pd.factorize(subset['frame_name'],sort=False)
+    order = np.argsort(codes,kind='stable')
+    ends = np.cumsum(np.bincount(codes,minlength=len(frame_names)))
+    starts = ends - np.bincount(codes,minlength=len(frame_names))
+    columns = [subset[x].to_numpy()[order].tolist() for x in ['cell_index','x','y','region_label','phenotype_label']]
+    scored_calls = [[(k0,v0) for k0,v0 in v.items()] for v in subset['scored_calls'].to_numpy()[order]]
+    rows = [list(x) for x in zip(*columns,scored_calls)]
+    frame_shapes = subset['frame_shape'].to_numpy()[order]
+    region_sizes = dict([(x,[]) for x in frame_names])
+    for frame_name, region_name, region_area_pixels in subset.get_measured_regions()[['frame_name','region_label','region_area_pixels']].\
+                                                        itertuples(index=False,name=None):
+        region_sizes[frame_name].append({'region_name':region_name,'region_area_pixels':region_area_pixels})
+    image_names = set(image_names)
+    image_info = {}
+    for i, frame_name in enumerate(frame_names):
+        if frame_name not in image_names: continue
+        image_info[frame_name] = (['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'],
+                                  rows[starts[i]:ends[i]],
+                                  dict(zip(('y','x'),frame_shapes[starts[i]])),
+                                  region_sizes[frame_name])
+    return image_info
+
+# How each report table is made from a pythologist count or percentage frame.
+# columns maps the pythologist column names to the report column names, in
+# report order.  measure_qc_pass is False where the qc column is below a
+# minimum, the minimum passed in when the rule's minimum is None.
+REPORT_CONVERSIONS = {
+    'image_count_densities':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('region_area_pixels','region_area_pixels'),
+            ('region_area_mm2','region_area_mm2'),
+            ('count','count'),
+            ('density_mm2','density_mm2')
+        ]),
+        'qc':('region_area_pixels',None)
+    },
+    'image_count_percentages':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('numerator','numerator_count'),
+            ('denominator','denominator_count'),
+            ('fraction','fraction'),
+            ('percent','percent')
+        ]),
+        'qc':('denominator',None)
+    },
+    'sample_cumulative_count_densities':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('frame_count','image_count'),
+            ('cumulative_region_area_pixels','cumulative_region_area_pixels'),
+            ('cumulative_region_area_mm2','cumulative_region_area_mm2'),
+            ('cumulative_count','cumulative_count'),
+            ('cumulative_density_mm2','cumulative_density_mm2')
+        ]),
+        'qc':('cumulative_region_area_pixels',None)
+    },
+    'sample_aggregate_count_densities':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('frame_count','image_count'),
+            ('measured_frame_count','aggregate_measured_image_count'),
+            ('mean_density_mm2','aggregate_mean_density_mm2'),
+            ('stddev_density_mm2','aggregate_stddev_density_mm2'),
+            ('stderr_density_mm2','aggregate_stderr_density_mm2')
+        ]),
+        'qc':('measured_frame_count',1)
+    },
+    'sample_cumulative_count_percentages':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('frame_count','image_count'),
+            ('cumulative_numerator','cumulative_numerator_count'),
+            ('cumulative_denominator','cumulative_denominator_count'),
+            ('cumulative_fraction','cumulative_fraction'),
+            ('cumulative_percent','cumulative_percent')
+        ]),
+        'qc':('cumulative_denominator',None)
+    },
+    'sample_aggregate_count_percentages':{
+        'columns':OrderedDict([
+            ('region_label','region_name'),
+            ('phenotype_label','population_name'),
+            ('frame_count','image_count'),
+            ('measured_frame_count','aggregate_measured_image_count'),
+            ('mean_fraction','aggregate_mean_fraction'),
+            ('stdev_fraction','aggregate_stddev_fraction'),
+            ('stderr_fraction','aggregate_stderr_fraction'),
+            ('mean_percent','aggregate_mean_percent'),
+            ('stdev_percent','aggregate_stddev_percent'),
+            ('stderr_percent','aggregate_stderr_percent')
+        ]),
+        'qc':('measured_frame_count',1)
+    }
+}
+
+def _report_rows(frame,table_name,minimum=None,group_by=None):
+    """
+    Convert a pythologist count or percentage frame to the rows of a report table
+
+    Each column is converted to python values in one step with missing values
+    as None, and the rows are zipped together from the columns.
+
+    Args:
+        frame (pandas.DataFrame): the pythologist frame
+        table_name (str): a report table in REPORT_CONVERSIONS
+        minimum (float): the qc minimum for the tables whose rule takes one
+        group_by (str): a column of frame to split the rows by
+    Returns:
+        rows (list): the report rows as dicts in the order of frame,
+                     or an OrderedDict of those lists keyed by the group_by values if group_by is set
+    """
+    conversion = REPORT_CONVERSIONS[table_name]
+    qc_column, qc_minimum = conversion['qc']
+    if qc_minimum is None: qc_minimum = minimum
+    names = list(conversion['columns'].values())+['measure_qc_pass']
+    columns = [_column_values(frame[x]) for x in conversion['columns']]
+    # a missing qc measure isn't below the minimum so it passes
+    columns.append((~(frame[qc_column] < qc_minimum)).tolist())
+    rows = [dict(zip(names,row)) for row in zip(*columns)]
+    if group_by is None: return rows
+    groups = OrderedDict()
+    for key, row in zip(frame[group_by].tolist(),rows):
+        groups.setdefault(key,[]).append(row)
+    return groups
 
+def _column_values(series):
+    # python values of a column with NaN and other missing values as None
+    values = series.tolist()
+    if not series.hasnans: return values
+    return [None if missing else value for value, missing in zip(values,series.isna().tolist())]
 
 def do_inputs():
     parser = argparse.ArgumentParser(
             description = "Run the pipeline",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--input_json',required=True,help="The json file defining the run")
-    parser.add_argument('--output_json',help="The output of the pipeline")
+    parser.add_argument('--input_json',help="The json file defining the run, required unless recompute_from is set")
+    parser.add_argument('--output_json',help="The output of the pipeline.  When the run has a list of reports each is written beside it as <name>.<report name>.json")
     parser.add_argument('--verbose',action='store_true',help="Show more about the run")
-    parser.add_argument('--cache_directory',help="If set intermediate files will be stored in a directory")
+    parser.add_argument('--cache_directory',help="If set intermediate files, the parsed exports and the output of each sample will be stored in a directory. Exports parsed from the same files with the same reading parameters are reused")
+    parser.add_argument('--workers',type=int,default=1,help="Number of samples to run at once in separate processes")
+    parser.add_argument('--phenotype_map_encoding',choices=['rows','columnar'],default='rows',
+                        help="Write each phenotype map as one row per cell, or as columns with coded names and binary phenotype bitmasks")
+    parser.add_argument('--parquet_sidecar',choices=['phenotype_map','all'],
+                        help="Write the phenotype maps of each sample, or with all the report tables too, to Parquet files beside the output_json")
+    parser.add_argument('--resume',action='store_true',help="Reuse the sample outputs saved in the cache_directory by an earlier run with the same inputs")
+    parser.add_argument('--recompute_from',help="Measure the report_json for the samples of this earlier run output from the CellDataFrames it saved in its cache_directory, without reading the exports again")
+    parser.add_argument('--report_json',help="The report to measure with recompute_from, or a list of reports")
+    parser.add_argument('--compression',choices=COMPRESSIONS,
+                        help="Compress the output_json, if not set it is compressed when its name ends in .gz, .xz or .zst.  The input_json is read compressed or not.")
+    parser.add_argument('--compression_level',type=int,help="Compression level of the output_json, if not set use the default of the compression")
     args = parser.parse_args()
     return args
 
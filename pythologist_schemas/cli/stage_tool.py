@@ -5,12 +5,10 @@ The CLI tool for validating the setup of templates, and the staging of files.
 import argparse, os, json, sys, hashlib
 from importlib_resources import files
 from pythologist_schemas.template import excel_to_json
-from pythologist_schemas.platforms.InForm.files import injest_project, injest_sample
+from pythologist_schemas.platforms.InForm.files import injest_project, injest_sample, restage_project
 from pythologist_schemas.report import convert_report_definition_to_report
-from pythologist_reader.formats.inform.custom import CellFrameInFormLineArea, CellFrameInFormCustomMask
-from pythologist_reader.formats.inform.frame import CellFrameInForm
-from pythologist_image_utilities import hash_tiff_contents
-import pandas as pd
+from pythologist_schemas.hashing import FileHasher, FileHashCache, DEFAULT_BUFFER_SIZE
+from pythologist_schemas.compression import open_json, COMPRESSIONS
 import logging
 
 sys.setrecursionlimit(15000)
@@ -25,6 +23,10 @@ def main(args):
     #make sure we can do the outputs if they are set
     if args.output_json and not args.report_excel:
         raise ValueError("cannot output a run setup without a report_excel")
+    if args.output_changes and not args.previous_json:
+        raise ValueError("cannot output changes without a previous_json")
+    if args.previous_json and args.sample_name:
+        raise ValueError("previous_json restages the whole project and can not be used with sample_name")
 
     total_success = True
 
@@ -95,18 +97,47 @@ def main(args):
 
     # 2. No we can ensure the files are properly structured
 
+    hasher = FileHasher(buffer_size=args.hash_buffer_size,use_mmap=args.hash_mmap,workers=args.hash_workers)
+    hash_cache = None
+    changes = None
+    if args.hash_cache:
+        logger.info("using file hash cache "+str(args.hash_cache))
+        hash_cache = FileHashCache(args.hash_cache,hasher=hasher)
     if args.sample_name: 
         logger.info("checking the structure of specific sample "+str(args.sample_name))
-        sample_file, injestion_success, injest_errors = injest_sample(args.sample_name,project_json,analysis_json,project_path)   
+        sample_file, injestion_success, injest_errors = injest_sample(args.sample_name,project_json,analysis_json,project_path,
+                                                                     hasher=hasher if hash_cache is None else hash_cache)
         sample_files = [sample_file]
+    elif args.previous_json:
+        logger.info("checking the samples that changed since "+str(args.previous_json))
+        with open_json(args.previous_json,'rt') as inf:
+            previous_json = json.loads(inf.read())
+        sample_files, injestion_success, injest_errors, changes = restage_project(previous_json,project_json,analysis_json,project_path,
+                                                                                 workers=args.workers,
+                                                                                 pool_type=args.pool_type,
+                                                                                 hasher=hasher if hash_cache is None else hash_cache)
+        if args.output_changes:
+            with open_json(args.output_changes,'wt',args.compression,args.compression_level) as of:
+                of.write(json.dumps(changes,indent=2))
     else:
         logger.info("checking entire project")
-        sample_files, injestion_success, injest_errors = injest_project(project_json,analysis_json,project_path)
+        sample_files, injestion_success, injest_errors = injest_project(project_json,analysis_json,project_path,
+                                                                       workers=args.workers,
+                                                                       pool_type=args.pool_type,
+                                                                       hasher=hasher if hash_cache is None else hash_cache)
+    if hash_cache is not None:
+        logger.info("file hash cache "+str(hash_cache.stats()))
+        hash_cache.close()
+    logger.info("file hashing "+str(hasher.stats()))
+    hasher.close()
     total_success = total_success and injestion_success
 
     # 3. Now we can run pythologist to get a light read on each sample.
 
+    # samples carried over from a previous staging were already read then
+    unchanged = set() if changes is None else set([x['sample_name'] for x in changes if x['status']=='unchanged'])
     for sample_file in sample_files:
+        if sample_file['sample_name'] in unchanged: continue
         logger.info("checking sample "+str(sample_file['sample_name']))
         _lightly_validate_sample(sample_file,analysis_json,project_json,panel_json,project_path)
 
@@ -124,7 +155,7 @@ def main(args):
         'sample_files':sample_files
     }
     if args.output_json:
-        with open(args.output_json,'wt') as of:
+        with open_json(args.output_json,'wt',args.compression,args.compression_level) as of:
             of.write(json.dumps(output,indent=2))
     #print(json.dumps(output,indent=2))
     return 
@@ -206,6 +237,11 @@ def _lightly_validate_export(sample_name,export,analysis_json,project_json,panel
    return to_compare
 
 def _lightly_validate_image_frame(image_frame,export_name,analysis_json,panel_json):
+   # the readers are heavy so only import them once an image actually needs reading
+   from pythologist_reader.formats.inform.custom import CellFrameInFormLineArea, CellFrameInFormCustomMask
+   from pythologist_reader.formats.inform.frame import CellFrameInForm
+   from pythologist_image_utilities import hash_tiff_contents
+   import pandas as pd
 
    logger = logging.getLogger("deep image "+str(export_name)+"|"+str(image_frame['image_name']))
    # Get the conversions for the channel names
@@ -364,6 +400,16 @@ def do_inputs():
    parser.add_argument('--output_log',help="Save the validation log")
    parser.add_argument('--output_json',help="Save the json that defines the run")
    parser.add_argument('--temp',help="Specify a temporary directory")
+   parser.add_argument('--previous_json',help="The output_json of an earlier staging of this project, only samples whose files changed are checked again")
+   parser.add_argument('--output_changes',help="Save the samples and images added, removed and modified since the previous_json")
+   parser.add_argument('--workers',type=int,default=1,help="Number of samples to injest at once")
+   parser.add_argument('--pool_type',choices=['thread','process','asyncio'],default='thread',help="Kind of pool used to injest samples when workers is more than 1, asyncio overlaps the filesystem calls of every sample with workers as the number of calls at once")
+   parser.add_argument('--hash_cache',help="A SQLite file that keeps sha256 digests of unchanged files between runs")
+   parser.add_argument('--hash_workers',type=int,default=4,help="Number of files to hash at once")
+   parser.add_argument('--hash_buffer_size',type=int,default=DEFAULT_BUFFER_SIZE,help="Bytes to read at a time when hashing")
+   parser.add_argument('--hash_mmap',action='store_true',help="Hash files through mmap rather than buffered reads")
+   parser.add_argument('--compression',choices=COMPRESSIONS,help="Compress the output_json and output_changes, if not set each is compressed when its name ends in .gz, .xz or .zst.  The previous_json is read compressed or not.")
+   parser.add_argument('--compression_level',type=int,help="Compression level of the json outputs, if not set use the default of the compression")
    parser.add_argument('--verbose',action='store_true',help="Report info and debug")
    args = parser.parse_args()
    return args
@@ -9,18 +9,21 @@ import re, sys
 from datetime import datetime
 import argparse, gzip
 import json
-from openpyxl.styles import NamedStyle, Font, Border, Side, PatternFill
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
+from functools import lru_cache
 from importlib_resources import files
 from pythologist_schemas import get_validator
 
-highlight = NamedStyle(name="highlight")
-highlight.font = Font(bold=True)
-highlight.fill = PatternFill(start_color="CDEAC2", end_color="CDEAC2", fill_type = "solid")
+@lru_cache(maxsize=None)
+def _named_styles():
+   "Build the highlight and boldened styles, openpyxl is only imported once a workbook is written"
+   from openpyxl.styles import NamedStyle, Font, PatternFill
+   highlight = NamedStyle(name="highlight")
+   highlight.font = Font(bold=True)
+   highlight.fill = PatternFill(start_color="CDEAC2", end_color="CDEAC2", fill_type = "solid")
 
-boldened = NamedStyle(name="boldened")
-boldened.font = Font(bold=True)
+   boldened = NamedStyle(name="boldened")
+   boldened.font = Font(bold=True)
+   return highlight, boldened
 
 def cli():
    args = do_inputs()
@@ -44,6 +47,7 @@ def main(args):
 def _write_parameters(worksheet,fields):
    "Write the metadata fields to the worksheet"
    "fields can be either a single object of metadata, or multiple in list or tuple to stack"
+   highlight, boldened = _named_styles()
    header_names = ['Parameter','Value']
    for _j,_header_name in enumerate(header_names):
       worksheet.cell(row=1,column=_j+1).style = highlight
@@ -74,6 +78,7 @@ def _write_parameters(worksheet,fields):
 
 def _write_repeating(worksheet,fields):
    "Write the repeating data fields to the worksheet"
+   highlight, boldened = _named_styles()
    header_names = list(fields['items']['properties'])
    #print(header_names)
    for _j,_header_name in enumerate(header_names):
@@ -83,6 +88,7 @@ def _write_repeating(worksheet,fields):
       worksheet.cell(row=1,column=_j+1).value = _header_name if 'title' not in entry else entry['title']
 
 def _fix_width(worksheet,min_width=20,padding=3):
+   from openpyxl.utils import get_column_letter
    column_widths = []
    for row in worksheet:
       for i, cell in enumerate(row):
@@ -99,9 +105,10 @@ def _fix_width(worksheet,min_width=20,padding=3):
 def do_report_output(output_path):
    _validator = get_validator(files('schema_data.inputs').joinpath('report_definition.json'))
    _schema = _validator.schema
+   from openpyxl import Workbook
    wb = Workbook()
    default_names = wb.sheetnames
-   wb.add_named_style(highlight)
+   wb.add_named_style(_named_styles()[0])
 
 
    # Start with the Metadata. Write the header and the value names
@@ -134,9 +141,10 @@ def do_analysis_output(output_file):
    #_schema1 = json.loads(files('schema_data.inputs').joinpath('panel.json').read_text())
    #_schema2 = json.loads(files('schema_data.inputs.platforms.InForm').joinpath('analysis.json').read_text())
 
+   from openpyxl import Workbook
    wb = Workbook()
    default_names = wb.sheetnames
-   wb.add_named_style(highlight)
+   wb.add_named_style(_named_styles()[0])
 
 
    # Start with the Metadata. Write the header and the value names
@@ -177,9 +185,10 @@ def do_project_folder_output(output_file):
    _validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('project.json'))
    _schema = _validator.schema
 
+   from openpyxl import Workbook
    wb = Workbook()
    default_names = wb.sheetnames
-   wb.add_named_style(highlight)
+   wb.add_named_style(_named_styles()[0])
 
    # Start with the Metadata. Write the header and the value names
 
@@ -205,9 +214,10 @@ def do_panel_output(args):
    _validator = get_validator(files('schema_data.inputs').joinpath('panel.json'))
    _schema = _validator.schema
 
+   from openpyxl import Workbook
    wb = Workbook()
    default_names = wb.sheetnames
-   wb.add_named_style(highlight)
+   wb.add_named_style(_named_styles()[0])
 
    _oname = args.panel_output
 
@@ -0,0 +1,416 @@
+"""
+Compile json-schema documents into specialized python validation functions.
+
+The generic Draft7Validator walks the schema one keyword at a time for every
+element of an instance.  Here each (sub)schema is translated once into python
+source where type checks, required keys and property lookups are written out
+inline.  The generated source is cached on disk keyed by the schema content and
+the source of this compiler so later processes only have to compile the source
+text.  Each cached file starts with a hash of the code it holds and is only
+used when that hash matches.
+
+The generated code only answers valid or not valid.  When an instance fails,
+the reference Draft7Validator is consulted to raise the same ValidationError
+jsonschema would have raised.
+"""
+import os, re, json, hashlib, logging, numbers, tempfile
+from fractions import Fraction
+from urllib.parse import unquote
+
+# Bump when the generated code changes so stale cache files are not reused
+GENERATOR_VERSION = 1
+
+_TYPE_CHECKS = {
+    'string':'isinstance({0}, str)',
+    'integer':'((isinstance({0}, int) and not isinstance({0}, bool)) or (isinstance({0}, float) and {0}.is_integer()))',
+    'number':'(isinstance({0}, Number) and not isinstance({0}, bool))',
+    'boolean':'isinstance({0}, bool)',
+    'null':'{0} is None',
+    'object':'isinstance({0}, dict)',
+    'array':'isinstance({0}, list)'
+}
+
+# Keywords that draft 7 validates, anything else in a schema is ignored
+_KEYWORDS = set(['type','enum','const','properties','patternProperties','additionalProperties','required',
+                 'minProperties','maxProperties','propertyNames','dependencies',
+                 'items','additionalItems','minItems','maxItems','uniqueItems','contains',
+                 'minLength','maxLength','pattern',
+                 'minimum','maximum','exclusiveMinimum','exclusiveMaximum','multipleOf',
+                 'allOf','anyOf','oneOf','not','if','then','else','$ref'])
+
+def _equal(one, two):
+    # json-schema equality where booleans are never equal to numbers
+    if isinstance(one, bool) or isinstance(two, bool):
+        return isinstance(one, bool) and isinstance(two, bool) and one == two
+    if isinstance(one, str) or isinstance(two, str):
+        return one == two
+    if isinstance(one, dict) and isinstance(two, dict):
+        return len(one) == len(two) and all(k in two and _equal(v, two[k]) for k, v in one.items())
+    if isinstance(one, list) and isinstance(two, list):
+        return len(one) == len(two) and all(_equal(a, b) for a, b in zip(one, two))
+    return one == two
+
+def _in(value, choices):
+    return any(_equal(value, x) for x in choices)
+
+def _unique(items):
+    seen = set()
+    others = []
+    for item in items:
+        if isinstance(item, (dict, list)):
+            if _in(item, others): return False
+            others.append(item)
+            continue
+        # tag the type so True and 1 stay distinct
+        key = (isinstance(item, bool), item)
+        if key in seen: return False
+        seen.add(key)
+    return True
+
+def _multiple_of(value, divisor):
+    if isinstance(divisor, float):
+        quotient = value / divisor
+        try:
+            return int(quotient) == quotient
+        except OverflowError:
+            return (Fraction(value) / Fraction(divisor)).denominator == 1
+    return not value % divisor
+
+_GENERATOR_DIGEST = None
+def _generator_digest():
+    # generated code depends on this module so a cache file is only reused by the same compiler
+    global _GENERATOR_DIGEST
+    if _GENERATOR_DIGEST is None:
+        with open(__file__,'rb') as inf:
+            _GENERATOR_DIGEST = hashlib.sha256(inf.read()).hexdigest()
+    return _GENERATOR_DIGEST
+
+def _source_header(source):
+    return '# sha256 '+hashlib.sha256(source.encode('utf-8')).hexdigest()+'\n'
+
+def _cache_directory():
+    path = os.environ.get('PYTHOLOGIST_SCHEMAS_CACHE_DIR')
+    if path: return path
+    return os.path.join(os.environ.get('XDG_CACHE_HOME',os.path.join(os.path.expanduser('~'),'.cache')),
+                        'pythologist_schemas')
+
+class _SchemaCompiler(object):
+    """Translate a root schema into the source text of a python module."""
+    def __init__(self, root):
+        self.root = root
+        self.lines = []
+        self.constants = []
+        self.functions = {}
+        self.fallbacks = []
+        self.counter = 0
+
+    def source(self):
+        entry = self._function(self.root)
+        header = ['# generated by pythologist_schemas.compiler version '+str(GENERATOR_VERSION)]
+        for name, value in self.constants:
+            header.append(name+' = '+value)
+        return '\n'.join(header+['']+self.lines+['','validate = '+entry,''])
+
+    def _name(self, prefix):
+        self.counter += 1
+        return prefix+str(self.counter)
+
+    def _constant(self, value, wrap=repr):
+        name = self._name('_c')
+        self.constants.append((name, wrap(value)))
+        return name
+
+    def _resolve(self, ref):
+        pointer = unquote(ref[1:])
+        node = self.root
+        for part in [x for x in pointer.split('/')][1:]:
+            part = part.replace('~1','/').replace('~0','~')
+            node = node[int(part)] if isinstance(node, list) else node[part]
+        return node
+
+    def _function(self, schema):
+        # one function per distinct subschema object so recursive refs terminate
+        key = id(schema)
+        if key in self.functions: return self.functions[key]
+        name = self._name('_v')
+        self.functions[key] = name
+        body = self._body(schema)
+        self.lines += ['def '+name+'(data):']+['    '+x for x in body]+['    return True','']
+        return name
+
+    def _check(self, schema, var):
+        """Return a python expression testing var against schema."""
+        if schema is True or schema == {}: return 'True'
+        if schema is False: return 'False'
+        keys = set(schema.keys()) & _KEYWORDS
+        if len(keys) == 0: return 'True'
+        if keys == set(['type']):
+            return self._type_expression(schema['type'], var)
+        if '$ref' in schema and schema['$ref'].startswith('#'):
+            return self._function(self._resolve(schema['$ref']))+'('+var+')'
+        return self._function(schema)+'('+var+')'
+
+    def _type_expression(self, types, var):
+        if not isinstance(types, list): types = [types]
+        if len(types) == 1:
+            return _TYPE_CHECKS[types[0]].format(var)
+        return '('+' or '.join([_TYPE_CHECKS[x].format(var) for x in types])+')'
+
+    def _body(self, schema):
+        if schema is True: return []
+        if schema is False: return ['return False']
+        if '$ref' in schema:
+            # In draft 7 a $ref overrides any sibling keywords
+            if schema['$ref'].startswith('#'):
+                return ['if not '+self._function(self._resolve(schema['$ref']))+'(data): return False']
+            return self._fallback(schema)
+        # keywords unknown to draft 7 are ignored here as they are by jsonschema
+        lines = []
+        if 'type' in schema:
+            lines.append('if not '+self._type_expression(schema['type'],'data')+': return False')
+        if 'enum' in schema:
+            if all([isinstance(x, str) for x in schema['enum']]):
+                lines.append('if not (isinstance(data, str) and data in '+self._constant(frozenset(schema['enum']))+'): return False')
+            else:
+                lines.append('if not _in(data, '+self._constant(schema['enum'])+'): return False')
+        if 'const' in schema:
+            if isinstance(schema['const'], str):
+                lines.append('if data != '+self._constant(schema['const'])+': return False')
+            else:
+                lines.append('if not _equal(data, '+self._constant(schema['const'])+'): return False')
+        lines += self._object_lines(schema)
+        lines += self._array_lines(schema)
+        lines += self._string_lines(schema)
+        lines += self._number_lines(schema)
+        for subschema in schema.get('allOf',[]):
+            lines.append('if not '+self._check(subschema,'data')+': return False')
+        if 'anyOf' in schema:
+            lines.append('if not ('+' or '.join([self._check(x,'data') for x in schema['anyOf']])+'): return False')
+        if 'oneOf' in schema:
+            lines.append('if ['+', '.join([self._check(x,'data') for x in schema['oneOf']])+'].count(True) != 1: return False')
+        if 'not' in schema:
+            lines.append('if '+self._check(schema['not'],'data')+': return False')
+        if 'if' in schema and ('then' in schema or 'else' in schema):
+            lines.append('if '+self._check(schema['if'],'data')+':')
+            lines.append('    if not '+self._check(schema.get('then',True),'data')+': return False')
+            lines.append('elif not '+self._check(schema.get('else',True),'data')+': return False')
+        return lines
+
+    def _guard(self, schema, type_name, lines):
+        # keywords only apply to their own type, the guard is redundant when type is fixed
+        if len(lines) == 0: return lines
+        if schema.get('type') == type_name: return [x[4:] for x in lines]
+        return ['if '+_TYPE_CHECKS[type_name].format('data')+':']+lines
+
+    def _object_lines(self, schema):
+        lines = []
+        properties = schema.get('properties',{})
+        pattern_properties = schema.get('patternProperties',{})
+        additional = schema.get('additionalProperties',True)
+        if len(properties)==0 and len(pattern_properties)==0 and additional is True and \
+           len(set(['required','minProperties','maxProperties','propertyNames','dependencies']) & set(schema.keys()))==0:
+            return lines
+        if len(schema.get('required',[])) > 0:
+            lines.append('    for _k in '+self._constant(tuple(schema['required']))+':')
+            lines.append('        if _k not in data: return False')
+        if 'minProperties' in schema:
+            lines.append('    if len(data) < '+repr(schema['minProperties'])+': return False')
+        if 'maxProperties' in schema:
+            lines.append('    if len(data) > '+repr(schema['maxProperties'])+': return False')
+        for property_name, subschema in properties.items():
+            check = self._check(subschema,'_v')
+            if check == 'True': continue
+            lines.append('    _v = data.get('+repr(property_name)+', _MISSING)')
+            lines.append('    if _v is not _MISSING and not '+check+': return False')
+        if len(pattern_properties) > 0 or additional is not True:
+            known = self._constant(frozenset(properties.keys()))
+            patterns = [(self._constant(x, lambda p: 're.compile('+repr(p)+')'), self._check(y,'_v')) for x, y in pattern_properties.items()]
+            lines.append('    for _k, _v in data.items():')
+            if len(patterns) > 0:
+                lines.append('        _matched = False')
+                for pattern, check in patterns:
+                    lines.append('        if '+pattern+'.search(_k):')
+                    lines.append('            _matched = True')
+                    lines.append('            if not '+check+': return False')
+                lines.append('        if _matched: continue')
+            if additional is False:
+                lines.append('        if _k not in '+known+': return False')
+            elif additional is not True:
+                lines.append('        if _k in '+known+': continue')
+                lines.append('        if not '+self._check(additional,'_v')+': return False')
+        if 'propertyNames' in schema:
+            lines.append('    for _k in data:')
+            lines.append('        if not '+self._check(schema['propertyNames'],'_k')+': return False')
+        for property_name, dependency in schema.get('dependencies',{}).items():
+            lines.append('    if '+repr(property_name)+' in data:')
+            if isinstance(dependency, list):
+                lines.append('        for _k in '+self._constant(tuple(dependency))+':')
+                lines.append('            if _k not in data: return False')
+            else:
+                lines.append('        if not '+self._check(dependency,'data')+': return False')
+        return self._guard(schema,'object',lines)
+
+    def _array_lines(self, schema):
+        lines = []
+        if len(set(['items','minItems','maxItems','uniqueItems','contains']) & set(schema.keys()))==0:
+            return lines
+        if 'minItems' in schema:
+            lines.append('    if len(data) < '+repr(schema['minItems'])+': return False')
+        if 'maxItems' in schema:
+            lines.append('    if len(data) > '+repr(schema['maxItems'])+': return False')
+        if schema.get('uniqueItems',False):
+            lines.append('    if not _unique(data): return False')
+        items = schema.get('items',True)
+        if isinstance(items, list):
+            for i, subschema in enumerate(items):
+                lines.append('    if len(data) > '+str(i)+' and not '+self._check(subschema,'data['+str(i)+']')+': return False')
+            additional = schema.get('additionalItems',True)
+            check = self._check(additional,'_v')
+            if check != 'True':
+                lines.append('    for _v in data['+str(len(items))+':]:')
+                lines.append('        if not '+check+': return False')
+        else:
+            check = self._check(items,'_v')
+            if check != 'True':
+                lines.append('    for _v in data:')
+                lines.append('        if not '+check+': return False')
+        if 'contains' in schema:
+            lines.append('    if not any('+self._check(schema['contains'],'_v')+' for _v in data): return False')
+        return self._guard(schema,'array',lines)
+
+    def _string_lines(self, schema):
+        lines = []
+        if 'minLength' in schema:
+            lines.append('if isinstance(data, str) and len(data) < '+repr(schema['minLength'])+': return False')
+        if 'maxLength' in schema:
+            lines.append('if isinstance(data, str) and len(data) > '+repr(schema['maxLength'])+': return False')
+        if 'pattern' in schema:
+            pattern = self._constant(schema['pattern'], lambda p: 're.compile('+repr(p)+')')
+            lines.append('if isinstance(data, str) and not '+pattern+'.search(data): return False')
+        return lines
+
+    def _number_lines(self, schema):
+        lines = []
+        number = '(isinstance(data, Number) and not isinstance(data, bool))'
+        for keyword, operator in [('minimum','<'),('maximum','>'),('exclusiveMinimum','<='),('exclusiveMaximum','>=')]:
+            if keyword in schema:
+                lines.append('if '+number+' and data '+operator+' '+repr(schema[keyword])+': return False')
+        if 'multipleOf' in schema:
+            lines.append('if '+number+' and not _multiple_of(data, '+repr(schema['multipleOf'])+'): return False')
+        return lines
+
+    def _fallback(self, schema):
+        # references outside of this document are left to jsonschema
+        self.fallbacks.append(schema)
+        return ['if not _fallback('+str(len(self.fallbacks)-1)+', data): return False']
+
+def generate_source(schema):
+    """
+    Generate the python source for a validation function of a schema
+
+    Args:
+        schema (dict): a json-schema document
+    Returns:
+        source (str): module source defining validate(data) returning a bool
+        fallbacks (list): subschemas that the generated code delegates to jsonschema
+    """
+    compiler = _SchemaCompiler(schema)
+    return compiler.source(), compiler.fallbacks
+
+def load_source(schema, cache_directory=None):
+    """
+    Return generated source for a schema, reading or writing the on-disk cache
+
+    Args:
+        schema (dict): a json-schema document
+        cache_directory (str): where generated modules are kept, if None use the user cache directory
+    Returns:
+        source (str): module source defining validate(data)
+        fallbacks (list): subschemas that the generated code delegates to jsonschema
+    """
+    logger = logging.getLogger("schema compiler")
+    source, fallbacks = None, None
+    digest = hashlib.sha256((str(GENERATOR_VERSION)+_generator_digest()+json.dumps(schema,sort_keys=True)).encode('utf-8')).hexdigest()
+    if cache_directory is None: cache_directory = _cache_directory()
+    cache_path = os.path.join(cache_directory,'validator_'+digest+'.py')
+    if os.path.exists(cache_path):
+        with open(cache_path,'rt') as inf:
+            header = inf.readline()
+            source = inf.read()
+        if header == _source_header(source):
+            # fallbacks are cheap to recover and depend on the traversal order only
+            _temp, fallbacks = generate_source(schema) if '_fallback(' in source else (None, [])
+            return source, fallbacks
+        logger.warning("regenerating "+str(cache_path)+" which does not match its hash")
+    source, fallbacks = generate_source(schema)
+    try:
+        os.makedirs(cache_directory,exist_ok=True)
+        # a temporary file of its own so threads and processes writing the same module don't collide
+        with tempfile.NamedTemporaryFile('wt',dir=cache_directory,prefix='validator_'+digest+'.',suffix='.tmp',delete=False) as of:
+            of.write(_source_header(source)+source)
+        try:
+            os.replace(of.name,cache_path)
+        except OSError:
+            os.remove(of.name)
+            raise
+    except OSError as e:
+        logger.debug("unable to cache generated validator "+str(e))
+    return source, fallbacks
+
+class CompiledValidator(object):
+    """
+    A validator running generated code, falling back on a reference
+    Draft7Validator to describe failures.
+
+    Supports the parts of the Draft7Validator interface used in this package,
+    schema, is_valid, iter_errors and validate.
+    """
+    def __init__(self, reference, cache_directory=None):
+        self.reference = reference
+        self.schema = reference.schema
+        self.source, self._fallback_schemas = load_source(self.schema, cache_directory)
+        self._fallback_validators = {}
+        namespace = {
+            're':re,
+            'Number':numbers.Number,
+            '_MISSING':object(),
+            '_equal':_equal,
+            '_in':_in,
+            '_unique':_unique,
+            '_multiple_of':_multiple_of,
+            '_fallback':self._fallback
+        }
+        exec(compile(self.source,'<compiled schema>','exec'), namespace)
+        self._validate = namespace['validate']
+
+    def _fallback(self, index, data):
+        if index not in self._fallback_validators:
+            schema = self._fallback_schemas[index]
+            if hasattr(self.reference,'evolve'):
+                self._fallback_validators[index] = self.reference.evolve(schema=schema)
+            else:
+                self._fallback_validators[index] = type(self.reference)(schema, resolver=self.reference.resolver)
+        return self._fallback_validators[index].is_valid(data)
+
+    def is_valid(self, instance):
+        return self._validate(instance)
+
+    def _disagreement(self, instance):
+        from jsonschema import ValidationError
+        return ValidationError("the compiled validator rejected an instance the reference "+\
+                               type(self.reference).__name__+" accepts",instance=instance,schema=self.schema)
+
+    def iter_errors(self, instance):
+        if self._validate(instance): return
+        errors = 0
+        for error in self.reference.iter_errors(instance):
+            errors += 1
+            yield error
+        # never let a disagreement between the two pass as valid
+        if errors == 0: yield self._disagreement(instance)
+
+    def validate(self, instance):
+        if self._validate(instance): return
+        for error in self.reference.iter_errors(instance):
+            raise error
+        raise self._disagreement(instance)
@@ -0,0 +1,79 @@
+"""
+Open json files that may be compressed with gzip, xz or zstd.
+
+A file being read is recognized by its first bytes, so a compressed file reads
+the same whatever it is named.  A file being written is compressed as asked, or
+as its extension suggests (.gz, .xz or .zst).  Data is compressed and
+decompressed as it streams so memory use does not grow with the size of the
+file.  zstd needs the zstandard package.
+"""
+import os
+
+COMPRESSIONS = ['none','gzip','xz','zstd']
+EXTENSIONS = {'.gz':'gzip','.xz':'xz','.zst':'zstd'}
+DEFAULT_LEVELS = {'gzip':6,'xz':6,'zstd':3}
+LEVEL_RANGES = {'gzip':(0,9),'xz':(0,9),'zstd':(1,22)}
+_MAGIC = [(b'\x1f\x8b','gzip'),(b'\xfd7zXZ\x00','xz'),(b'\x28\xb5\x2f\xfd','zstd')]
+
+def detect_compression(file_path):
+    """
+    Return the compression of an existing file from its first bytes
+
+    Args:
+        file_path (str): path to the file
+    Returns:
+        compression (str): one of COMPRESSIONS
+    """
+    with open(file_path,'rb') as inf:
+        start = inf.read(6)
+    for magic, compression in _MAGIC:
+        if start.startswith(magic): return compression
+    return 'none'
+
+def compression_from_extension(file_path):
+    """
+    Return the compression the extension of a file name asks for, 'none' if it is not a compressed extension
+    """
+    return EXTENSIONS.get(os.path.splitext(str(file_path))[1].lower(),'none')
+
+def open_json(file_path,mode='rt',compression=None,level=None):
+    """
+    Open a json file as text, compressed or not
+
+    Args:
+        file_path (str): path to the file
+        mode (str): 'rt' to read or 'wt' to write
+        compression (str): one of COMPRESSIONS to write with, if None use the extension of file_path.
+                           Files are always read as their first bytes say they are compressed.
+        level (int): the compression level to write with, if None use DEFAULT_LEVELS
+    Returns:
+        file (file): a text file object
+    """
+    if mode not in ['rt','wt']:
+        raise ValueError("json files are opened with mode 'rt' or 'wt' not "+str(mode))
+    if mode == 'rt':
+        compression = detect_compression(file_path)
+    elif compression is None:
+        compression = compression_from_extension(file_path)
+    if compression not in COMPRESSIONS:
+        raise ValueError("unknown compression "+str(compression)+" must be one of "+str(COMPRESSIONS))
+    if compression == 'none':
+        return open(file_path,mode,encoding='utf-8')
+    if level is None: level = DEFAULT_LEVELS[compression]
+    if level < LEVEL_RANGES[compression][0] or level > LEVEL_RANGES[compression][1]:
+        raise ValueError(compression+" compression level must be from "+str(LEVEL_RANGES[compression][0])+" to "+\
+                         str(LEVEL_RANGES[compression][1])+" not "+str(level))
+    if compression == 'gzip':
+        import gzip
+        if mode == 'rt': return gzip.open(file_path,'rt',encoding='utf-8')
+        return gzip.open(file_path,'wt',compresslevel=level,encoding='utf-8')
+    if compression == 'xz':
+        import lzma
+        if mode == 'rt': return lzma.open(file_path,'rt',encoding='utf-8')
+        return lzma.open(file_path,'wt',preset=level,encoding='utf-8')
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package, install it with pip install pythologist_schemas[zstd]")
+    if mode == 'rt': return zstandard.open(file_path,'rt',encoding='utf-8')
+    return zstandard.open(file_path,'wt',cctx=zstandard.ZstdCompressor(level=level),encoding='utf-8')
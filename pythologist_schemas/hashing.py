@@ -0,0 +1,312 @@
+"""
+Hash files for the staging manifests.
+
+FileHasher reads files with a configurable buffer size, or through mmap, and
+can hash many files at once on a bounded thread pool (hashlib releases the GIL
+while it digests large buffers).  It keeps byte and time counts so the
+throughput can be tuned for each filesystem.
+
+FileHashCache keeps sha256 digests in a SQLite file so a file that has not
+changed since it was last hashed (same path, inode, size and st_mtime_ns) is
+not read again.
+
+Both offer sha256() to hash a file now and submit() to get a
+concurrent.futures.Future of the digest.
+"""
+import os, mmap, time, hashlib, sqlite3, threading, logging
+from concurrent.futures import ThreadPoolExecutor, Future
+
+DEFAULT_BUFFER_SIZE = 1024*1024
+
+def sha256_file(file_path, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False):
+    """
+    Return the hex sha256 digest of a file
+
+    Args:
+        file_path (str): path to the file
+        buffer_size (int): number of bytes to read at a time
+        use_mmap (bool): map the file into memory and digest it in one call rather than reading it
+    Returns:
+        digest (str): hex digest
+    """
+    hash_sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        if use_mmap:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hash_sha256.update(mm)
+                return hash_sha256.hexdigest()
+            except ValueError:
+                # empty files can not be mapped
+                pass
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        while True:
+            n = f.readinto(buffer)
+            if not n: break
+            hash_sha256.update(view[:n])
+    return hash_sha256.hexdigest()
+
+class FileHasher(object):
+    """
+    Hash files with a chosen buffer size or mmap on a bounded thread pool
+
+    Args:
+        buffer_size (int): number of bytes to read at a time
+        use_mmap (bool): map files into memory instead of reading them
+        workers (int): most files to hash at the same time
+    """
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False, workers=4):
+        if buffer_size < 1: raise ValueError("buffer_size must be positive")
+        if workers < 1: raise ValueError("workers must be positive")
+        self.buffer_size = buffer_size
+        self.use_mmap = use_mmap
+        self.workers = workers
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __getstate__(self):
+        # the pool and counters stay with this process
+        return {'buffer_size':self.buffer_size,'use_mmap':self.use_mmap,'workers':self.workers}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sha256(self, file_path, stat_result=None):
+        """
+        Hash a file in the calling thread
+
+        Args:
+            file_path (str): path to the file
+            stat_result (os.stat_result): stat of the file if it has already been taken
+        Returns:
+            digest (str): hex digest
+        """
+        start = time.perf_counter()
+        digest = sha256_file(file_path, self.buffer_size, self.use_mmap)
+        seconds = time.perf_counter() - start
+        size = stat_result.st_size if stat_result is not None else os.path.getsize(file_path)
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.seconds += seconds
+        return digest
+
+    def submit(self, file_path, stat_result=None):
+        """
+        Queue a file to be hashed on the pool
+
+        Returns:
+            future (concurrent.futures.Future): resolves to the hex digest
+        """
+        return self._pool().submit(self.sha256, file_path, stat_result)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def sha256_many(self, file_paths):
+        """
+        Hash many files concurrently
+
+        Args:
+            file_paths (list): paths to hash
+        Returns:
+            digests (list): hex digests in the order of file_paths
+        """
+        start = time.perf_counter()
+        _bytes = self.bytes
+        digests = [x.result() for x in [self.submit(y) for y in file_paths]]
+        seconds = time.perf_counter() - start
+        logging.getLogger("file hasher").info("hashed "+str(len(file_paths))+" files at "+\
+                                              str(int((self.bytes-_bytes)/seconds) if seconds > 0 else None)+" bytes/sec")
+        return digests
+
+    def stats(self):
+        """
+        Return the counts for files hashed so far
+
+        bytes_per_second is the rate of a single reader, the sum of bytes over
+        the time spent hashing each file.  With several workers the combined
+        rate can be higher.
+
+        Returns:
+            stats (dict): files, bytes, seconds and bytes_per_second
+        """
+        return {
+            'files':self.files,
+            'bytes':self.bytes,
+            'seconds':self.seconds,
+            'bytes_per_second':None if self.seconds == 0 else self.bytes/self.seconds
+        }
+
+    def add_stats(self, stats):
+        """
+        Add the counts of another hasher, such as the copy a worker process used
+
+        Args:
+            stats (dict): the stats() of the other hasher
+        """
+        with self._lock:
+            self.files += stats['files']
+            self.bytes += stats['bytes']
+            self.seconds += stats['seconds']
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+class FileHashCache(object):
+    """
+    A persistent cache of file sha256 digests stored in SQLite
+
+    Entries are keyed on the absolute path and are only reused when the inode,
+    size and st_mtime_ns of the file still match.  One cache can be shared by
+    threads, and it can be handed to a process pool where each task opens its
+    own connection to the same file.  The task should close its copy when it
+    finishes and send its stats() back to be added to the original.
+
+    The file keeps SQLite's default rollback journal rather than WAL, which
+    needs shared memory that network filesystems do not provide, so the cache
+    can sit in a project folder on an NFS or SMB share.
+
+    Args:
+        cache_path (str): the SQLite file to use, created if it does not exist
+        commit_interval (int): number of new digests to hold before committing them
+        hasher (FileHasher): hashes the files that are not in the cache, if None use FileHasher defaults
+    """
+    def __init__(self, cache_path, commit_interval=100, hasher=None):
+        self.cache_path = cache_path
+        self.commit_interval = commit_interval
+        self._owns_hasher = hasher is None
+        self.hasher = hasher if hasher is not None else FileHasher()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._connect()
+
+    def _connect(self):
+        _dir = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.exists(_dir): os.makedirs(_dir)
+        self._connection = sqlite3.connect(self.cache_path, timeout=60, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS file_hashes ('+\
+                                 'file_path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, sha256_hash TEXT)')
+        self._connection.commit()
+
+    def __getstate__(self):
+        # connections can't cross a process boundary, reopen the file on the other side.
+        # Worker processes commit every digest so they never hold the write lock for long.
+        self.flush()
+        return {'cache_path':self.cache_path,'commit_interval':1,'hasher':self.hasher}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_path'], state['commit_interval'], state['hasher'])
+        self._owns_hasher = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _lookup(self, file_path, stat_result):
+        # return the absolute path, the stat key and a cached digest or None
+        file_path = os.path.abspath(file_path)
+        if stat_result is None: stat_result = os.stat(file_path)
+        key = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+        with self._lock:
+            row = self._connection.execute('SELECT inode, size, mtime_ns, sha256_hash FROM file_hashes WHERE file_path=?',
+                                           (file_path,)).fetchone()
+            if row is not None and tuple(row[0:3]) == key:
+                self.hits += 1
+                return file_path, key, row[3]
+        return file_path, key, None
+
+    def _store(self, file_path, key, digest):
+        with self._lock:
+            self.misses += 1
+            self._connection.execute('INSERT OR REPLACE INTO file_hashes VALUES (?,?,?,?,?)',(file_path,)+key+(digest,))
+            self._pending += 1
+            if self._pending >= self.commit_interval:
+                self._connection.commit()
+                self._pending = 0
+        return digest
+
+    def sha256(self, file_path, stat_result=None):
+        """
+        Return the sha256 of a file, reading it only if it is not already cached
+
+        Args:
+            file_path (str): path to the file
+            stat_result (os.stat_result): stat of the file if it has already been taken
+        Returns:
+            digest (str): hex digest
+        """
+        file_path, key, digest = self._lookup(file_path, stat_result)
+        if digest is not None: return digest
+        return self._store(file_path, key, self.hasher.sha256(file_path, stat_result))
+
+    def submit(self, file_path, stat_result=None):
+        """
+        Return a future of the sha256 of a file, hashing on the pool of the hasher on a miss
+
+        Returns:
+            future (concurrent.futures.Future): resolves to the hex digest
+        """
+        file_path, key, digest = self._lookup(file_path, stat_result)
+        if digest is not None:
+            future = Future()
+            future.set_result(digest)
+            return future
+        return self.hasher._pool().submit(lambda: self._store(file_path, key, self.hasher.sha256(file_path, stat_result)))
+
+    def stats(self):
+        """
+        Return the hit and miss counts for this cache object
+
+        Returns:
+            stats (dict): hits, misses and hit_rate
+        """
+        total = self.hits + self.misses
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'hit_rate':None if total == 0 else float(self.hits)/total
+        }
+
+    def add_stats(self, stats):
+        """
+        Add the hit and miss counts of another cache, such as the copy a worker process used
+
+        Args:
+            stats (dict): the stats() of the other cache
+        """
+        with self._lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+
+    def flush(self):
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self):
+        if self._connection is None: return
+        self.flush()
+        self._connection.close()
+        self._connection = None
+        if self._owns_hasher: self.hasher.close()
+        logging.getLogger("file hash cache").info("hash cache "+str(self.cache_path)+" "+str(self.stats()))
@@ -0,0 +1,157 @@
+"""
+Read a json document incrementally.
+
+JSONStreamReader walks the objects and arrays of a document from a text file a
+chunk at a time.  The caller steps through the keys of an object or the
+elements of an array and for each one either decodes the value or skips over
+it.  A skipped object or array is decoded a member at a time and dropped, so
+the memory used is set by the values that are kept rather than by the size of
+the document.  end checks that nothing follows the document once it is read.
+"""
+import re, json
+
+DEFAULT_CHUNK_SIZE = 1024*1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARACTERS = set('0123456789.eE+-')
+
+class JSONStreamReader(object):
+    """
+    Step through a json document in a text file
+
+    Args:
+        fileobj (file): a text file open for reading
+        chunk_size (int): number of characters to read at a time
+    """
+    def __init__(self, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+        if chunk_size < 1: raise ValueError("chunk_size must be positive")
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size=None):
+        # drop what has been read and append the next chunk, False at the end of the file
+        if self._eof: return False
+        chunk = self.fileobj.read(size if size is not None else self.chunk_size)
+        self._buffer = self._buffer[self._pos:]+chunk
+        self._pos = 0
+        if len(chunk) == 0: self._eof = True
+        return len(chunk) > 0
+
+    def peek(self):
+        """
+        Return the next character that is not whitespace without reading past it
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer): return self._buffer[self._pos]
+            if not self._fill(): raise ValueError("unexpected end of json document")
+
+    def end(self):
+        """
+        Check that only whitespace follows the values read so far
+
+        Raises a ValueError when there is anything else before the end of the
+        file, such as a second document or the rest of a damaged one.
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                raise ValueError("extra data after the json document starting '"+self._buffer[self._pos:self._pos+20]+"'")
+            if not self._fill(): return
+
+    def _expect(self, character):
+        if self.peek() != character:
+            raise ValueError("expected '"+character+"' in json document but found '"+self._buffer[self._pos]+"'")
+        self._pos += 1
+
+    def value(self):
+        """
+        Decode the next value
+
+        Returns:
+            value: the value as json.loads would return it
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                end = None
+            # a value running to the end of the buffer may be cut short, and a number may
+            # stop early at a chunk boundary, 4 of 4.5 say, so it needs the character after it
+            if end is not None and (self._eof or (end < len(self._buffer) and self._buffer[end] not in _NUMBER_CHARACTERS)):
+                self._pos = end
+                return value
+            # grow the buffer geometrically so a large value is decoded a few times at most
+            if not self._fill(max(self.chunk_size, len(self._buffer)-self._pos)):
+                if end is not None: continue
+                # let the decoder describe what is wrong
+                self._decoder.raw_decode(self._buffer, self._pos)
+
+    def skip(self):
+        """
+        Pass over the next value without keeping it
+
+        The members of an object or array are decoded one at a time by the
+        C scanner of the json module and dropped, which is quicker than
+        scanning the text in python, and only the largest member is ever
+        held in memory.
+        """
+        first = self.peek()
+        if first == '{':
+            for key in self.items(): self.value()
+        elif first == '[':
+            for index in self.elements(): self.value()
+        else:
+            self.value()
+
+    def items(self):
+        """
+        Iterate over the keys of the next object
+
+        The value of each key has to be read with value, skip, items or
+        elements before asking for the next key.
+
+        Yields:
+            key (str)
+        """
+        self._expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"': raise ValueError("expected a key in json object")
+            key = self.value()
+            self._expect(':')
+            yield key
+            separator = self.peek()
+            self._pos += 1
+            if separator == '}': return
+            if separator != ',': raise ValueError("expected ',' or '}' in json object but found '"+separator+"'")
+
+    def elements(self):
+        """
+        Iterate over the elements of the next array
+
+        Each element has to be read with value, skip, items or elements
+        before asking for the next one.
+
+        Yields:
+            index (int)
+        """
+        self._expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            separator = self.peek()
+            self._pos += 1
+            if separator == ']': return
+            if separator != ',': raise ValueError("expected ',' or ']' in json array but found '"+separator+"'")
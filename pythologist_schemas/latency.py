@@ -0,0 +1,56 @@
+"""
+Slow down a local folder as if it were on network storage.
+
+simulated_latency patches os.stat, os.lstat, os.listdir, os.scandir and open
+so that each call on a path under a root folder waits first, the way a round
+trip to an NFS or SMB server would.  The wait happens in the calling thread,
+so calls made from several threads overlap just like real network requests,
+and the most calls that were in flight at once is recorded to show they did.
+Use it to benchmark the staging backends without network storage.
+"""
+import os, time, builtins, threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+
+@contextmanager
+def simulated_latency(root, seconds=0.005):
+    """
+    Add a fixed delay to filesystem calls on paths under root while the context is open
+
+    Args:
+        root (str): folder whose paths are slowed down
+        seconds (float): delay of each call
+    Yields:
+        calls (dict): counts of the delayed calls by function name, and peak_in_flight, the most
+                      delayed calls that were running at the same time
+    """
+    root = os.path.join(os.path.abspath(root),'')
+    calls = {'peak_in_flight':0}
+    in_flight = [0]
+    def _slowed(name, function):
+        def _function(*args, **kwargs):
+            path = args[0] if len(args) > 0 else kwargs.get('path', kwargs.get('file'))
+            if isinstance(path, (str, bytes, os.PathLike)) and \
+               os.path.join(os.path.abspath(os.fsdecode(path)),'').startswith(root):
+                with _lock:
+                    calls[name] = calls.get(name, 0) + 1
+                    in_flight[0] += 1
+                    calls['peak_in_flight'] = max(calls['peak_in_flight'], in_flight[0])
+                try:
+                    time.sleep(seconds)
+                    return function(*args, **kwargs)
+                finally:
+                    with _lock:
+                        in_flight[0] -= 1
+            return function(*args, **kwargs)
+        return _function
+    originals = [(os, 'stat', os.stat), (os, 'lstat', os.lstat), (os, 'listdir', os.listdir),
+                 (os, 'scandir', os.scandir), (builtins, 'open', builtins.open)]
+    for module, name, function in originals:
+        setattr(module, name, _slowed(name, function))
+    try:
+        yield calls
+    finally:
+        for module, name, function in originals:
+            setattr(module, name, function)
@@ -0,0 +1,334 @@
+"""
+Measure the densities and percentages of report regions in one pass over the cells.
+
+The cells of a sample are counted once for each frame, base region and
+population, and the area of each base region of each frame is read once.  A
+report region that combines base regions is a sum over those counts and areas,
+and the sample level cumulative and aggregate measures are derived from the
+frame level ones, so the pass over the cells does not grow with the number of
+report regions.
+
+The measures are the pythologist Counts measures the report is made from.
+A cell without a region_label is in no region and is not counted, as Counts
+leaves it out when grouping by region.  For each frame where the report region
+has area:
+
+- count is the number of cells of the population in the region, missing if
+  the region is smaller than the minimum region size, as Counts does
+- density_mm2 is count over region_area_mm2, missing if the region is smaller
+  than the minimum region size
+- fraction is the numerator count over the denominator count, missing if the
+  denominator is smaller than the minimum denominator count, and percent is
+  100 times fraction
+
+and for the sample:
+
+- cumulative measures treat the frames as one large frame, summing counts and
+  areas before dividing, with the same minimums, so cumulative_count is
+  missing along with cumulative_density_mm2 when the summed area is too small
+- aggregate measures are the mean, standard deviation and standard error of
+  the frame measures that are not missing, and measured_frame_count is the
+  number of them
+"""
+from collections import OrderedDict
+
+FRAME_COUNT_COLUMNS = ['frame_name','region_label','phenotype_label','region_area_pixels','region_area_mm2','count','density_mm2']
+FRAME_PERCENTAGE_COLUMNS = ['frame_name','region_label','phenotype_label','numerator','denominator','fraction','percent']
+SAMPLE_COUNT_COLUMNS = ['region_label','phenotype_label','frame_count','cumulative_region_area_pixels','cumulative_region_area_mm2',
+                        'cumulative_count','cumulative_density_mm2','measured_frame_count','mean_density_mm2',
+                        'stddev_density_mm2','stderr_density_mm2']
+SAMPLE_PERCENTAGE_COLUMNS = ['region_label','phenotype_label','frame_count','cumulative_numerator','cumulative_denominator',
+                             'cumulative_fraction','cumulative_percent','measured_frame_count','mean_fraction','stdev_fraction',
+                             'stderr_fraction','mean_percent','stdev_percent','stderr_percent']
+
+class SampleMeasurements(object):
+    """
+    Frame, base region and population counts of the cells of a sample
+
+    Each cell's mutually exclusive phenotype is encoded as an integer code and
+    its binary phenotypes as two bitsets, which are defined and which are
+    positive.  Cells with the same frame, base region, phenotype code and
+    bitsets are collapsed to one signature with a cell count, and a population
+    is compiled to a lookup table over the phenotype codes and a required and
+    expected bitset, which are checked against every signature at once.
+
+    Args:
+        cells (pandas.DataFrame): one row per cell with frame_name, region_label, phenotype_label,
+                                  scored_calls and regions columns like a pythologist CellDataFrame
+        microns_per_pixel (float): size of a pixel
+        phenotypes (list): the mutually exclusive phenotypes populations can use, if None those in phenotype_label
+    """
+    def __init__(self, cells, microns_per_pixel, phenotypes=None):
+        import numpy as np
+        import pandas as pd
+        self.microns_per_pixel = microns_per_pixel
+        frame_codes, self.frame_names = pd.factorize(cells['frame_name'],sort=False)
+        # the regions of a frame and their areas are the same for every cell of the frame
+        first_cells = np.unique(frame_codes,return_index=True)[1]
+        frame_regions = [cells['regions'].iloc[i] for i in first_cells]
+        region_names = OrderedDict()
+        for regions in frame_regions:
+            for region_name in regions: region_names.setdefault(region_name,len(region_names))
+        for region_name in pd.unique(cells['region_label'].dropna()): region_names.setdefault(region_name,len(region_names))
+        self.region_names = list(region_names)
+        self.areas = np.zeros((len(self.frame_names),len(self.region_names)),dtype=np.int64)
+        for i, regions in enumerate(frame_regions):
+            for region_name, area in regions.items(): self.areas[i,region_names[region_name]] = area
+        region_codes = pd.Categorical(cells['region_label'],categories=self.region_names).codes.astype(np.int64)
+        # a code into frames by regions, -1 for a cell without a region so it is in none of them
+        cell_keys = frame_codes.astype(np.int64)*len(self.region_names)+region_codes
+        cell_keys[region_codes < 0] = -1
+
+        self.phenotypes = list(phenotypes) if phenotypes is not None else list(pd.unique(cells['phenotype_label'].dropna()))
+        # a code into phenotypes, -1 for a cell without one
+        phenotype_codes = pd.Categorical(cells['phenotype_label'],categories=self.phenotypes).codes.astype(np.int64)
+
+        self.scored_names, values = _scored_values(cells['scored_calls'].tolist())
+        self._scored_bits = dict([(x,(i//64,np.uint64(1)<<np.uint64(i%64))) for i, x in enumerate(self.scored_names)])
+        self._words = max(1,(len(self.scored_names)+63)//64)
+        defined = np.zeros((self._words,len(values)),dtype=np.uint64)
+        positive = np.zeros((self._words,len(values)),dtype=np.uint64)
+        for i, (word, bit) in enumerate([self._scored_bits[x] for x in self.scored_names]):
+            defined[word,values[:,i] >= 0] |= bit
+            positive[word,values[:,i] == 1] |= bit
+
+        # collapse the cells to their distinct signatures
+        self._cell_signatures = _row_codes([cell_keys+1,phenotype_codes+1]+\
+                                           [y for x in list(defined)+list(positive) for y in [x>>np.uint64(32),x&np.uint64(0xffffffff)]])
+        signature_count = int(self._cell_signatures.max())+1 if len(self._cell_signatures) > 0 else 0
+        first = np.zeros(signature_count,dtype=np.int64)
+        first[self._cell_signatures[::-1]] = np.arange(len(self._cell_signatures))[::-1]
+        self._signature_weights = np.bincount(self._cell_signatures,minlength=signature_count)
+        self._signature_keys = cell_keys[first]
+        self._signature_phenotypes = phenotype_codes[first]
+        self._signature_defined = defined[:,first]
+        self._signature_positive = positive[:,first]
+        self._counts = {}
+
+    def compile_population(self, phenotypes, binary_phenotypes=[]):
+        """
+        Compile a population to the checks made on the phenotype code and bitsets of a cell
+
+        Args:
+            phenotypes (list): mutually exclusive phenotypes the cells can have, every phenotype if empty
+            binary_phenotypes (list): target_name and filter_direction of binary phenotypes the cells must have,
+                                      the last direction given for a target is used
+        Returns:
+            table (numpy.ndarray): True for the phenotype codes in the population, shifted by one so -1 is at 0
+            required (numpy.ndarray): the bits of the binary phenotypes that have to be defined
+            expected (numpy.ndarray): the values the positive bits have to have under required
+        """
+        import numpy as np
+        phenotypes = list(phenotypes) if len(phenotypes) > 0 else self.phenotypes
+        table = np.zeros(len(self.phenotypes)+1,dtype=bool)
+        for phenotype in phenotypes:
+            if phenotype not in self.phenotypes: raise ValueError("phenotype "+str(phenotype)+" must exist in defined")
+            table[self.phenotypes.index(phenotype)+1] = True
+        required = np.zeros(self._words,dtype=np.uint64)
+        expected = np.zeros(self._words,dtype=np.uint64)
+        for binary_phenotype in binary_phenotypes:
+            target_name = binary_phenotype['target_name']
+            if target_name not in self._scored_bits: raise ValueError("Scored name "+str(target_name)+" must exist in defined")
+            word, bit = self._scored_bits[target_name]
+            required[word] |= bit
+            expected[word] &= ~bit
+            if binary_phenotype['filter_direction'] == '+': expected[word] |= bit
+        return table, required, expected
+
+    def _signature_mask(self, population):
+        # which signatures a compiled population takes
+        table, required, expected = population
+        mask = table[self._signature_phenotypes+1]
+        for word in range(self._words):
+            if required[word] == 0: continue
+            mask &= (self._signature_defined[word] & required[word]) == required[word]
+            mask &= (self._signature_positive[word] & required[word]) == expected[word]
+        return mask
+
+    def population_mask(self, phenotypes, binary_phenotypes=[]):
+        """
+        Return which cells are in a population
+
+        Args:
+            phenotypes (list): mutually exclusive phenotypes the cells can have, every phenotype if empty
+            binary_phenotypes (list): target_name and filter_direction of binary phenotypes the cells must have
+        Returns:
+            mask (numpy.ndarray): True for each cell in the population
+        """
+        return self._signature_mask(self.compile_population(phenotypes,binary_phenotypes))[self._cell_signatures]
+
+    def counts(self, phenotypes, binary_phenotypes=[]):
+        """
+        Return the cell counts of a population for every frame and base region
+
+        Counts are kept so a population used by several measures is only counted once.
+
+        Returns:
+            counts (numpy.ndarray): frames by base regions in the order of frame_names and region_names
+        """
+        import numpy as np
+        key = (tuple(sorted(phenotypes)),tuple(sorted(dict([(x['target_name'],x['filter_direction']) for x in binary_phenotypes]).items())))
+        if key not in self._counts:
+            mask = self._signature_mask(self.compile_population(phenotypes,binary_phenotypes))&(self._signature_keys >= 0)
+            counts = np.bincount(self._signature_keys[mask],weights=self._signature_weights[mask],minlength=self.areas.size)
+            self._counts[key] = counts.astype(np.int64).reshape(self.areas.shape)
+        return self._counts[key]
+
+    def region_members(self, regions_to_combine):
+        """
+        Return which base regions make up a report region
+
+        Raises:
+            ValueError: if a region is not in the data
+        """
+        import numpy as np
+        bad_regions = set(regions_to_combine)-set(self.region_names)
+        if len(bad_regions) > 0: raise ValueError("Error regions(s) "+str(bad_regions)+" are not in the data.")
+        return np.isin(np.array(self.region_names,dtype=object),np.array(list(regions_to_combine),dtype=object))
+
+    def report_tables(self, report):
+        """
+        Measure every region and population of a report
+
+        Args:
+            report (dict): a report in the report schema
+        Returns:
+            frame_counts (pandas.DataFrame): frame_name, region_label, phenotype_label, region_area_pixels, region_area_mm2, count and density_mm2
+            sample_counts (pandas.DataFrame): region_label, phenotype_label, frame_count, the cumulative_ measures,
+                                              measured_frame_count and the mean, stddev and stderr of density_mm2
+            frame_percentages (pandas.DataFrame): frame_name, region_label, phenotype_label, numerator, denominator, fraction and percent
+            sample_percentages (pandas.DataFrame): region_label, phenotype_label, frame_count, the cumulative_ measures,
+                                                   measured_frame_count and the mean, stdev and stderr of fraction and percent
+        """
+        import numpy as np
+        import pandas as pd
+        minimum_region_size_pixels = report['parameters']['minimum_density_region_size_pixels']
+        minimum_denominator_count = report['parameters']['minimum_denominator_count']
+        frame_counts, sample_counts, frame_percentages, sample_percentages = [], [], [], []
+        for report_region_row in report['region_selection']:
+            region_name = report_region_row['report_region_name']
+            members = self.region_members(report_region_row['regions_to_combine'])
+            areas = self.areas[:,members].sum(axis=1)
+            measured = areas > 0
+            frame_names = np.asarray(self.frame_names,dtype=object)[measured]
+            areas = areas[measured]
+            areas_mm2 = (areas/1000000)*(self.microns_per_pixel*self.microns_per_pixel)
+            small = areas < minimum_region_size_pixels
+            for population in report['population_densities']:
+                counts = self.counts(population['mutually_exclusive_phenotypes'],population['binary_phenotypes'])[:,members].sum(axis=1)[measured]
+                densities = _divide(counts,areas_mm2)
+                densities[small] = np.nan
+                # the densities use every count, the counts of a small region are then reported missing
+                measured_counts = pd.array(counts,dtype='Int64')
+                measured_counts[small] = pd.NA
+                frame_counts.append(pd.DataFrame(OrderedDict([
+                    ('frame_name',frame_names),
+                    ('region_label',region_name),
+                    ('phenotype_label',population['population_name']),
+                    ('region_area_pixels',areas),
+                    ('region_area_mm2',areas_mm2),
+                    ('count',measured_counts),
+                    ('density_mm2',densities)
+                ]),columns=FRAME_COUNT_COLUMNS))
+                cumulative_area, cumulative_area_mm2, cumulative_count = areas.sum(), areas_mm2.sum(), counts.sum()
+                cumulative_density = _divide(np.array([cumulative_count]),np.array([cumulative_area_mm2]))[0]
+                if cumulative_area < minimum_region_size_pixels: cumulative_count, cumulative_density = pd.NA, np.nan
+                sample_counts.append(OrderedDict([
+                    ('region_label',region_name),
+                    ('phenotype_label',population['population_name']),
+                    ('frame_count',len(areas)),
+                    ('cumulative_region_area_pixels',cumulative_area),
+                    ('cumulative_region_area_mm2',cumulative_area_mm2),
+                    ('cumulative_count',cumulative_count),
+                    ('cumulative_density_mm2',cumulative_density)
+                ]+_aggregate(densities,['measured_frame_count','mean_density_mm2','stddev_density_mm2','stderr_density_mm2'])))
+            for population in report['population_percentages']:
+                numerators = self.counts(population['numerator_mutually_exclusive_phenotypes'],
+                                         population['numerator_binary_phenotypes'])[:,members].sum(axis=1)[measured]
+                denominators = self.counts(population['denominator_mutually_exclusive_phenotypes'],
+                                           population['denominator_binary_phenotypes'])[:,members].sum(axis=1)[measured]
+                fractions = _divide(numerators,denominators)
+                fractions[denominators < minimum_denominator_count] = np.nan
+                frame_percentages.append(pd.DataFrame(OrderedDict([
+                    ('frame_name',frame_names),
+                    ('region_label',region_name),
+                    ('phenotype_label',population['population_name']),
+                    ('numerator',numerators),
+                    ('denominator',denominators),
+                    ('fraction',fractions),
+                    ('percent',fractions*100)
+                ]),columns=FRAME_PERCENTAGE_COLUMNS))
+                cumulative_numerator, cumulative_denominator = numerators.sum(), denominators.sum()
+                cumulative_fraction = _divide(np.array([cumulative_numerator]),np.array([cumulative_denominator]))[0]
+                if cumulative_denominator < minimum_denominator_count: cumulative_fraction = np.nan
+                sample_percentages.append(OrderedDict([
+                    ('region_label',region_name),
+                    ('phenotype_label',population['population_name']),
+                    ('frame_count',len(areas)),
+                    ('cumulative_numerator',cumulative_numerator),
+                    ('cumulative_denominator',cumulative_denominator),
+                    ('cumulative_fraction',cumulative_fraction),
+                    ('cumulative_percent',cumulative_fraction*100)
+                ]+_aggregate(fractions,['measured_frame_count','mean_fraction','stdev_fraction','stderr_fraction'])+\
+                  _aggregate(fractions*100,['measured_frame_count','mean_percent','stdev_percent','stderr_percent'])[1:]))
+        sample_counts = pd.DataFrame(sample_counts,columns=SAMPLE_COUNT_COLUMNS)
+        sample_counts['cumulative_count'] = sample_counts['cumulative_count'].astype('Int64')
+        return _concat(frame_counts,FRAME_COUNT_COLUMNS), sample_counts, \
+               _concat(frame_percentages,FRAME_PERCENTAGE_COLUMNS), pd.DataFrame(sample_percentages,columns=SAMPLE_PERCENTAGE_COLUMNS)
+
+def _divide(numerators, denominators):
+    # a measure over nothing is missing
+    import numpy as np
+    with np.errstate(divide='ignore',invalid='ignore'):
+        values = numerators/denominators.astype(float)
+    values[denominators == 0] = np.nan
+    return values
+
+def _aggregate(values, names):
+    # the count, mean, sample standard deviation and standard error of the values that are not missing
+    import numpy as np
+    values = values[~np.isnan(values)]
+    n = len(values)
+    mean = values.mean() if n > 0 else np.nan
+    stddev = values.std(ddof=1) if n > 1 else np.nan
+    return list(zip(names,[n,mean,stddev,stddev/np.sqrt(n) if n > 1 else np.nan]))
+
+def _concat(frames, columns):
+    import pandas as pd
+    if len(frames) == 0: return pd.DataFrame(columns=columns)
+    return pd.concat(frames,ignore_index=True)
+
+def _row_codes(columns):
+    # one code for each distinct row of non-negative integer columns, numbered in order of first appearance
+    import numpy as np
+    import pandas as pd
+    codes = np.zeros(len(columns[0]),dtype=np.int64)
+    for column in columns:
+        column = column.astype(np.int64)
+        if len(column) == 0: break
+        codes = pd.factorize(codes*(int(column.max())+1)+column,sort=False)[0].astype(np.int64)
+    return codes
+
+def _scored_values(scored_calls):
+    # the sorted binary phenotype names and a cells by names array of the calls, -1 where a cell has no call
+    import itertools
+    import numpy as np
+    from operator import itemgetter
+    if len(scored_calls) == 0: return [], np.zeros((0,0),dtype=np.int64)
+    names = sorted(scored_calls[0].keys())
+    # usually every cell has a call for every name, and then the calls can be read without a python loop
+    if len(names) > 0 and set(map(len,scored_calls)) == set([len(names)]):
+        calls = map(itemgetter(*names),scored_calls)
+        # itemgetter of one name gives the call rather than a tuple of calls
+        if len(names) > 1: calls = itertools.chain.from_iterable(calls)
+        try:
+            return names, np.fromiter(calls,dtype=np.int64,count=len(scored_calls)*len(names)).reshape(len(scored_calls),len(names))
+        except KeyError:
+            pass
+    names = set()
+    for x in scored_calls: names.update(x.keys())
+    names = sorted(names)
+    values = np.full((len(scored_calls),len(names)),-1,dtype=np.int64)
+    for i, name in enumerate(names):
+        values[:,i] = np.fromiter((x.get(name,-1) for x in scored_calls),dtype=np.int64,count=len(scored_calls))
+    return names, values
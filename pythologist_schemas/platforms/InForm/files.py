@@ -20,30 +20,217 @@ g. Make sure there are not image frames that do not have a cell seg data since t
 h. Make sure that the required images for each annotation strategy are present
 
 """
-import os, re, time, stat, hashlib, logging
+import os, time, stat, logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from importlib_resources import files
 from pythologist_schemas import get_validator
+from pythologist_schemas.hashing import sha256_file, FileHashCache
 
-# Lets preload our validators for relevent schemas as globals
-project_schema_validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('project.json'))
-analysis_schema_validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('analysis.json'))
-files_schema_validator = get_validator(files('schema_data.inputs.platforms.InForm').joinpath('files.json'))
+# Validators for the relevent schemas are loaded on first use (get_validator caches them)
+_schema_validator_files = {
+    'project_schema_validator':'project.json',
+    'analysis_schema_validator':'analysis.json',
+    'files_schema_validator':'files.json'
+}
 
+def _schema_validator(name):
+    return get_validator(files('schema_data.inputs.platforms.InForm').joinpath(_schema_validator_files[name]))
 
-def injest_project(project_json,analysis_json,project_directory):
+def __getattr__(name):
+    # keep the former module-level validator globals available without loading them at import
+    if name in _schema_validator_files: return _schema_validator(name)
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
+
+
+def injest_project(project_json,analysis_json,project_directory,workers=1,pool_type='thread',hasher=None):
     """
     Read a path pointing to multiple InForm sample folders
 
     Args:
         project_json (dict): The json object as a valid project schema
         analysis_json (dict): The json object as a valid analysis schema
+        workers (int): number of samples to injest at once, 1 injests serially.  For 'asyncio' the number of filesystem calls at once
+        pool_type (str): 'thread' or 'process' pool used when workers is more than 1, or 'asyncio' to overlap the filesystem calls of every sample
+        hasher (pythologist_schemas.hashing.FileHasher or FileHashCache): hashes files concurrently, and with a FileHashCache reuses digests of unchanged files
+    Returns:
+        samples (list): A list of json objects for the samples in the project in sample manifest order
+    """
+    if pool_type not in ['thread','process','asyncio']:
+        raise ValueError('pool_type must be "thread", "process" or "asyncio" not '+str(pool_type))
+
+    sample_names = _project_sample_names(project_json,analysis_json,project_directory)
+
+    samples = []
+    injest_success = True
+    injest_errors = []
+    for sample_json, injest_success0, injest_errors0 in _injest_samples(sample_names,project_json,analysis_json,project_directory,
+                                                                        workers,pool_type,hasher):
+        injest_errors += injest_errors0
+        injest_success  = injest_success0 and injest_success
+        samples.append(sample_json)
+    return samples, injest_success, injest_errors
+
+def restage_project(previous_json,project_json,analysis_json,project_directory,workers=1,pool_type='thread',hasher=None):
+    """
+    Read a project again, only injesting the samples whose files changed since a previous staging
+
+    A sample is reused from the previous staging when its export folders list
+    the same files, its annotation files are the same, and every file has the
+    size and nanosecond modification time recorded before.  Everything else,
+    including samples staged before sizes were recorded, is injested again.
+    When the analysis differs from the one used before every sample is injested again.
+
+    Args:
+        previous_json (dict): the output of an earlier staging with 'analysis' and 'sample_files'
+        project_json (dict): The json object as a valid project schema
+        analysis_json (dict): The json object as a valid analysis schema
+        workers (int): number of samples to injest at once, 1 injests serially.  For 'asyncio' the number of filesystem calls at once
+        pool_type (str): 'thread' or 'process' pool used when workers is more than 1, or 'asyncio' to overlap the filesystem calls of every sample
+        hasher (pythologist_schemas.hashing.FileHasher or FileHashCache): hashes the files of changed samples
     Returns:
-        samples (list): A list of json objects for the samples in the project
+        samples (list): A list of json objects for the samples in the project in sample manifest order
+        injest_success (bool): True if the samples were injested
+        injest_errors (list): errors from injesting the samples
+        changes (list): one dict per sample in manifest order, then the samples that were removed, with the
+                        sample_name, status ('added','removed','modified' or 'unchanged'), added_images,
+                        removed_images and modified_images
     """
+    logger = logging.getLogger("restage project")
+    if pool_type not in ['thread','process','asyncio']:
+        raise ValueError('pool_type must be "thread", "process" or "asyncio" not '+str(pool_type))
 
+    sample_names = _project_sample_names(project_json,analysis_json,project_directory)
+
+    previous_samples = dict([(x['sample_name'],x) for x in previous_json['sample_files']])
+    reusable = previous_samples
+    if previous_json.get('analysis') != analysis_json:
+        logger.warning("analysis differs from the previous staging so every sample will be injested")
+        reusable = {}
+
+    unchanged = set([x for x in sample_names if x in reusable and \
+                     _sample_unchanged(previous_samples[x],os.path.join(project_directory,'SAMPLES',x),analysis_json)])
+    logger.info("reusing "+str(len(unchanged))+" of "+str(len(sample_names))+" samples from the previous staging")
+
+    restaged = _injest_samples([x for x in sample_names if x not in unchanged],project_json,analysis_json,project_directory,
+                               workers,pool_type,hasher)
+    samples = []
+    changes = []
+    injest_success = True
+    injest_errors = []
+    for sample_name in sample_names:
+        if sample_name in unchanged:
+            sample_json = previous_samples[sample_name]
+        else:
+            sample_json, injest_success0, injest_errors0 = next(restaged)
+            injest_errors += injest_errors0
+            injest_success  = injest_success0 and injest_success
+        samples.append(sample_json)
+        changes.append(_sample_changes(sample_name,previous_samples.get(sample_name),sample_json))
+    for sample_name in [x['sample_name'] for x in previous_json['sample_files'] if x['sample_name'] not in sample_names]:
+        changes.append(_sample_changes(sample_name,previous_samples[sample_name],None))
+    for change in changes:
+        if change['status'] == 'unchanged': continue
+        logger.info("sample "+str(change['sample_name'])+" "+change['status']+\
+                    " added images "+str(change['added_images'])+\
+                    " removed images "+str(change['removed_images'])+\
+                    " modified images "+str(change['modified_images']))
+    return samples, injest_success, injest_errors, changes
+
+def _annotation_file_names(image_name,analysis_json):
+    # the annotation files an image may have under the region annotation strategy
+    annotation_strategy = analysis_json['parameters']['region_annotation_strategy']
+    if annotation_strategy == 'GIMP_TSI':
+        return [image_name+'_Tumor.tif',image_name+'_Invasive_Margin.tif']
+    if annotation_strategy == 'GIMP_CUSTOM':
+        return [image_name+'_'+str(analysis_json['parameters']['region_annotation_custom_label'])+'.tif']
+    return []
+
+def _sample_unchanged(previous_sample,sample_path,analysis_json):
+    """
+    Compare the directory listings and file stats of a sample folder to a previous staging of it
+
+    Returns:
+        unchanged (bool): True if the previous sample_files entry still describes the folder
+    """
+    if previous_sample['sample_directory'] != sample_path: return False
+    # the size and modification time recorded for each file we expect to find
+    expected = {}
+    for export in previous_sample['exports']:
+        export_path = os.path.join(sample_path,'INFORM_ANALYSIS',export['export_name'])
+        export_files = set()
+        for image in export['images']:
+            for d in image['image_data'].values():
+                export_files.add(os.path.basename(d['file_path']))
+                expected[d['file_path']] = (d.get('file_size'),d.get('last_modified_ns'))
+            for d in image['image_annotations']:
+                expected[d['file_path']] = (d.get('file_size'),d.get('last_modified_ns'))
+        # only the image data files are staged, summaries and composites InForm writes beside them are not
+        try:
+            observed = set([y for x in _index_export_folder(export_path)['images'].values() for y in x.values()])
+        except OSError:
+            return False
+        if observed != export_files: return False
+    try:
+        observed = set([x for x in os.listdir(os.path.join(sample_path,'INFORM_ANALYSIS')) if x[0]!='.'])
+    except OSError:
+        return False
+    if observed != set([x['export_name'] for x in previous_sample['exports']]): return False
+    # an annotation that was added since the previous staging is a change too
+    annotation_folder = os.path.join(sample_path,'ANNOTATIONS')
+    image_names = set([y['image_name'] for x in previous_sample['exports'] for y in x['images']])
+    for image_name in image_names:
+        for annotation_file_name in _annotation_file_names(image_name,analysis_json):
+            annotation_path = os.path.join(annotation_folder,annotation_file_name)
+            if annotation_path not in expected and os.path.exists(annotation_path): return False
+    for file_path, file_stats in expected.items():
+        # the timestamp string only has one second resolution, an older staging without sizes is a change
+        if None in file_stats: return False
+        try:
+            fileStatsObj = os.stat(file_path)
+        except OSError:
+            return False
+        if (fileStatsObj.st_size,fileStatsObj.st_mtime_ns) != file_stats: return False
+    return True
+
+def _sample_changes(sample_name,previous_sample,sample_json):
+    # summarize the images added, removed and modified in a sample between two stagings
+    def _images(sample):
+        images = {}
+        if sample is None: return images
+        for export in sample['exports']:
+            for image in export['images']:
+                digests = images.setdefault(image['image_name'],{})
+                for d in list(image['image_data'].values())+image['image_annotations']:
+                    digests[d['file_path']] = d['sha256_hash']
+        return images
+    previous_images = _images(previous_sample)
+    images = _images(sample_json)
+    change = {
+        'sample_name':sample_name,
+        'added_images':sorted(list(set(images)-set(previous_images))),
+        'removed_images':sorted(list(set(previous_images)-set(images))),
+        'modified_images':sorted([x for x in images if x in previous_images and images[x]!=previous_images[x]])
+    }
+    if previous_sample is None:
+        change['status'] = 'added'
+    elif sample_json is None:
+        change['status'] = 'removed'
+    elif len(change['added_images'])+len(change['removed_images'])+len(change['modified_images']) > 0:
+        change['status'] = 'modified'
+    else:
+        change['status'] = 'unchanged'
+    return change
+
+def _project_sample_names(project_json,analysis_json,project_directory):
+    """
+    Check the project directory against the project and return its sample folder names
+
+    Returns:
+        sample_names (list): names of the sample folders in sample manifest order
+    """
     # Might want to revalidate teh project_schema here against the project schema
-    project_schema_validator.validate(project_json)
-    analysis_schema_validator.validate(analysis_json)
+    _schema_validator('project_schema_validator').validate(project_json)
+    _schema_validator('analysis_schema_validator').validate(analysis_json)
 
     # a. Make sure the project directory exists
     if not os.path.exists(project_directory):
@@ -72,26 +259,76 @@ def injest_project(project_json,analysis_json,project_directory):
     if len(unwelcome) > 0:
         raise ValueError('Folder(s) are present in the project folder that are not listed in the sample manifest '+str(unwelcome))
 
-    samples = []
-    injest_success = True
-    injest_errors = []
-    for sample_path, sample_name in [(os.path.join(project_directory,x),x) for x in folder_names]:
-        #print(sample_name)
-        sample_json, injest_success0, injest_errors0 = injest_sample(sample_name,project_json,analysis_json,project_directory)
-        injest_errors += injest_errors0
-        injest_success  = injest_success0 and injest_success
-        samples.append(sample_json)
-    return samples, injest_success, injest_errors
-
-
+    # keep the order of the sample manifest so the output does not depend on the directory listing
+    sample_names = sorted(folder_names,key=sample_allow_list.index)
+    return sample_names
+
+def _injest_samples(sample_names,project_json,analysis_json,project_directory,workers=1,pool_type='thread',hasher=None):
+    # Yield injest_sample results in order from the chosen backend
+    if pool_type == 'asyncio':
+        import asyncio
+        from pythologist_schemas.platforms.InForm.files_async import injest_samples_async
+        for result in asyncio.run(injest_samples_async(sample_names,project_json,analysis_json,project_directory,
+                                                       concurrency=workers,hasher=hasher)):
+            yield result
+        return
+    if pool_type == 'process' and hasher is not None and workers is not None and workers > 1:
+        # every task gets its own copy of the hasher, count the work of each copy here
+        for result, stats in _map_samples(_injest_sample_task,sample_names,(project_json,analysis_json,project_directory,hasher),
+                                          workers,pool_type):
+            _add_hasher_stats(hasher,stats)
+            yield result
+        return
+    for result in _map_samples(injest_sample,sample_names,(project_json,analysis_json,project_directory,hasher),workers,pool_type):
+        yield result
+
+def _injest_sample_task(sample_name,project_json,analysis_json,project_directory,hasher):
+    # runs in a worker process on a hasher unpickled for this task, which is closed before the
+    # task ends so its SQLite connection and thread pool do not outlive it
+    with hasher:
+        result = injest_sample(sample_name,project_json,analysis_json,project_directory,hasher)
+    return result, _hasher_stats(hasher)
+
+def _hasher_stats(hasher):
+    # the counts of a FileHasher, or of a FileHashCache and the FileHasher it reads files with
+    if isinstance(hasher,FileHashCache): return hasher.stats(), hasher.hasher.stats()
+    return hasher.stats(), None
+
+def _add_hasher_stats(hasher,stats):
+    hasher.add_stats(stats[0])
+    if stats[1] is not None: hasher.hasher.add_stats(stats[1])
+
+def _map_samples(function,sample_names,args,workers=1,pool_type='thread'):
+    """
+    Yield function(sample_name,*args) for each sample in order, optionally run on a pool
 
-def injest_sample(sample_name,project_json,analysis_json,project_directory):
+    Results come back in the order of sample_names, and the first exception in
+    that order is raised just as it would be when running serially.
+    """
+    if workers is None or workers <= 1:
+        for sample_name in sample_names:
+            yield function(sample_name,*args)
+        return
+    executor_class = ThreadPoolExecutor if pool_type == 'thread' else ProcessPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        futures = [executor.submit(function,sample_name,*args) for sample_name in sample_names]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # dont start samples that are still waiting if we stopped early
+            for future in futures: future.cancel()
+
+
+
+def injest_sample(sample_name,project_json,analysis_json,project_directory,hasher=None):
     """
     Read a path pointing to an InForm sample folder
 
     Args:
         phenotypes (list): a list of phenotypes to add to scored calls.  if none or not set, add them all
         overwrite (bool): if True allow the overwrite of a phenotype, if False, the phenotype must not exist in the scored calls
+        hasher (pythologist_schemas.hashing.FileHasher or FileHashCache): hashes files concurrently, and with a FileHashCache reuses digests of unchanged files
     Returns:
         CellDataFrame
     """
@@ -99,8 +336,8 @@ def injest_sample(sample_name,project_json,analysis_json,project_directory):
 
     
     # Confirm the inputs are valid
-    project_schema_validator.validate(project_json)
-    analysis_schema_validator.validate(analysis_json)
+    _schema_validator('project_schema_validator').validate(project_json)
+    _schema_validator('analysis_schema_validator').validate(analysis_json)
     # a. Make sure the project directory exists
     if not os.path.exists(project_directory):
         raise ValueError('Project directory "'+str(project_directory)+'" does not exist.')
@@ -137,85 +374,101 @@ def injest_sample(sample_name,project_json,analysis_json,project_directory):
             'exports':[
             ]
     }
+    annotation_index = _index_annotation_folder(sample_path)
     for export_path, export_name in [(os.path.join(sample_path,'INFORM_ANALYSIS',x),x) for x in expected_export_files]:
         # Inspect the export_path to make sure there isnt something funky inside of it
     
         # e. Make sure there aren't more folders burried deeper in these .. only files
 
         # f. Make sure all files present start with a prefix of the sample whose folder they are in that is followed by an underscore
-        _inspect_export_folder(export_path,sample_name,analysis_json)
+        export_index = _index_export_folder(export_path)
+        _inspect_export_folder(export_path,sample_name,analysis_json,export_index)
 
         export = {
             'export_name':export_name,
-            'images':_do_export_images(export_path,sample_name,analysis_json,sample_path)
+            'images':_do_export_images(export_path,sample_name,analysis_json,sample_path,hasher,export_index,annotation_index)
         }
         sample_files['exports'].append(export)
 
-    files_schema_validator.validate(instance=sample_files)
+    _resolve_digests(sample_files)
+    _schema_validator('files_schema_validator').validate(instance=sample_files)
     return sample_files, True, []
 
-def _inspect_export_folder(export_path,sample_name,analysis_json):
+def _resolve_digests(sample_files):
+    # Swap the digests still being computed on the hasher pool for their values
+    for export in sample_files['exports']:
+        for image in export['images']:
+            for d in list(image['image_data'].values())+image['image_annotations']:
+                if isinstance(d['sha256_hash'],Future):
+                    d['sha256_hash'] = d['sha256_hash'].result()
+
+def _index_export_folder(export_path):
+    """
+    List an export folder once and group its files by image
+
+    Returns:
+        export_index (dict): 'files' the visible entry names, 'folders' the visible folder names
+                             and 'images' the image names mapped to each image_data type and its file name
+    """
+    suffixes = _image_data_suffixes()
+    export_index = {'files':[],'folders':[],'images':{}}
+    with os.scandir(export_path) as entries:
+        for entry in entries:
+            if entry.name[0]=='.': continue
+            export_index['files'].append(entry.name)
+            if entry.is_dir(): export_index['folders'].append(entry.name)
+            for image_file_name, suffix in suffixes:
+                if len(entry.name) > len(suffix) and entry.name.endswith(suffix):
+                    export_index['images'].setdefault(entry.name[:-len(suffix)],{})[image_file_name] = entry.name
+    # keep the image_data types in schema order whatever order the directory was listed in
+    for image_name, image_files in export_index['images'].items():
+        export_index['images'][image_name] = dict([(x,image_files[x]) for x, suffix in suffixes if x in image_files])
+    return export_index
+
+def _image_data_suffixes():
+    # Get the various core image types we are interested in collecting from our image data from the schema itself.
+    _schema = _schema_validator('files_schema_validator').schema
+    return [(x,'_'+_schema['definitions']['image_data']['properties'][x]['allOf'][1]['properties']['suffix']['const']) \
+            for x in _schema['definitions']['image_data']['properties']]
+
+def _inspect_export_folder(export_path,sample_name,analysis_json,export_index=None):
     logger = logging.getLogger("insepct export folder")
-    prog = re.compile('^(.+)_cell_seg_data\.txt$')
-    observed_files = [x for x in os.listdir(export_path) if x[0]!='.']
+    if export_index is None: export_index = _index_export_folder(export_path)
+    observed_files = export_index['files']
     # Now look for individual frames
-    frame_names = [prog.match(x).group(1) for x in observed_files if prog.match(x)]
+    frame_names = set([x for x in export_index['images'] if 'cell_seg_data_txt' in export_index['images'][x]])
 
 
     # figure out if we are seeing
-    unwanted_folders = [x for x in observed_files if os.path.isdir(os.path.join(export_path,x))]
+    unwanted_folders = export_index['folders']
     if len(unwanted_folders) > 0:
         raise ValueError('Unexpected folder(s) present in the export folder '+str(unwanted_folders))
 
-    # See if there are any files present that are not part of an image with a cell seg data
+    # See if there are any files present that are not part of an image with a cell seg data.
+    # Every underscore marks a prefix that could be a frame name.
     for file_name in observed_files:
-        if len([x for x in frame_names if file_name.startswith(x+"_")])==0:
+        if not any([file_name[:i] in frame_names for i, c in enumerate(file_name) if c=='_']):
             raise ValueError("Found an unexpected file "+str(file_name)+" that isnt prefixed the same as the cell_seg_data files.")
 
 
     _temp, export_name = os.path.split(export_path)
-    misnamed = [x for x in frame_names if not x.startswith(sample_name+'_')]
+    misnamed = sorted([x for x in frame_names if not x.startswith(sample_name+'_')])
     if len(misnamed) > 0:
         logger.warning('Image file(s) do not start with the anticipated sample name "'+str(export_name)+'" "'+str(sample_name)+'" '+str(misnamed))
 
-    # g. Make sure there are not image frames that do not have a cell seg data
-    all_files = set(observed_files.copy())
-    for file_name in list(all_files):
-        for frame_name in frame_names:
-            if file_name.startswith(frame_name):
-                all_files-=set([file_name])
-    if len(all_files) > 0:
-        raise ValueError('It appears there may be some image ROIs that are missing their cell_seg_data.txt file '+str(all_files))
-
 def _sha256(fname):
-    hash_sha256 = hashlib.sha256()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_sha256.update(chunk)
-    return hash_sha256.hexdigest()
+    return sha256_file(fname)
 
 # Now for each sample read it into the files json-schema object
-def _do_export_images(export_path,sample_name,analysis_json,sample_path):
+def _do_export_images(export_path,sample_name,analysis_json,sample_path,hasher=None,export_index=None,annotation_index=None):
 
 
     # Some things we need to check 
     # get the image_file list
-    image_files = [x for x in os.listdir(export_path) if x[0]!='.']    
+    if export_index is None: export_index = _index_export_folder(export_path)
 
     # This will bey keyed by each of the image names and contain a dictionary of the primary images we are putting together pointing to their path
-    image_obj = {}
-
-    # Get the various core image types we are interested in collecting from our image data from the schema itself.
-    for image_file_name in files_schema_validator.schema['definitions']['image_data']['properties']:
-        image_file = files_schema_validator.schema['definitions']['image_data']['properties'][image_file_name]
-        suffix = image_file['allOf'][1]['properties']['suffix']['const']
-        rgxstr = suffix.replace('.','\.')
-        prog = re.compile('^(.+)_'+rgxstr+'$')
-        _dict = dict([(prog.match(x).group(1),x) for x in image_files if prog.match(x)])
-        for image_name in _dict.keys():
-            if image_name not in image_obj:
-                image_obj[image_name] = {}
-            image_obj[image_name][image_file_name] = _dict[image_name]
+    image_obj = export_index['images']
     image_output = {}
     for image_name in sorted(list(image_obj.keys())):
         #print(image_name)
@@ -226,70 +479,87 @@ def _do_export_images(export_path,sample_name,analysis_json,sample_path):
         }
         for image_file_name in image_obj[image_name]:
             file_path = os.path.join(export_path,image_obj[image_name][image_file_name])
-            _img['image_data'][image_file_name] = _generate_file_dictionary(file_path)
+            _img['image_data'][image_file_name] = _generate_file_dictionary(file_path,hasher)
         #print(_img)
         image_output[image_name] = _img
 
     # Load annotations if needed    
     # check against annotation_strategy_requirements
-    annotation_strategy = analysis_json['parameters']['region_annotation_strategy']
+    if annotation_index is None: annotation_index = _index_annotation_folder(sample_path)
     for image_name in sorted(list(image_obj.keys())):
-        if annotation_strategy == 'GIMP_TSI':
-            #print(image_output[image_name])
-            image_output[image_name]['image_annotations'] = _do_region_annotation_GIMP_TSI(image_name,sample_path,image_files)
-        elif annotation_strategy == 'GIMP_CUSTOM':
-            image_output[image_name]['image_annotations'] = _do_region_annotation_GIMP_CUSTOM(image_name,
-            	                                                                              sample_path,image_files,
-            	                                                                              analysis_json['parameters']['region_annotation_custom_label']
-            	                                                                              )
-        elif annotation_strategy == 'INFORM_ANALYSIS':
-            continue
-        elif annotation_strategy == 'NO_ANNOTATION':
-            continue
-        else:
-            raise ValueError("Unsupported Region Annotation Strategy. You shouldn't see this because of enum check")
+        image_output[image_name]['image_annotations'] = _do_region_annotations(image_name,sample_path,analysis_json,annotation_index,hasher)
 
     return list(image_output.values())
 
-def _do_region_annotation_GIMP_TSI(image_name,sample_path,image_files):
-    annotation_folder = os.path.join(sample_path,'ANNOTATIONS')
-    if not os.path.exists(annotation_folder) or not os.path.isdir(annotation_folder):
-        raise ValueError("Unable to locate ANNOTATIONS folder in the sample folder "+str(sample_path))
-    prospective1 = os.path.join(annotation_folder,image_name+'_Tumor.tif')
+def _index_annotation_folder(sample_path):
+    """
+    List the ANNOTATIONS folder of a sample once so every export can share it
+
+    Returns:
+        annotation_index (dict): 'names' the names in the folder or None if it is missing,
+                                 'images' each image name mapped to its (file_path, mask_label) annotations,
+                                 and 'files' the file dictionary of each annotation file read so far
+    """
+    try:
+        names = set(os.listdir(os.path.join(sample_path,'ANNOTATIONS')))
+    except OSError:
+        names = None
+    return {'names':names,'images':{},'files':{}}
+
+def _do_region_annotations(image_name,sample_path,analysis_json,annotation_index,hasher=None):
+    if image_name not in annotation_index['images']:
+        annotation_index['images'][image_name] = _plan_region_annotations(image_name,sample_path,analysis_json,annotation_index['names'])
     outputs = []
-    if not os.path.exists(prospective1):
-        raise ValueError("Required file is not present. "+str(prospective1))
-    d1 =  _generate_file_dictionary(prospective1)
-    d1['mask_label'] = 'Tumor'
-    outputs += [d1]
-
-    # This file is not required
-    prospective2 = os.path.join(annotation_folder,image_name+'_Invasive_Margin.tif')
-    if os.path.exists(prospective2):
-        d2 =  _generate_file_dictionary(prospective2)
-        d2['mask_label'] = 'TSI Line'
-        outputs += [d2]
+    for file_path, mask_label in annotation_index['images'][image_name]:
+        # exports of the same image share annotations, only read each file once per sample
+        if file_path not in annotation_index['files']:
+            annotation_index['files'][file_path] = _generate_file_dictionary(file_path,hasher)
+        d = dict(annotation_index['files'][file_path])
+        d['mask_label'] = mask_label
+        outputs += [d]
     return outputs
 
-def _do_region_annotation_GIMP_CUSTOM(image_name,sample_path,image_files,custom_label):
+def _plan_region_annotations(image_name,sample_path,analysis_json,annotation_names):
+    """
+    Find the annotation files of an image from a listing of the ANNOTATIONS folder
+
+    Args:
+        image_name (str): the image the annotations belong to
+        sample_path (str): path of the sample folder
+        analysis_json (dict): the analysis that sets the region annotation strategy
+        annotation_names (set): the names in the ANNOTATIONS folder, None if the folder is missing
+    Returns:
+        annotations (list): (file_path, mask_label) for each annotation file of the image
+    """
+    annotation_strategy = analysis_json['parameters']['region_annotation_strategy']
+    if annotation_strategy in ['INFORM_ANALYSIS','NO_ANNOTATION']: return []
+    if annotation_strategy not in ['GIMP_TSI','GIMP_CUSTOM']:
+        raise ValueError("Unsupported Region Annotation Strategy. You shouldn't see this because of enum check")
     annotation_folder = os.path.join(sample_path,'ANNOTATIONS')
-    if not os.path.exists(annotation_folder) or not os.path.isdir(annotation_folder):
+    if annotation_names is None:
         raise ValueError("Unable to locate ANNOTATIONS folder in the sample folder "+str(sample_path))
+    if annotation_strategy == 'GIMP_TSI':
+        if image_name+'_Tumor.tif' not in annotation_names:
+            raise ValueError("Required file is not present. "+str(os.path.join(annotation_folder,image_name+'_Tumor.tif')))
+        outputs = [(os.path.join(annotation_folder,image_name+'_Tumor.tif'),'Tumor')]
+        # This file is not required
+        if image_name+'_Invasive_Margin.tif' in annotation_names:
+            outputs += [(os.path.join(annotation_folder,image_name+'_Invasive_Margin.tif'),'TSI Line')]
+        return outputs
+    custom_label = analysis_json['parameters']['region_annotation_custom_label']
     prospective1 = os.path.join(annotation_folder,image_name+'_'+str(custom_label)+'.tif')
-    outputs = []
-    if not os.path.exists(prospective1):
+    if os.path.basename(prospective1) not in annotation_names:
         raise ValueError("Required custom annotation file is not present. "+str(prospective1))
-    d1 =  _generate_file_dictionary(prospective1)
-    d1['mask_label'] = custom_label
-    outputs += [d1]
-    return outputs
+    return [(prospective1,custom_label)]
 
-def _generate_file_dictionary(file_path):
+def _generate_file_dictionary(file_path,hasher=None):
     fileStatsObj = os.stat(file_path)
     modificationTime = time.ctime(fileStatsObj[stat.ST_MTIME])
     d = {
             'file_path': file_path,
-            'sha256_hash':_sha256(file_path),
-            'last_modified_timestamp':modificationTime
+            'sha256_hash':_sha256(file_path) if hasher is None else hasher.submit(file_path,fileStatsObj),
+            'last_modified_timestamp':modificationTime,
+            'file_size':fileStatsObj.st_size,
+            'last_modified_ns':fileStatsObj.st_mtime_ns
     }
     return d
\ No newline at end of file
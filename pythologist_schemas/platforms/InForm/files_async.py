@@ -0,0 +1,171 @@
+"""
+Injest InForm sample folders with asyncio.
+
+On network filesystems every stat, listdir and open is a round trip.  This
+backend runs those calls on a bounded thread pool from an event loop so the
+round trips of many files, exports and samples overlap.  It produces the same
+files.json objects, and raises the same errors, as injest_sample.
+"""
+import os, asyncio, logging
+from concurrent.futures import ThreadPoolExecutor
+from pythologist_schemas.platforms.InForm.files import _schema_validator, _project_sample_names, _index_export_folder, \
+                                                       _inspect_export_folder, _index_annotation_folder, _plan_region_annotations, \
+                                                       _generate_file_dictionary, _resolve_digests
+
+DEFAULT_CONCURRENCY = 16
+
+async def injest_project_async(project_json,analysis_json,project_directory,concurrency=DEFAULT_CONCURRENCY,hasher=None):
+    """
+    Read a path pointing to multiple InForm sample folders with asyncio
+
+    Run it with asyncio.run, or use injest_project with pool_type='asyncio'.
+
+    Args:
+        project_json (dict): The json object as a valid project schema
+        analysis_json (dict): The json object as a valid analysis schema
+        concurrency (int): most filesystem calls to have waiting at once
+        hasher (pythologist_schemas.hashing.FileHasher or FileHashCache): hashes the files, if None hash them on the filesystem threads
+    Returns:
+        samples (list): A list of json objects for the samples in the project in sample manifest order
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        sample_names = await _call(executor,_project_sample_names,project_json,analysis_json,project_directory)
+    results = await injest_samples_async(sample_names,project_json,analysis_json,project_directory,concurrency,hasher)
+    return [x[0] for x in results], all([x[1] for x in results]), [y for x in results for y in x[2]]
+
+async def injest_samples_async(sample_names,project_json,analysis_json,project_directory,concurrency=DEFAULT_CONCURRENCY,hasher=None):
+    """
+    Injest several samples at once on a shared pool of filesystem threads
+
+    Returns:
+        results (list): the (sample_json, success, errors) of each sample in the order of sample_names,
+                        the first error in that order is raised
+    """
+    if concurrency is None or concurrency < 1: concurrency = 1
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(*[injest_sample_async(x,project_json,analysis_json,project_directory,hasher=hasher,_executor=executor) \
+                                         for x in sample_names],return_exceptions=True)
+    for result in results:
+        if isinstance(result,BaseException): raise result
+    return results
+
+async def injest_sample_async(sample_name,project_json,analysis_json,project_directory,concurrency=DEFAULT_CONCURRENCY,hasher=None,_executor=None):
+    """
+    Read a path pointing to an InForm sample folder with asyncio
+
+    Args:
+        sample_name (str): the sample folder to read
+        project_json (dict): The json object as a valid project schema
+        analysis_json (dict): The json object as a valid analysis schema
+        concurrency (int): most filesystem calls to have waiting at once, when not sharing a pool
+        hasher (pythologist_schemas.hashing.FileHasher or FileHashCache): hashes the files, if None hash them on the filesystem threads
+    Returns:
+        sample_files (dict): the files.json object of the sample
+        success (bool): True
+        errors (list): empty
+    """
+    if _executor is None:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await injest_sample_async(sample_name,project_json,analysis_json,project_directory,hasher=hasher,_executor=executor)
+    logger = logging.getLogger("injest sample async")
+
+    # Confirm the inputs are valid
+    _schema_validator('project_schema_validator').validate(project_json)
+    _schema_validator('analysis_schema_validator').validate(analysis_json)
+    sample_path = os.path.join(project_directory,'SAMPLES',sample_name)
+    inform_analysis_path = os.path.join(sample_path,'INFORM_ANALYSIS')
+    # ask for everything that doesn't depend on another answer at once
+    project_exists, project_isdir, sample_exists, inform_analysis_listing, annotation_index = await asyncio.gather(
+        _call(_executor,os.path.exists,project_directory),
+        _call(_executor,os.path.isdir,project_directory),
+        _call(_executor,os.path.exists,sample_path),
+        _call(_executor,_list_folder,inform_analysis_path),
+        _call(_executor,_index_annotation_folder,sample_path)
+    )
+    # a. Make sure the project directory exists
+    if not project_exists:
+        raise ValueError('Project directory "'+str(project_directory)+'" does not exist.')
+    if not project_isdir:
+        raise ValueError('Project directory path "'+str(project_directory)+'" does not a directory.')
+    if not sample_exists:
+        raise ValueError(str(sample_path)+' sample path does not exist')
+    if sample_name not in [x['sample'] for x in project_json['samples']]:
+        raise ValueError(str(sample_name)+ ' not in sample allow list from project definition')
+    if isinstance(inform_analysis_listing,OSError): raise inform_analysis_listing
+
+    # d. Make sure all export folders and only those export folders are present in each sample folder
+    expected_export_files = [x['export_name'] for x in analysis_json['inform_exports']]
+    observed_files = [x for x, is_dir in inform_analysis_listing]
+    for observed_file, is_dir in inform_analysis_listing:
+        if not is_dir:
+            raise ValueError('File is present in the Sample folder that is not an InForm Export Folder '+str(observed_file)+' is not among '+str(expected_export_files))
+    missing = sorted(list(set(expected_export_files)-set(observed_files)))
+    if len(missing) > 0:
+        raise ValueError('InForm Export Folder(s) are missing from the sample path "'+sample_path+'" that are expected '+str(missing))
+    unwelcome = sorted(list(set(observed_files)-set(expected_export_files)))
+    if len(unwelcome) > 0:
+        raise ValueError('Unexpected folder(s) are present in the sample path "'+sample_path+'" '+str(unwelcome))
+
+    export_paths = [os.path.join(inform_analysis_path,x) for x in expected_export_files]
+    export_indexes = await asyncio.gather(*[_call(_executor,_index_export_folder,x) for x in export_paths])
+
+    # Work out every file of the sample in the order injest_sample checks them so the same error comes first
+    exports = []
+    for export_path, export_name, export_index in zip(export_paths,expected_export_files,export_indexes):
+        _inspect_export_folder(export_path,sample_name,analysis_json,export_index)
+        images = []
+        for image_name in sorted(list(export_index['images'].keys())):
+            image_data = [(x,os.path.join(export_path,y)) for x, y in export_index['images'][image_name].items()]
+            images.append((image_name,image_data,_plan_region_annotations(image_name,sample_path,analysis_json,annotation_index['names'])))
+        exports.append((export_name,images))
+
+    # stat and hash each file once, annotations can be shared by several exports
+    file_paths = list(dict.fromkeys([y for export_name, images in exports for image_name, image_data, annotations in images \
+                                       for y in [x[1] for x in image_data]+[x[0] for x in annotations]]))
+    logger.info(str(sample_name)+" reading "+str(len(file_paths))+" files")
+    file_dictionaries = dict(zip(file_paths,await asyncio.gather(*[_call(_executor,_generate_file_dictionary,x,hasher) for x in file_paths])))
+
+    # Set up the output file
+    sample_files = {
+            'sample_name':sample_name,
+            'sample_directory':sample_path,
+            'exports':[]
+    }
+    for export_name, images in exports:
+        export = {
+            'export_name':export_name,
+            'images':[]
+        }
+        for image_name, image_data, annotations in images:
+            _img = {
+                'image_name':image_name,
+                'image_data':dict([(x,dict(file_dictionaries[y])) for x, y in image_data]),
+                'image_annotations':[]
+            }
+            for file_path, mask_label in annotations:
+                d = dict(file_dictionaries[file_path])
+                d['mask_label'] = mask_label
+                _img['image_annotations'].append(d)
+            export['images'].append(_img)
+        sample_files['exports'].append(export)
+
+    await asyncio.gather(*[asyncio.wrap_future(x) for x in _pending_digests(sample_files)])
+    _resolve_digests(sample_files)
+    _schema_validator('files_schema_validator').validate(instance=sample_files)
+    return sample_files, True, []
+
+async def _call(executor,function,*args):
+    return await asyncio.get_running_loop().run_in_executor(executor,function,*args)
+
+def _list_folder(folder_path):
+    # the visible names in a folder and whether each is a folder, or the error from listing it
+    try:
+        with os.scandir(folder_path) as entries:
+            return [(x.name,x.is_dir()) for x in entries if x.name[0]!='.']
+    except OSError as e:
+        return e
+
+def _pending_digests(sample_files):
+    # the futures of digests still being computed by a hasher
+    return [d['sha256_hash'] for export in sample_files['exports'] for image in export['images'] \
+            for d in list(image['image_data'].values())+image['image_annotations'] if not isinstance(d['sha256_hash'],str)]
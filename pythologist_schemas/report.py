@@ -2,14 +2,25 @@ import json
 from importlib_resources import files
 from pythologist_schemas import get_validator
 
-report_definition_schema_validator = get_validator(files('schema_data.inputs').joinpath('report_definition.json'))
-report_schema_validator = get_validator(files('schema_data.inputs').joinpath('report.json'))
+# Validators are loaded on first use (get_validator caches them)
+_schema_validator_files = {
+    'report_definition_schema_validator':'report_definition.json',
+    'report_schema_validator':'report.json'
+}
+
+def _schema_validator(name):
+    return get_validator(files('schema_data.inputs').joinpath(_schema_validator_files[name]))
+
+def __getattr__(name):
+    # keep the former module-level validator globals available without loading them at import
+    if name in _schema_validator_files: return _schema_validator(name)
+    raise AttributeError("module "+repr(__name__)+" has no attribute "+repr(name))
 
 def convert_report_definition_to_report(report_definition_json):
     """
     Take a report_definition and return a report in valid json format
     """
-    report_definition_schema_validator.validate(report_definition_json)
+    _schema_validator('report_definition_schema_validator').validate(report_definition_json)
 
     output = json.loads(json.dumps(report_definition_json)) # get deep copy of the definition to modify.. parameters will come directly from that
     # Do the regions
@@ -45,5 +56,5 @@ def convert_report_definition_to_report(report_definition_json):
             output['population_percentages'][i]['denominator_binary_phenotypes'] = \
                 [{'target_name':x.strip()[:-1].strip(),'filter_direction':x.strip()[-1]} for x in measure['denominator_binary_phenotypes'].split(',')]
 
-    report_schema_validator.validate(output)
+    _schema_validator('report_schema_validator').validate(output)
     return output
\ No newline at end of file
@@ -1,4 +1,3 @@
-from openpyxl import Workbook, load_workbook
 #from importlib_resources import files
 from pythologist_schemas import get_validator
 
@@ -13,6 +12,7 @@ def excel_to_json(excel_template_path,
     into a json object compatible with its respective json-schema.
     Return back the json object or None, whether its valid or not, and any errors.
     """
+    from openpyxl import load_workbook
     #_fname = files('schema_data.inputs.platforms.InForm').joinpath('analysis.json')
     _validator = get_validator(json_schema_path)
     wb = load_workbook(excel_template_path)
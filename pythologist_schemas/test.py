@@ -1,5 +1,323 @@
-import unittest, os, json,sys
-from pythologist_schemas import get_validator
+import unittest, os, io, json,sys, shutil, tempfile, random, copy, subprocess, hashlib, time, logging, uuid, argparse, pickle
+from importlib_resources import files
+from jsonschema import ValidationError
+from pythologist_schemas import get_validator, clear_validator_cache, VALIDATOR_ENGINES
+from pythologist_schemas.compiler import CompiledValidator, load_source, _source_header
+from pythologist_schemas.platforms.InForm.files import injest_project, injest_sample, restage_project
+from pythologist_schemas.platforms.InForm import files as files_module
+from pythologist_schemas.latency import simulated_latency
+from pythologist_schemas.json_stream import JSONStreamReader
+from pythologist_schemas.compression import open_json, detect_compression, compression_from_extension
+from pythologist_schemas.measurements import SampleMeasurements, FRAME_COUNT_COLUMNS, SAMPLE_COUNT_COLUMNS, FRAME_PERCENTAGE_COLUMNS, SAMPLE_PERCENTAGE_COLUMNS
+from pythologist_schemas.cli import run_tool, report_tool
+from pythologist_schemas.hashing import FileHasher, FileHashCache, sha256_file
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+_package_dir = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+
+def _generate_instance(schema,root,rng,depth=0):
+    # Build a random instance that mostly follows the schema
+    if not isinstance(schema,dict): return None
+    if '$ref' in schema:
+        node = root
+        for part in schema['$ref'][2:].split('/'): node = node[part]
+        return _generate_instance(node,root,rng,depth)
+    if 'const' in schema: return copy.deepcopy(schema['const'])
+    if 'enum' in schema: return copy.deepcopy(rng.choice(schema['enum']))
+    if 'allOf' in schema:
+        output = {}
+        for subschema in schema['allOf']:
+            _part = _generate_instance(subschema,root,rng,depth)
+            if isinstance(_part,dict): output.update(_part)
+        return output
+    if 'anyOf' in schema: return _generate_instance(rng.choice(schema['anyOf']),root,rng,depth)
+    _type = schema.get('type','object')
+    if isinstance(_type,list): _type = rng.choice(_type)
+    if _type == 'object':
+        output = {}
+        for k, v in schema.get('properties',{}).items():
+            if k in schema.get('required',[]) or (depth < 4 and rng.random() < 0.5):
+                output[k] = _generate_instance(v,root,rng,depth+1)
+        return output
+    if _type == 'array':
+        if depth >= 4: return []
+        return [_generate_instance(schema.get('items',{'type':'string'}),root,rng,depth+1) \
+                for x in range(schema.get('minItems',0),rng.randint(schema.get('minItems',0),3)+1)]
+    if _type == 'string': return rng.choice(['Tumor','Stroma','CD8','x'])+str(rng.randint(0,1000))
+    if _type == 'integer': return rng.randint(-5,5)
+    if _type == 'number': return rng.choice([rng.random(),rng.randint(0,5)])
+    if _type == 'boolean': return rng.random() < 0.5
+    return None
+
+def _mutate_instance(instance,rng):
+    # Replace, drop or add one random element somewhere in the instance
+    output = copy.deepcopy(instance)
+    node = output
+    while True:
+        children = list(node.keys()) if isinstance(node,dict) else list(range(len(node))) if isinstance(node,list) else []
+        if len(children) == 0 or rng.random() < 0.3: break
+        key = rng.choice(children)
+        if not isinstance(node[key],(dict,list)) or rng.random() < 0.3:
+            choice = rng.random()
+            if choice < 0.3 and isinstance(node,dict): del node[key]
+            elif choice < 0.4 and isinstance(node,dict): node['unexpected_key'] = 1
+            else: node[key] = rng.choice([None,1,1.0,1.5,True,'x',[],{},[1,'x'],{'a':1}])
+            return output
+        node = node[key]
+    return rng.choice([None,1,'x',[],{}])
+
+# Console script modules in setup.py
+_entry_point_modules = ['pythologist_schemas.cli.stage_tool','pythologist_schemas.cli.template_tool',
+                        'pythologist_schemas.cli.run_tool','pythologist_schemas.cli.report_tool']
+
+# Modules that must not be loaded just to start a console script
+_deferred_modules = ['pandas','numpy','pyarrow','pythologist','pythologist_reader','pythologist_image_utilities','openpyxl','jsonschema']
+
+def _imported_modules(module_name):
+    # Return the names in sys.modules after importing a module in a fresh interpreter
+    result = subprocess.run([sys.executable,'-c','import sys, json, '+module_name+'; print(json.dumps(sorted(sys.modules)))'],
+                            cwd=_package_dir,stdout=subprocess.PIPE,universal_newlines=True,check=True)
+    return set(json.loads(result.stdout))
+
+def _make_inform_project(project_directory,sample_names,frame_count=3,exports=['EXPORT1','EXPORT2'],strategy='GIMP_TSI',
+                         extra_suffixes=[]):
+    # Lay out a small InForm project folder and return its project and analysis json,
+    # extra_suffixes are other files InForm writes for each frame that are not staged
+    for sample_name in sample_names:
+        for export_name in exports:
+            export_path = os.path.join(project_directory,'SAMPLES',sample_name,'INFORM_ANALYSIS',export_name)
+            os.makedirs(export_path)
+            for i in range(frame_count):
+                for suffix in ['cell_seg_data.txt','component_data.tif','binary_seg_maps.tif','score_data.txt']+extra_suffixes:
+                    with open(os.path.join(export_path,sample_name+'_['+str(i)+']_'+suffix),'wt') as of:
+                        of.write(sample_name+export_name+str(i)+suffix)
+        annotation_path = os.path.join(project_directory,'SAMPLES',sample_name,'ANNOTATIONS')
+        os.makedirs(annotation_path)
+        for i in range(frame_count):
+            for suffix in ['Tumor.tif','Invasive_Margin.tif']:
+                if suffix == 'Invasive_Margin.tif' and i == 0: continue
+                with open(os.path.join(annotation_path,sample_name+'_['+str(i)+']_'+suffix),'wt') as of:
+                    of.write(sample_name+str(i)+suffix)
+    project_json = {
+        'samples':[{'sample':x} for x in sample_names],
+        'parameters':{'project_name':'test','microns_per_pixel':0.496}
+    }
+    analysis_json = {
+        'inform_exports':[{'export_name':x,'primary_phenotyping':i==0} for i, x in enumerate(exports)],
+        'mutually_exclusive_phenotypes':[],
+        'binary_phenotypes':[],
+        'regions':[],
+        'parameters':{
+            'analysis_name':'test',
+            'analysis_version':'1',
+            'region_annotation_strategy':strategy,
+            'region_annotation_custom_label':'Tumor' if strategy=='GIMP_CUSTOM' else None
+        }
+    }
+    return project_json, analysis_json
+
+def _fake_execute_sample(files_json,inputs,run_id,verbose=False,cache_directory=None):
+    # stands in for run_tool.execute_sample which needs pythologist
+    logger = logging.getLogger(files_json['sample_name'])
+    for i in range(3):
+        logger.warning(files_json['sample_name']+' step '+str(i))
+        time.sleep(random.random()*0.01)
+    if files_json['sample_name'] == inputs['fail']: raise KeyError('bad sample')
+    _fake_execute_sample.calls.append(files_json['sample_name'])
+    return {'sample_name':files_json['sample_name'],'run_id':run_id}
+_fake_execute_sample.calls = []
+
+def _fake_cell_data_frame(rows):
+    # a pandas stand in for the parts of a pythologist CellDataFrame the run tool reads
+    import pandas as pd
+    class _FakeCellDataFrame(pd.DataFrame):
+        @property
+        def _constructor(self):
+            return _FakeCellDataFrame
+        def get_measured_regions(self):
+            _frames = self.drop_duplicates(subset=['sample_name','frame_name'])
+            return pd.DataFrame([{'frame_name':x,'region_label':k,'region_area_pixels':v} \
+                                 for x, regions in zip(_frames['frame_name'],_frames['regions']) for k, v in regions.items()])
+        def merge_scores(self,df_addition,on):
+            # as pythologist merges the calls of two exports
+            names = sorted(set().union(*[x.keys() for x in self['scored_calls']]))
+            addition_names = sorted(set().union(*[x.keys() for x in df_addition['scored_calls']]))
+            df_addition = df_addition[['scored_calls']+on].rename(columns={'scored_calls':'_addition'})
+            df_addition['_key'] = 1
+            df = self.merge(df_addition,on=on,how='left')
+            df['scored_calls'] = [{**dict((k,x[k]) for k in names),**({} if y!=y else dict((k,y[k]) for k in addition_names))} \
+                                  for x, y in zip(df['scored_calls'],df['_addition'])]
+            df = df.drop(columns=['_addition'])
+            return df.drop(columns='_key'), df[df['_key'].isna()].drop(columns='_key')
+    return _FakeCellDataFrame(rows)
+
+def _cell_data_frame(cells, regions, microns_per_pixel=0.5):
+    # a pythologist CellDataFrame of one sample from (frame_name, region_label, phenotype_label, scored_calls) cells
+    import pandas as pd
+    from pythologist import CellDataFrame
+    phenotypes = sorted(set([x[2] for x in cells]))
+    frame_ids = dict([(x,i) for i, x in enumerate(regions)])
+    cdf = CellDataFrame(pd.DataFrame([OrderedDict([
+        ('project_id','P'),('project_name','P'),('sample_id','S'),('sample_name','S'),
+        ('frame_id',frame_ids[frame_name]),('frame_name',frame_name),('frame_shape',(1000,1000)),
+        ('cell_index',i),('x',i%1000),('y',i//1000),('cell_area',10),('edge_length',1),('neighbors',{}),
+        ('phenotype_calls',dict([(x,int(x==phenotype_label)) for x in phenotypes])),('phenotype_label',phenotype_label),
+        ('scored_calls',scored_calls),('regions',regions[frame_name]),('region_label',region_label)
+    ]) for i, (frame_name, region_label, phenotype_label, scored_calls) in enumerate(cells)]))
+    cdf.microns_per_pixel = microns_per_pixel
+    return cdf
+
+def _reference_report_tables(cdf, report):
+    # how the run tool measured a report before SampleMeasurements, one report region at a time with
+    # pythologist's combine_regions and counts, in the four tables of SampleMeasurements.report_tables
+    import pandas as pd
+    from pythologist import SubsetLogic as SL, PercentageLogic as PL
+    def _logic(phenotypes, binary_phenotypes, label=None):
+        return SL(phenotypes = phenotypes,
+                  scored_calls = dict([(x['target_name'],x['filter_direction']) for x in binary_phenotypes]),
+                  label = label
+                 )
+    density_populations = [_logic(x['mutually_exclusive_phenotypes'],x['binary_phenotypes'],x['population_name']) \
+                           for x in report['population_densities']]
+    percentage_populations = [PL(numerator = _logic(x['numerator_mutually_exclusive_phenotypes'],x['numerator_binary_phenotypes']),
+                                 denominator = _logic(x['denominator_mutually_exclusive_phenotypes'],x['denominator_binary_phenotypes']),
+                                 label = x['population_name']
+                                ) for x in report['population_percentages']]
+    tables = [[],[],[],[]]
+    for report_region_row in report['region_selection']:
+        region_name = report_region_row['report_region_name']
+        counts = cdf.combine_regions(report_region_row['regions_to_combine'],region_name).\
+                     counts(minimum_region_size_pixels=report['parameters']['minimum_density_region_size_pixels'],
+                            minimum_denominator_count=report['parameters']['minimum_denominator_count'])
+        measured = []
+        if len(density_populations) > 0:
+            measured += [(0,counts.frame_counts(subsets=density_populations)),(1,counts.sample_counts(subsets=density_populations))]
+        if len(percentage_populations) > 0:
+            measured += [(2,counts.frame_percentages(percentage_logic_list=percentage_populations)),
+                         (3,counts.sample_percentages(percentage_logic_list=percentage_populations))]
+        for i, table in measured:
+            tables[i].append(table.loc[table['region_label']==region_name])
+    return tuple([(pd.concat(x,ignore_index=True) if len(x) > 0 else pd.DataFrame(columns=columns))[columns].reset_index(drop=True) \
+                  for x, columns in zip(tables,[FRAME_COUNT_COLUMNS,SAMPLE_COUNT_COLUMNS,FRAME_PERCENTAGE_COLUMNS,SAMPLE_PERCENTAGE_COLUMNS])])
+
+def _fake_report_output(sample_count=2,image_count=3,cell_count=50,seed=0):
+    # a run output with random measurements in the shape the run tool writes
+    rng = random.Random(seed)
+    def _value(kind):
+        if kind == 'integer': return rng.randint(0,1000)
+        if kind == 'nullable' and rng.random() < 0.1: return None
+        return rng.random()*100
+    def _rows(columns):
+        rows = []
+        for region_name in ['Tumor','Stroma']:
+            for population_name in ['CD8+','PD1+ CD8+']:
+                row = {'region_name':region_name,'population_name':population_name}
+                for column, kind in columns:
+                    row[column] = _value(kind)
+                row['measure_qc_pass'] = rng.random() < 0.8
+                rows.append(row)
+        return rows
+    output = {
+        'run_id':'run','time':'now','project_name':'p','report_name':'r','report_version':'1',
+        'analysis_name':'a','analysis_version':'1','panel_name':'p','panel_version':'1','sample_outputs':[]
+    }
+    for i in range(sample_count):
+        sample_name = 'S'+str(i)
+        sample_output = {
+            'sample_name':sample_name,
+            'sample_reports':{
+                'sample_cumulative_count_densities':_rows([('image_count','integer'),('cumulative_region_area_pixels','integer'),('cumulative_region_area_mm2','number'),
+                                                           ('cumulative_count','integer'),('cumulative_density_mm2','nullable')]),
+                'sample_aggregate_count_densities':_rows([('image_count','integer'),('aggregate_measured_image_count','integer'),('aggregate_mean_density_mm2','nullable'),
+                                                          ('aggregate_stddev_density_mm2','nullable'),('aggregate_stderr_density_mm2','nullable')]),
+                'sample_cumulative_count_percentages':_rows([('image_count','integer'),('cumulative_numerator_count','integer'),('cumulative_denominator_count','integer'),
+                                                             ('cumulative_fraction','nullable'),('cumulative_percent','nullable')]),
+                'sample_aggregate_count_percentages':_rows([('image_count','integer'),('aggregate_measured_image_count','integer'),
+                                                            ('aggregate_mean_fraction','nullable'),('aggregate_stddev_fraction','nullable'),('aggregate_stderr_fraction','nullable'),
+                                                            ('aggregate_mean_percent','nullable'),('aggregate_stddev_percent','nullable'),('aggregate_stderr_percent','nullable')])
+            },
+            'images':[],
+            'intermediate_files':{'project_h5':None,'celldataframe_h5':None}
+        }
+        for j in range(image_count):
+            sample_output['images'].append({
+                'image_name':sample_name+'_['+str(j)+']',
+                'image_size_pixels':{'y':1000,'x':1340},
+                'microns_per_pixel':0.496,
+                'image_reports':{
+                    'image_count_densities':_rows([('region_area_pixels','integer'),('region_area_mm2','number'),('count','integer'),('density_mm2','nullable')]),
+                    'image_count_percentages':_rows([('numerator_count','integer'),('denominator_count','integer'),('fraction','nullable'),('percent','nullable')])
+                },
+                'phenotype_map':{
+                    'column_names':['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'],
+                    'rows':[[k,rng.randint(0,1339),rng.randint(0,999),rng.choice(['Tumor','Stroma']),rng.choice(['CD8+','OTHER']),
+                             [['PD1',rng.randint(0,1)],['PDL1',rng.randint(0,1)]]] for k in range(cell_count)],
+                    'mutually_exclusive_phenotypes':['CD8+','OTHER']
+                },
+                'region_sizes':[{'region_name':'Tumor','region_area_pixels':1000},{'region_name':'Stroma','region_area_pixels':2000}]
+            })
+        output['sample_outputs'].append(sample_output)
+    return output
+
+def _random_json(rng,depth=0):
+    # a json value with the awkward parts, escapes, unicode, exponents and nesting
+    kind = rng.choice(['object','array','string','number','literal'] if depth < 4 else ['string','number','literal'])
+    if kind == 'object':
+        return dict([(_random_string(rng),_random_json(rng,depth+1)) for i in range(rng.randint(0,4))])
+    if kind == 'array':
+        return [_random_json(rng,depth+1) for i in range(rng.randint(0,4))]
+    if kind == 'string': return _random_string(rng)
+    if kind == 'number': return rng.choice([rng.randint(-10**12,10**12),rng.random()*10**rng.randint(-20,20)])
+    return rng.choice([True,False,None])
+
+def _random_string(rng):
+    return ''.join([rng.choice(['a','Z','"','\\','/','\n','{',']',',',':','\u00e9','\u2603',' ']) for i in range(rng.randint(0,12))])
+
+def _run_output_args(output_json,compression=None,level=None):
+    # the arguments of the run tool that _write_outputs reads
+    return argparse.Namespace(output_json=output_json,parquet_sidecar=None,compression=compression,compression_level=level)
+
+def _has_module(module_name):
+    try:
+        __import__(module_name)
+    except ImportError:
+        return False
+    return True
+
+def _isna(value):
+    import pandas as pd
+    return pd.isna(value)
+
+class _DirectoryTestCase(unittest.TestCase):
+    # a test case with a temporary directory for each test
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class _FakeProject(object):
+    # stands in for a pythologist_reader project that saves itself to h5
+    def to_hdf(self,path,overwrite=False):
+        with open(path,'wb') as of: of.write(b'project')
+
+def _fake_recompute_sample(previous_output,inputs,run_id,verbose=False,cache_directory=None):
+    # a stand in for recompute_sample that records what it was given
+    outputs = [{'sample_name':previous_output['sample_name'],'run_id':run_id,'report_name':x['parameters']['report_name'],
+                'images':[sorted(x.keys()) for x in previous_output['images']]} for x in run_tool._reports(inputs)]
+    return outputs if isinstance(inputs['report'],list) else outputs[0]
+
+_cache_environment = {}
+def setUpModule():
+    # keep compiled validators out of the user cache directory
+    _cache_environment['previous'] = os.environ.get('PYTHOLOGIST_SCHEMAS_CACHE_DIR')
+    _cache_environment['directory'] = tempfile.mkdtemp()
+    os.environ['PYTHOLOGIST_SCHEMAS_CACHE_DIR'] = _cache_environment['directory']
+
+def tearDownModule():
+    if _cache_environment['previous'] is None: del os.environ['PYTHOLOGIST_SCHEMAS_CACHE_DIR']
+    else: os.environ['PYTHOLOGIST_SCHEMAS_CACHE_DIR'] = _cache_environment['previous']
+    shutil.rmtree(_cache_environment['directory'])
 
 class TestValidSchemas(unittest.TestCase):
     pass
@@ -103,6 +421,1160 @@ for root,dirs,files in os.walk(schemas_dir):
         test_method.__name__ = 'testing if example file is validated example of the json-schema: '+example_path
         setattr(TestExampleSchemas,test_method.__name__,test_method)
 
+class TestValidatorCache(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        clear_validator_cache()
+    def test_validator_is_shared(self):
+        _fname = files('schema_data.inputs').joinpath('panel.json')
+        self.assertIs(get_validator(_fname),get_validator(_fname))
+        self.assertIsNot(get_validator(_fname),get_validator(_fname,use_cache=False))
+    def test_clear_cache(self):
+        _fname = files('schema_data.inputs').joinpath('panel.json')
+        validator = get_validator(_fname)
+        clear_validator_cache(_fname)
+        self.assertIsNot(validator,get_validator(_fname))
+    def test_modified_schema_is_reloaded(self):
+        _fname = os.path.join(self.directory,'schema.json')
+        with open(_fname,'wt') as of:
+            of.write(json.dumps({'type':'string'}))
+        validator = get_validator(_fname)
+        with open(_fname,'wt') as of:
+            of.write(json.dumps({'type':'integer'}))
+        os.utime(_fname,ns=(0,os.stat(_fname).st_mtime_ns+1000000))
+        self.assertIsNot(validator,get_validator(_fname))
+        self.assertTrue(get_validator(_fname).is_valid(1))
+    def test_validator_per_thread(self):
+        _fname = files('schema_data.inputs').joinpath('panel.json')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            validator = executor.submit(get_validator,_fname).result()
+            self.assertIs(validator,executor.submit(get_validator,_fname).result())
+            self.assertIsNot(validator,get_validator(_fname))
+            clear_validator_cache(_fname)
+            self.assertIsNot(validator,executor.submit(get_validator,_fname).result())
+    def test_source_cached_from_threads(self):
+        # threads of one process writing the same module each use their own temporary file, every
+        # thread is held at the rename so all of them have written before the first one is moved in place
+        import threading
+        schema = json.loads(files('schema_data.inputs').joinpath('panel.json').read_text())
+        barrier, renamed, replace = threading.Barrier(4,timeout=30), [], os.replace
+        def _replace(source, destination):
+            renamed.append(source)
+            barrier.wait()
+            return replace(source,destination)
+        os.replace = _replace
+        try:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                sources = list(executor.map(lambda x: load_source(schema,self.directory)[0],range(4)))
+        finally:
+            os.replace = replace
+        self.assertEqual(4,len(set(renamed)))
+        self.assertEqual(1,len(set(sources)))
+        cached = os.listdir(self.directory)
+        self.assertEqual(1,len(cached),cached)
+        with open(os.path.join(self.directory,cached[0]),'rt') as inf:
+            self.assertEqual(_source_header(sources[0])+sources[0],inf.read())
+
+class TestCompiledValidatorParity(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_directory = tempfile.mkdtemp()
+        cls.schemas = []
+        for root,dirs,_files in os.walk(os.path.join(_package_dir,'schema_data')):
+            cls.schemas += [os.path.join(root,x) for x in sorted(_files) if x.endswith('.json')]
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_directory)
+    def assertParity(self,reference,compiled,instance):
+        self.assertEqual(reference.is_valid(instance),compiled.is_valid(instance),json.dumps(instance))
+        if reference.is_valid(instance): return
+        with self.assertRaises(ValidationError) as expected:
+            reference.validate(instance)
+        with self.assertRaises(ValidationError) as observed:
+            compiled.validate(instance)
+        self.assertEqual(expected.exception.message,observed.exception.message)
+    def test_examples(self):
+        examples = []
+        for root,dirs,_files in os.walk(os.path.join(_package_dir,'examples')):
+            examples += [os.path.join(root,x) for x in sorted(_files) if x.endswith('.json')]
+        self.assertGreater(len(examples),0)
+        for schema_path in self.schemas:
+            reference = get_validator(schema_path)
+            compiled = get_validator(schema_path,engine='compiled')
+            for example_path in examples:
+                with open(example_path,'rt') as inf:
+                    self.assertParity(reference,compiled,json.loads(inf.read()))
+    def test_generated_instances(self):
+        rng = random.Random(0)
+        for schema_path in self.schemas:
+            reference = get_validator(schema_path)
+            compiled = get_validator(schema_path,engine='compiled')
+            for i in range(50):
+                instance = _generate_instance(reference.schema,reference.schema,rng)
+                self.assertParity(reference,compiled,instance)
+                for j in range(5):
+                    self.assertParity(reference,compiled,_mutate_instance(instance,rng))
+    def test_keywords(self):
+        schema = {
+            'definitions':{'node':{'type':'object','properties':{'child':{'$ref':'#/definitions/node'}},'additionalProperties':False}},
+            'type':'object',
+            'properties':{
+                'name':{'type':'string','pattern':'^[A-Z]','minLength':2,'maxLength':5},
+                'count':{'type':'integer','minimum':0,'exclusiveMaximum':10,'multipleOf':2},
+                'ratio':{'type':'number','multipleOf':0.5},
+                'tags':{'type':'array','uniqueItems':True,'maxItems':3,'contains':{'const':1}},
+                'pair':{'type':'array','items':[{'type':'string'},{'type':'integer'}],'additionalItems':False},
+                'choice':{'oneOf':[{'type':'integer'},{'minimum':2}]},
+                'flag':{'not':{'enum':[True,None]}},
+                'tree':{'$ref':'#/definitions/node'},
+                'switch':{'if':{'type':'string'},'then':{'const':'on'},'else':{'type':'integer'}}
+            },
+            'patternProperties':{'^x_':{'type':'boolean'}},
+            'additionalProperties':{'type':'null'},
+            'dependencies':{'name':['count'],'ratio':{'required':['tags']}},
+            'propertyNames':{'maxLength':6},
+            'minProperties':1
+        }
+        reference = get_validator(self._write_schema(schema))
+        compiled = CompiledValidator(reference,cache_directory=self.cache_directory)
+        instances = [{},{'name':'Ab','count':4},{'name':'ab','count':4},{'name':'Abcdef','count':4},{'name':'Ab'},
+                     {'count':3},{'count':10},{'count':-2},{'count':4.0},{'ratio':1.5,'tags':[1]},{'ratio':1.2,'tags':[1]},
+                     {'tags':[1,True]},{'tags':[1,1]},{'tags':[2]},{'tags':[1,[1],[1]]},{'tags':[1,{'a':1},{'a':True}]},
+                     {'pair':['a',1]},{'pair':['a','b']},{'pair':['a',1,2]},{'choice':1},{'choice':3},{'choice':1.5},
+                     {'flag':False},{'flag':True},{'flag':1},{'tree':{'child':{'child':{}}}},{'tree':{'child':{'other':1}}},
+                     {'switch':'on'},{'switch':'off'},{'switch':2},{'switch':2.5},{'x_a':True},{'x_a':1},{'other':None},
+                     {'other':1},{'toolongname':None},[],None]
+        for instance in instances:
+            self.assertParity(reference,compiled,instance)
+    def test_disk_cache(self):
+        schema_path = self.schemas[0]
+        compiled = CompiledValidator(get_validator(schema_path),cache_directory=self.cache_directory)
+        cached = [x for x in os.listdir(self.cache_directory) if x.startswith('validator_')]
+        self.assertGreater(len(cached),0)
+        self.assertEqual(compiled.source,CompiledValidator(get_validator(schema_path),cache_directory=self.cache_directory).source)
+    def test_disk_cache_hash(self):
+        schema_path = self.schemas[0]
+        source = CompiledValidator(get_validator(schema_path),cache_directory=self.cache_directory).source
+        for cache_path in [os.path.join(self.cache_directory,x) for x in os.listdir(self.cache_directory) if x.startswith('validator_')]:
+            with open(cache_path,'rt') as inf:
+                header = inf.readline()
+            with open(cache_path,'wt') as of:
+                of.write(header+'def validate(data):\n    return True\n')
+        compiled = CompiledValidator(get_validator(schema_path),cache_directory=self.cache_directory)
+        self.assertEqual(source,compiled.source)
+        self.assertFalse(compiled.is_valid(None))
+    def test_disagreement(self):
+        reference = get_validator(self._write_schema({'type':'object','required':['name']}))
+        compiled = CompiledValidator(reference,cache_directory=self.cache_directory)
+        compiled._validate = lambda instance: False
+        instance = {'name':'a'}
+        self.assertTrue(reference.is_valid(instance))
+        with self.assertRaises(ValidationError) as observed:
+            compiled.validate(instance)
+        self.assertIn('compiled validator rejected',observed.exception.message)
+        self.assertEqual(1,len(list(compiled.iter_errors(instance))))
+    def _write_schema(self,schema):
+        _fname = os.path.join(self.cache_directory,'keywords.json')
+        with open(_fname,'wt') as of:
+            of.write(json.dumps(schema))
+        return _fname
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_modules_deferred(self):
+        # a structural check rather than a wall clock budget, starting a console script loads none of the heavy modules
+        for module_name in _entry_point_modules:
+            imported = _imported_modules(module_name)
+            self.assertIn(module_name,imported)
+            self.assertEqual([],[x for x in _deferred_modules if x in imported],module_name)
+
+class TestInjestProject(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sample_names = ['S'+str(i) for i in range(8)][::-1]
+        self.project_json, self.analysis_json = _make_inform_project(self.directory,self.sample_names)
+    def test_sample_order(self):
+        samples, success, errors = injest_project(self.project_json,self.analysis_json,self.directory)
+        self.assertTrue(success)
+        self.assertEqual(self.sample_names,[x['sample_name'] for x in samples])
+        self.assertEqual(samples[0],injest_sample(self.sample_names[0],self.project_json,self.analysis_json,self.directory)[0])
+    def test_workers_match_serial(self):
+        serial = injest_project(self.project_json,self.analysis_json,self.directory)
+        self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=4))
+        self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=2,pool_type='process'))
+        self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=8,pool_type='asyncio'))
+        with FileHasher(workers=2) as hasher:
+            self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,
+                                                   workers=8,pool_type='asyncio',hasher=hasher))
+    def test_workers_raise_first_error(self):
+        os.remove(os.path.join(self.directory,'SAMPLES','S5','ANNOTATIONS','S5_[1]_Tumor.tif'))
+        os.remove(os.path.join(self.directory,'SAMPLES','S2','ANNOTATIONS','S2_[1]_Tumor.tif'))
+        for workers, pool_type in [(1,'thread'),(4,'thread'),(4,'asyncio')]:
+            with self.assertRaisesRegex(ValueError,'S5_\\[1\\]_Tumor.tif'):
+                injest_project(self.project_json,self.analysis_json,self.directory,workers=workers,pool_type=pool_type)
+    def test_threads_with_refs(self):
+        # samples are validated from every thread of the pool at once, including against schemas
+        # whose $refs move between documents with their own local $refs
+        schema_directory = os.path.join(self.directory,'schemas')
+        os.makedirs(schema_directory)
+        for name, leaf in [('integers','integer'),('strings','string')]:
+            with open(os.path.join(schema_directory,name+'.json'),'wt') as of:
+                of.write(json.dumps({'definitions':{'node':{'type':'object','properties':{'b':{'$ref':'#/definitions/leaf'}},
+                                                            'required':['b']},
+                                                    'leaf':{'type':leaf}}}))
+        with open(os.path.join(schema_directory,'sample.json'),'wt') as of:
+            of.write(json.dumps({'type':'object','properties':{'a':{'$ref':'integers.json#/definitions/node'},
+                                                               'c':{'$ref':'strings.json#/definitions/node'}}}))
+        def _rejected(i):
+            validator = get_validator(os.path.join(schema_directory,'sample.json'),base_uri='file://'+schema_directory+'/')
+            return sum([not validator.is_valid({'a':{'b':j}} if i%2 else {'c':{'b':str(j)}}) for j in range(300)])
+        serial = injest_project(self.project_json,self.analysis_json,self.directory)
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=8))
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                self.assertEqual(0,sum(executor.map(_rejected,range(16))))
+        finally:
+            sys.setswitchinterval(switch_interval)
+    def test_asyncio_overlaps_latency(self):
+        serial = injest_project(self.project_json,self.analysis_json,self.directory)
+        with simulated_latency(self.directory,0.002) as calls:
+            self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=1,pool_type='thread'))
+            # one worker makes one call at a time
+            self.assertEqual(1,calls['peak_in_flight'])
+        with simulated_latency(self.directory,0.002) as calls:
+            self.assertEqual(serial,injest_project(self.project_json,self.analysis_json,self.directory,workers=16,pool_type='asyncio'))
+            self.assertGreater(calls['stat'],0)
+            # the asyncio workers wait on the filesystem at the same time rather than one after another
+            self.assertGreater(calls['peak_in_flight'],1)
+
+class TestFileHashCache(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project_json, self.analysis_json = _make_inform_project(self.directory,['S1','S2'])
+        self.cache_path = os.path.join(self.directory,'hashes.sqlite')
+    def test_reuse_across_runs(self):
+        expected = injest_project(self.project_json,self.analysis_json,self.directory)
+        with FileHashCache(self.cache_path) as hash_cache:
+            self.assertEqual(expected,injest_project(self.project_json,self.analysis_json,self.directory,hasher=hash_cache))
+            total = hash_cache.stats()['hits']+hash_cache.stats()['misses']
+        with FileHashCache(self.cache_path) as hash_cache:
+            self.assertEqual(expected,injest_project(self.project_json,self.analysis_json,self.directory,hasher=hash_cache))
+            self.assertEqual({'hits':total,'misses':0,'hit_rate':1.0},hash_cache.stats())
+    def test_changed_file_rehashed(self):
+        file_path = os.path.join(self.directory,'SAMPLES','S1','ANNOTATIONS','S1_[0]_Tumor.tif')
+        with FileHashCache(self.cache_path) as hash_cache:
+            hash_cache.sha256(file_path)
+            with open(file_path,'wt') as of:
+                of.write('changed contents')
+            self.assertEqual(sha256_file(file_path),hash_cache.sha256(file_path))
+            self.assertEqual(2,hash_cache.stats()['misses'])
+    def test_process_pool(self):
+        expected = injest_project(self.project_json,self.analysis_json,self.directory)
+        with FileHashCache(self.cache_path) as hash_cache:
+            self.assertEqual(expected,injest_project(self.project_json,self.analysis_json,self.directory,
+                                                     workers=2,pool_type='process',hasher=hash_cache))
+            # the counts of every worker's copy come back to this cache
+            total = hash_cache.stats()['misses']
+            self.assertGreater(total,0)
+            self.assertEqual(total,hash_cache.hasher.stats()['files'])
+        with FileHashCache(self.cache_path) as hash_cache:
+            injest_project(self.project_json,self.analysis_json,self.directory,workers=2,pool_type='process',hasher=hash_cache)
+            self.assertEqual({'hits':total,'misses':0,'hit_rate':1.0},hash_cache.stats())
+    def test_worker_copy_closed(self):
+        with FileHashCache(self.cache_path) as hash_cache:
+            worker_copy = pickle.loads(pickle.dumps(hash_cache))
+            sample, stats = files_module._injest_sample_task('S1',self.project_json,self.analysis_json,self.directory,worker_copy)
+            self.assertIsNone(worker_copy._connection)
+            self.assertEqual(worker_copy.stats(),stats[0])
+            self.assertEqual(0,hash_cache.stats()['misses'])
+
+class TestFileHasher(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(0)
+        self.file_paths = []
+        for size in [0,1,4095,4096,4097,300000]:
+            self.file_paths.append(os.path.join(self.directory,str(size)+'.bin'))
+            with open(self.file_paths[-1],'wb') as of:
+                of.write(bytes([rng.randint(0,255) for x in range(size)]))
+    def test_digests(self):
+        expected = []
+        for file_path in self.file_paths:
+            with open(file_path,'rb') as inf:
+                expected.append(hashlib.sha256(inf.read()).hexdigest())
+        for buffer_size, use_mmap in [(1,False),(4096,False),(65536,False),(4096,True)]:
+            with FileHasher(buffer_size=buffer_size,use_mmap=use_mmap,workers=3) as hasher:
+                self.assertEqual(expected,hasher.sha256_many(self.file_paths))
+                self.assertEqual(expected,[hasher.submit(x).result() for x in self.file_paths])
+                self.assertEqual(2*len(self.file_paths),hasher.stats()['files'])
+                self.assertEqual(2*sum([os.path.getsize(x) for x in self.file_paths]),hasher.stats()['bytes'])
+    def test_injest_with_hasher(self):
+        project_json, analysis_json = _make_inform_project(self.directory,['S1','S2'])
+        expected = injest_project(project_json,analysis_json,self.directory)
+        with FileHasher(buffer_size=7,workers=2) as hasher:
+            self.assertEqual(expected,injest_project(project_json,analysis_json,self.directory,hasher=hasher))
+            self.assertGreater(hasher.stats()['files'],0)
+
+class TestRestageProject(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project_json, self.analysis_json = _make_inform_project(self.directory,['S1','S2','S3'])
+        samples, success, errors = injest_project(self.project_json,self.analysis_json,self.directory)
+        self.previous_json = {'analysis':copy.deepcopy(self.analysis_json),'sample_files':samples}
+    def _restage(self,**kwargs):
+        return restage_project(self.previous_json,self.project_json,self.analysis_json,self.directory,**kwargs)
+    def test_unchanged(self):
+        with FileHasher() as hasher:
+            samples, success, errors, changes = self._restage(hasher=hasher)
+            self.assertEqual(0,hasher.stats()['files'])
+        self.assertEqual(self.previous_json['sample_files'],samples)
+        self.assertEqual(['unchanged']*3,[x['status'] for x in changes])
+    def test_changes(self):
+        sample_path = os.path.join(self.directory,'SAMPLES')
+        shutil.rmtree(os.path.join(sample_path,'S1'))
+        file_path = os.path.join(sample_path,'S2','INFORM_ANALYSIS','EXPORT2','S2_[1]_score_data.txt')
+        with open(file_path,'wt') as of:
+            of.write('changed contents')
+        os.utime(file_path,(os.stat(file_path).st_atime,os.stat(file_path).st_mtime+10))
+        for export_name in ['EXPORT1','EXPORT2']:
+            for suffix in ['cell_seg_data.txt','component_data.tif','binary_seg_maps.tif']:
+                with open(os.path.join(sample_path,'S3','INFORM_ANALYSIS',export_name,'S3_[3]_'+suffix),'wt') as of:
+                    of.write(suffix)
+        with open(os.path.join(sample_path,'S3','ANNOTATIONS','S3_[3]_Tumor.tif'),'wt') as of:
+            of.write('Tumor.tif')
+        expected = injest_project(self.project_json,self.analysis_json,self.directory)
+        for workers in [1,2]:
+            samples, success, errors, changes = self._restage(workers=workers)
+            self.assertEqual(expected,(samples,success,errors))
+            self.assertEqual([
+                {'sample_name':'S2','status':'modified','added_images':[],'removed_images':[],'modified_images':['S2_[1]']},
+                {'sample_name':'S3','status':'modified','added_images':['S3_[3]'],'removed_images':[],'modified_images':[]},
+                {'sample_name':'S1','status':'removed','added_images':[],'removed_images':['S1_[0]','S1_[1]','S1_[2]'],'modified_images':[]}
+            ],changes)
+    def test_new_annotation(self):
+        with open(os.path.join(self.directory,'SAMPLES','S1','ANNOTATIONS','S1_[0]_Invasive_Margin.tif'),'wt') as of:
+            of.write('Invasive_Margin.tif')
+        samples, success, errors, changes = self._restage()
+        self.assertEqual(injest_project(self.project_json,self.analysis_json,self.directory)[0],samples)
+        self.assertEqual(['modified','unchanged','unchanged'],[x['status'] for x in changes])
+        self.assertEqual(['S1_[0]'],changes[0]['modified_images'])
+    def test_extra_inform_files(self):
+        project_directory = os.path.join(self.directory,'extra')
+        project_json, analysis_json = _make_inform_project(project_directory,['S1','S2'],
+                                                           extra_suffixes=['cell_seg_data_summary.txt','composite_image.jpg'])
+        samples, success, errors = injest_project(project_json,analysis_json,project_directory)
+        previous_json = {'analysis':copy.deepcopy(analysis_json),'sample_files':samples}
+        with FileHasher() as hasher:
+            samples, success, errors, changes = restage_project(previous_json,project_json,analysis_json,project_directory,
+                                                                hasher=hasher)
+            self.assertEqual(0,hasher.stats()['files'])
+        self.assertEqual(previous_json['sample_files'],samples)
+        self.assertEqual(['unchanged']*2,[x['status'] for x in changes])
+        # an image data file that changed among the extra files is still a change
+        with open(os.path.join(project_directory,'SAMPLES','S2','INFORM_ANALYSIS','EXPORT1','S2_[1]_score_data.txt'),'at') as of:
+            of.write('more')
+        samples, success, errors, changes = restage_project(previous_json,project_json,analysis_json,project_directory)
+        self.assertEqual(['unchanged','modified'],[x['status'] for x in changes])
+    def test_same_second_change(self):
+        # a rewrite within the same second is found from the size or the nanosecond modification time
+        file_path = os.path.join(self.directory,'SAMPLES','S2','INFORM_ANALYSIS','EXPORT1','S2_[0]_score_data.txt')
+        for contents in [None,'a longer score data file']:
+            mtime_ns = os.stat(file_path).st_mtime_ns
+            with open(file_path,'rt') as inf:
+                original = inf.read()
+            with open(file_path,'wt') as of:
+                of.write(original[::-1] if contents is None else contents)
+            os.utime(file_path,ns=(mtime_ns,mtime_ns+(1 if contents is None else 0)))
+            samples, success, errors, changes = self._restage()
+            self.assertEqual(['unchanged','modified','unchanged'],[x['status'] for x in changes])
+            self.assertEqual(['S2_[0]'],changes[1]['modified_images'])
+    def test_previous_without_sizes(self):
+        for sample in self.previous_json['sample_files']:
+            for export in sample['exports']:
+                for image in export['images']:
+                    for d in list(image['image_data'].values())+image['image_annotations']:
+                        del d['file_size'], d['last_modified_ns']
+        with FileHasher() as hasher:
+            samples, success, errors, changes = self._restage(hasher=hasher)
+            self.assertGreater(hasher.stats()['files'],0)
+        self.assertEqual(injest_project(self.project_json,self.analysis_json,self.directory)[0],samples)
+        self.assertEqual(['unchanged']*3,[x['status'] for x in changes])
+    def test_analysis_changed(self):
+        self.previous_json['analysis']['parameters']['analysis_version'] = '0'
+        with FileHasher() as hasher:
+            with self.assertLogs(level='WARNING'):
+                samples, success, errors, changes = self._restage(hasher=hasher)
+            self.assertGreater(hasher.stats()['files'],0)
+        self.assertEqual(self.previous_json['sample_files'],samples)
+
+class TestExportFolder(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project_json, self.analysis_json = _make_inform_project(self.directory,['S1'],exports=['EXPORT1'])
+        self.export_path = os.path.join(self.directory,'SAMPLES','S1','INFORM_ANALYSIS','EXPORT1')
+    def test_images(self):
+        samples, success, errors = injest_project(self.project_json,self.analysis_json,self.directory)
+        images = samples[0]['exports'][0]['images']
+        self.assertEqual(['S1_[0]','S1_[1]','S1_[2]'],[x['image_name'] for x in images])
+        self.assertEqual(['component_data_tif','binary_segs_maps_tif','cell_seg_data_txt','score_data_txt'],list(images[0]['image_data'].keys()))
+    def test_annotations_read_once(self):
+        project_json, analysis_json = _make_inform_project(self.directory,['S2'],exports=['EXPORT1','EXPORT2','EXPORT3'],strategy='GIMP_CUSTOM')
+        project_json['samples'] = [{'sample':'S1'},{'sample':'S2'}]
+        with FileHasher() as hasher:
+            sample_files, success, errors = injest_sample('S2',project_json,analysis_json,self.directory,hasher=hasher)
+            self.assertEqual(3*3*4+3,hasher.stats()['files'])
+        self.assertEqual(['Tumor'],[x['mask_label'] for x in sample_files['exports'][2]['images'][1]['image_annotations']])
+        self.assertEqual(sample_files['exports'][0]['images'][1]['image_annotations'],sample_files['exports'][2]['images'][1]['image_annotations'])
+    def test_unexpected_file(self):
+        with open(os.path.join(self.export_path,'S1_[3]_component_data.tif'),'wt') as of:
+            of.write('no cell seg data')
+        with self.assertRaisesRegex(ValueError,'unexpected file S1_\\[3\\]_component_data.tif'):
+            injest_project(self.project_json,self.analysis_json,self.directory)
+    def test_unexpected_folder(self):
+        os.makedirs(os.path.join(self.export_path,'S1_[0]_extra'))
+        with self.assertRaisesRegex(ValueError,'Unexpected folder'):
+            injest_project(self.project_json,self.analysis_json,self.directory)
+
+class TestExecuteSamples(unittest.TestCase):
+    def setUp(self):
+        self.sample_files = [{'sample_name':'S'+str(i)} for i in range(6)][::-1]
+    def test_order_and_logs(self):
+        for workers in [1,2,3]:
+            with self.assertLogs(level='WARNING') as logs:
+                outputs = list(run_tool._execute_samples(self.sample_files,{'fail':None},'run',workers=workers,function=_fake_execute_sample))
+            self.assertEqual([{'sample_name':x['sample_name'],'run_id':'run'} for x in self.sample_files],outputs)
+            self.assertEqual([x['sample_name']+' step '+str(i) for x in self.sample_files for i in range(3)],[x.getMessage() for x in logs.records])
+    def test_failure_names_sample(self):
+        with self.assertLogs(level='WARNING'):
+            with self.assertRaisesRegex(ValueError,'sample "S3" failed(.|\\n)*bad sample'):
+                list(run_tool._execute_samples(self.sample_files,{'fail':'S3'},'run',workers=3,function=_fake_execute_sample))
+
+class TestResumeRun(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.inputs = {
+            'project':{'name':'p'},'analysis':{'name':'a'},'panel':{'name':'p'},'report':{'name':'r'},
+            'sample_files':[{'sample_name':'S'+str(i)} for i in range(6)],
+            'fail':None
+        }
+        del _fake_execute_sample.calls[:]
+    def _run(self,resume=True):
+        return list(run_tool._iter_samples(self.inputs,'run',cache_directory=self.directory,resume=resume,function=_fake_execute_sample))
+    def test_resume_after_failure(self):
+        expected = [{'sample_name':x['sample_name'],'run_id':'run'} for x in self.inputs['sample_files']]
+        self.inputs['fail'] = 'S2'
+        with self.assertLogs(level='WARNING'):
+            with self.assertRaises(KeyError):
+                self._run(resume=False)
+        self.assertEqual(['S0','S1'],_fake_execute_sample.calls)
+        self.inputs['fail'] = None
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(expected,self._run())
+        self.assertEqual(['S0','S1','S2','S3','S4','S5'],_fake_execute_sample.calls)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(expected,self._run(resume=False))
+        self.assertEqual(12,len(_fake_execute_sample.calls))
+    def test_invalid_shards(self):
+        with self.assertLogs(level='WARNING'):
+            self._run()
+        with open(run_tool._shard_path(self.directory,self.inputs['sample_files'][1],self.inputs),'wt') as of:
+            of.write('{"key":')
+        self.inputs['sample_files'][4]['sample_directory'] = 'moved'
+        with self.assertLogs(level='WARNING'):
+            self._run()
+        self.assertEqual(['S0','S1','S2','S3','S4','S5','S1','S4'],_fake_execute_sample.calls)
+        self.inputs['report']['name'] = 'r2'
+        with self.assertLogs(level='WARNING'):
+            self._run()
+        self.assertEqual(14,len(_fake_execute_sample.calls))
+
+class TestImageInfo(unittest.TestCase):
+    def test_sample_image_info(self):
+        cells = []
+        for i, frame_name in enumerate(['A_[1]','A_[0]','A_[1]','A_[2]','A_[0]','A_[1]']):
+            cells.append({'sample_name':'A','frame_name':frame_name,'cell_index':i,'x':i*2,'y':i*3,
+                          'region_label':['Tumor','Stroma'][i%2],'phenotype_label':['CD8+','OTHER','TUMOR'][i%3],
+                          'scored_calls':{'PDL1':i%2,'PD1':1},'frame_shape':(100+i//2,200),
+                          'regions':{'Tumor':10,'Stroma':20+len(frame_name)}})
+        cells.append(dict(cells[0],sample_name='B'))
+        cdf = _fake_cell_data_frame(cells)
+        image_info = run_tool._get_sample_image_info('A',cdf,['A_[0]','A_[1]'])
+        self.assertEqual(['A_[1]','A_[0]'],list(image_info.keys()))
+        cnames, rows, frame_shape, region_sizes = image_info['A_[1]']
+        self.assertEqual(['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'],cnames)
+        self.assertEqual([[0,0,0,'Tumor','CD8+',[('PDL1',0),('PD1',1)]],
+                          [2,4,6,'Tumor','TUMOR',[('PDL1',0),('PD1',1)]],
+                          [5,10,15,'Stroma','TUMOR',[('PDL1',1),('PD1',1)]]],rows)
+        self.assertEqual({'y':100,'x':200},frame_shape)
+        self.assertEqual([{'region_name':'Tumor','region_area_pixels':10},{'region_name':'Stroma','region_area_pixels':25}],region_sizes)
+        self.assertEqual([1,4],[x[0] for x in image_info['A_[0]'][1]])
+        json.dumps(image_info)
+
+class TestColumnarPhenotypeMap(unittest.TestCase):
+    def setUp(self):
+        from jsonschema import Draft7Validator
+        schema = json.loads(files('schema_data').joinpath('report_output.json').read_text())
+        self.validator = Draft7Validator({'definitions':schema['definitions'],'$ref':'#/definitions/image_attributes/properties/phenotype_map'})
+        rng = random.Random(0)
+        self.phenotype_map = {
+            'column_names':['cell_index','x','y','region_name','mutually_exclusive_phenotype','binary_phenotypes'],
+            'rows':[[i,rng.randint(0,999),rng.randint(0,999),rng.choice(['Tumor','Stroma']),rng.choice(['CD8+','OTHER']),
+                     [('PD1',rng.randint(0,1)),('PDL1',rng.randint(0,1)),('FOXP3',rng.randint(0,1))]] for i in range(200)],
+            'mutually_exclusive_phenotypes':['CD8+','OTHER','TUMOR']
+        }
+    def test_round_trip(self):
+        columnar = run_tool._columnar_phenotype_map(self.phenotype_map)
+        self.validator.validate(json.loads(json.dumps(self.phenotype_map)))
+        self.validator.validate(columnar)
+        self.assertTrue(CompiledValidator(self.validator).is_valid(columnar))
+        self.assertFalse(self.validator.is_valid(dict(columnar,rows=[])))
+        self.assertEqual(['PD1','PDL1','FOXP3'],columnar['binary_phenotype_names'])
+        expected = report_tool.read_phenotype_map(self.phenotype_map)
+        self.assertEqual(['cell_index','x','y','region_name','mutually_exclusive_phenotype','PD1','PDL1','FOXP3'],list(expected.columns))
+        self.assertEqual(expected.values.tolist(),report_tool.read_phenotype_map(columnar).values.tolist())
+        self.assertLess(len(json.dumps(columnar)),len(json.dumps(self.phenotype_map))/2)
+    def test_mixed_binary_phenotypes_kept_as_rows(self):
+        self.phenotype_map['rows'][5][5] = [('PD1',1),('PD1',0),('FOXP3',1)]
+        self.assertIsNone(run_tool._columnar_phenotype_map(self.phenotype_map))
+        sample_output = {'sample_name':'S1','images':[{'image_name':'S1_[0]','phenotype_map':self.phenotype_map}]}
+        with self.assertLogs(level='WARNING'):
+            run_tool._encode_phenotype_maps(sample_output,'columnar')
+        self.assertIs(self.phenotype_map,sample_output['images'][0]['phenotype_map'])
+
+class TestParquetSidecar(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sidecar_directory = os.path.join(self.directory,'output_sidecar')
+        os.makedirs(self.sidecar_directory)
+        self.expected = _fake_report_output()
+        self.output = copy.deepcopy(self.expected)
+        self.output['sample_outputs'][1]['images'][1]['phenotype_map'] = run_tool._columnar_phenotype_map(self.output['sample_outputs'][1]['images'][1]['phenotype_map'])
+    def test_phenotype_map(self):
+        for sample_output in self.output['sample_outputs']:
+            run_tool._write_parquet_sidecar(sample_output,self.sidecar_directory,self.directory)
+        get_validator(files('schema_data').joinpath('report_output.json')).validate(self.output)
+        self.assertEqual(self.expected['sample_outputs'][0]['sample_reports'],self.output['sample_outputs'][0]['sample_reports'])
+        for expected, sample_output in zip(self.expected['sample_outputs'],self.output['sample_outputs']):
+            sidecar_file = sample_output['sidecar_files']['phenotype_map']
+            self.assertEqual(sha256_file(os.path.join(self.directory,sidecar_file['file_path'])),sidecar_file['sha256_hash'])
+            for expected_image, image in zip(expected['images'],sample_output['images']):
+                self.assertEqual('parquet',image['phenotype_map']['encoding'])
+                cells = report_tool.read_phenotype_map(image['phenotype_map'],base_directory=self.directory)
+                self.assertEqual(report_tool.read_phenotype_map(expected_image['phenotype_map']).values.tolist(),cells.values.tolist())
+                self.assertEqual(list(cells.columns),['cell_index','x','y','region_name','mutually_exclusive_phenotype','PD1','PDL1'])
+                cells = report_tool.read_phenotype_map(image['phenotype_map'],columns=['x','PD1'],base_directory=self.directory)
+                self.assertEqual([[x[1],x[5][0][1]] for x in expected_image['phenotype_map']['rows']],cells.values.tolist())
+    def test_tables(self):
+        import pandas as pd
+        for sample_output in self.output['sample_outputs']:
+            run_tool._write_parquet_sidecar(sample_output,self.sidecar_directory,self.directory,tables=True)
+        get_validator(files('schema_data').joinpath('report_output.json'),engine='compiled').validate(self.output)
+        for expected, sample_output in zip(self.expected['sample_outputs'],self.output['sample_outputs']):
+            self.assertEqual(7,len(sample_output['sidecar_files']))
+            for table_name in run_tool.SIDECAR_SAMPLE_TABLES:
+                self.assertEqual([],sample_output['sample_reports'][table_name])
+                pd.testing.assert_frame_equal(pd.DataFrame(expected['sample_reports'][table_name]),
+                                              report_tool._sample_table(sample_output,table_name,self.directory),check_dtype=False)
+            sidecar_tables = {}
+            for expected_image, image in zip(expected['images'],sample_output['images']):
+                for table_name in run_tool.SIDECAR_IMAGE_TABLES:
+                    self.assertEqual([],image['image_reports'][table_name])
+                    pd.testing.assert_frame_equal(pd.DataFrame(expected_image['image_reports'][table_name]),
+                                                  report_tool._image_table(sample_output,image,table_name,sidecar_tables,self.directory),check_dtype=False)
+
+class TestStreamingRunOutput(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_json = os.path.join(self.directory,'output.json')
+        self.output = _fake_report_output(sample_count=3)
+        self.header = dict([(k,v) for k,v in self.output.items() if k!='sample_outputs'])
+    def test_matches_whole_output(self):
+        written = []
+        def _samples():
+            for sample_output in self.output['sample_outputs']:
+                # samples are asked for one at a time while the output is still partial
+                self.assertEqual(1,len([x for x in os.listdir(self.directory) if x.endswith('.partial')]))
+                written.append(sample_output['sample_name'])
+                yield sample_output
+        run_tool._write_outputs(_run_output_args(self.output_json),[self.header],([x] for x in _samples()))
+        self.assertEqual(3,len(written))
+        with open(self.output_json,'rt') as inf:
+            self.assertEqual(json.dumps(self.output,allow_nan=False),inf.read())
+        self.assertEqual(['output.json'],os.listdir(self.directory))
+    def test_invalid_sample_leaves_no_output(self):
+        del self.output['sample_outputs'][2]['images'][0]['image_size_pixels']
+        with self.assertRaises(ValidationError):
+            run_tool._write_outputs(_run_output_args(self.output_json),[self.header],([x] for x in self.output['sample_outputs']))
+        self.assertEqual([],os.listdir(self.directory))
+        self.header['run_id'] = None
+        with self.assertRaises(ValidationError):
+            run_tool._write_outputs(_run_output_args(None),[self.header],iter([]))
+    def test_pointer_validator(self):
+        report_output = files('schema_data').joinpath('report_output.json')
+        for engine in VALIDATOR_ENGINES:
+            _validator = get_validator(report_output,engine=engine,pointer='/properties/sample_outputs/items')
+            self.assertIs(_validator,get_validator(report_output,engine=engine,pointer='/properties/sample_outputs/items'))
+            self.assertTrue(_validator.is_valid(self.output['sample_outputs'][0]))
+            self.assertFalse(_validator.is_valid(self.output))
+        with self.assertRaises(ValueError):
+            get_validator(report_output,pointer='/properties/missing')
+
+class TestJSONStreamReader(unittest.TestCase):
+    def test_values(self):
+        rng = random.Random(0)
+        for i in range(200):
+            document = _random_json(rng)
+            text = json.dumps(document,indent=rng.choice([None,1]),ensure_ascii=rng.random() < 0.5)
+            for chunk_size in [1,3,64]:
+                reader = JSONStreamReader(io.StringIO(text),chunk_size)
+                self.assertEqual(document,reader.value())
+                reader = JSONStreamReader(io.StringIO(text+' 7'),chunk_size)
+                reader.skip()
+                self.assertEqual(7,reader.value())
+    def test_items_and_elements(self):
+        rng = random.Random(1)
+        document = {'skipped':[_random_json(rng) for i in range(50)],'kept':[{'a':1,'b':[2]},{},'"\\'],'empty':[]}
+        for chunk_size in [1,5,1024]:
+            reader = JSONStreamReader(io.StringIO(json.dumps(document)),chunk_size)
+            read = {}
+            for key in reader.items():
+                if key == 'skipped':
+                    reader.skip()
+                    continue
+                read[key] = [reader.value() for index in reader.elements()]
+            self.assertEqual({'kept':document['kept'],'empty':[]},read)
+    def test_truncated(self):
+        for text in ['{"a": [1, 2','{"a": "b','[1, 2 3]','{"a" 1}']:
+            with self.assertRaises(ValueError):
+                reader = JSONStreamReader(io.StringIO(text),2)
+                for key in reader.items(): reader.skip()
+    def test_end(self):
+        for text in ['{"a": [1, 2]}','{"a": [1, 2]} \n ','7 ']:
+            for chunk_size in [1,4,64]:
+                reader = JSONStreamReader(io.StringIO(text),chunk_size)
+                reader.skip()
+                reader.end()
+        for text in ['{"a": [1, 2]}}','{"a": [1, 2]} {"a": 1}','[1] x','7 8']:
+            for chunk_size in [1,4,64]:
+                reader = JSONStreamReader(io.StringIO(text),chunk_size)
+                reader.skip()
+                with self.assertRaises(ValueError):
+                    reader.end()
+
+class TestStreamingReport(unittest.TestCase):
+    def setUp(self):
+        self.output = _fake_report_output(sample_count=3)
+        self.text = json.dumps(self.output)
+        self._validator = report_tool.sample_output_validator()
+    def test_sample_outputs(self):
+        for chunk_size in [7,None]:
+            header = {}
+            samples = list(report_tool.iter_sample_outputs(io.StringIO(self.text),header,chunk_size=chunk_size))
+            self.assertEqual(dict([(k,v) for k,v in self.output.items() if k!='sample_outputs']),header)
+            expected = copy.deepcopy(self.output['sample_outputs'])
+            for sample in expected:
+                for image in sample['images']: del image['phenotype_map']
+            self.assertEqual(expected,samples)
+            for sample in samples:
+                # the compiled code accepts the samples without the reference validator being consulted
+                self.assertTrue(self._validator._validate(sample))
+                self._validator.validate(sample)
+    def test_invalid_sample(self):
+        del self.output['sample_outputs'][1]['images'][0]['image_size_pixels']
+        samples = report_tool.iter_sample_outputs(io.StringIO(json.dumps(self.output)))
+        self._validator.validate(next(samples))
+        with self.assertRaises(ValidationError):
+            self._validator.validate(next(samples))
+    def test_malformed_documents(self):
+        # a document without sample outputs, or with anything after it, is not a run output
+        header = dict([(k,v) for k,v in self.output.items() if k!='sample_outputs'])
+        for text in [json.dumps(header),json.dumps(dict(header,sample_output=[])),self.text+' {}',self.text+']']:
+            with self.assertRaises(ValueError):
+                list(report_tool.iter_sample_outputs(io.StringIO(text),chunk_size=7))
+        self.assertEqual(3,len(list(report_tool.iter_sample_outputs(io.StringIO(self.text+'\n')))))
+
+class TestCompression(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = _fake_report_output()
+    def _round_trip(self,compression):
+        text = json.dumps(self.output)
+        for level in [None,1]:
+            # the name doesn't say how the file is compressed, reading looks at the bytes
+            file_path = os.path.join(self.directory,'output.json')
+            with open_json(file_path,'wt',compression,level) as of:
+                of.write(text)
+            self.assertEqual(compression,detect_compression(file_path))
+            with open_json(file_path,'rt') as inf:
+                self.assertEqual(text,inf.read())
+    def test_gzip(self):
+        self._round_trip('gzip')
+    def test_xz(self):
+        self._round_trip('xz')
+    @unittest.skipUnless(_has_module('zstandard'),"zstandard is not installed")
+    def test_zstd(self):
+        self._round_trip('zstd')
+    def test_none(self):
+        self._round_trip('none')
+    def test_extension(self):
+        for name, compression in [('a.json','none'),('a.json.gz','gzip'),('a.json.XZ','xz'),('a.json.zst','zstd')]:
+            self.assertEqual(compression,compression_from_extension(name))
+        with self.assertRaises(ValueError):
+            open_json(os.path.join(self.directory,'a.json.gz'),'wt',level=10)
+        with self.assertRaises(ValueError):
+            open_json(os.path.join(self.directory,'a.json'),'wt','bz2')
+    def test_run_output(self):
+        header = dict([(k,v) for k,v in self.output.items() if k!='sample_outputs'])
+        output_json = os.path.join(self.directory,'output.json.gz')
+        run_tool._write_outputs(_run_output_args(output_json),[header],([x] for x in self.output['sample_outputs']))
+        self.assertEqual('gzip',detect_compression(output_json))
+        self.assertEqual(['output.json.gz'],os.listdir(self.directory))
+        with open_json(output_json,'rt') as inf:
+            self.assertEqual(json.dumps(self.output),inf.read())
+        with open_json(output_json,'rt') as inf:
+            self.assertEqual([x['sample_name'] for x in self.output['sample_outputs']],
+                             [x['sample_name'] for x in report_tool.iter_sample_outputs(inf)])
+        run_tool._write_outputs(_run_output_args(output_json,compression='xz',level=0),[header],([x] for x in self.output['sample_outputs']))
+        self.assertEqual('xz',detect_compression(output_json))
+
+class TestReportRows(unittest.TestCase):
+    def setUp(self):
+        import pandas as pd
+        self.frame = pd.DataFrame({
+            'frame_name':['F2','F1','F2'],
+            'region_label':['Tumor','Tumor','Stroma'],
+            'phenotype_label':['CD8+','CD8+','PD1+ CD8+'],
+            'region_area_pixels':[99,100,float('nan')],
+            'region_area_mm2':[0.1,0.2,float('nan')],
+            'count':[1,2,3],
+            'density_mm2':[float('nan'),10.0,20.5],
+            'extra':['a','b','c']
+        })
+    def test_rows(self):
+        rows = run_tool._report_rows(self.frame,'image_count_densities',100)
+        self.assertEqual([
+            {'region_name':'Tumor','population_name':'CD8+','region_area_pixels':99.0,'region_area_mm2':0.1,'count':1,'density_mm2':None,'measure_qc_pass':False},
+            {'region_name':'Tumor','population_name':'CD8+','region_area_pixels':100.0,'region_area_mm2':0.2,'count':2,'density_mm2':10.0,'measure_qc_pass':True},
+            {'region_name':'Stroma','population_name':'PD1+ CD8+','region_area_pixels':None,'region_area_mm2':None,'count':3,'density_mm2':20.5,'measure_qc_pass':True}
+        ],rows)
+        self.assertEqual(['region_name','population_name','region_area_pixels','region_area_mm2','count','density_mm2','measure_qc_pass'],list(rows[0].keys()))
+        self.assertEqual([int,bool],[type(rows[0]['count']),type(rows[0]['measure_qc_pass'])])
+        json.dumps(rows,allow_nan=False)
+    def test_group_by(self):
+        rows = run_tool._report_rows(self.frame,'image_count_densities',100)
+        groups = run_tool._report_rows(self.frame,'image_count_densities',100,group_by='frame_name')
+        self.assertEqual(['F2','F1'],list(groups.keys()))
+        self.assertEqual([rows[0],rows[2]],groups['F2'])
+        self.assertEqual({},run_tool._report_rows(self.frame.iloc[0:0],'image_count_densities',100,group_by='frame_name'))
+    def test_fixed_minimum(self):
+        frame = self.frame.rename(columns={'count':'measured_frame_count'})
+        for column in ['frame_count','mean_density_mm2','stddev_density_mm2','stderr_density_mm2']: frame[column] = 1
+        frame['measured_frame_count'] = [0,1,2]
+        rows = run_tool._report_rows(frame,'sample_aggregate_count_densities')
+        self.assertEqual([False,True,True],[x['measure_qc_pass'] for x in rows])
+
+class TestSampleMeasurements(unittest.TestCase):
+    def setUp(self):
+        import pandas as pd
+        regions = {'F1':{'Tumor':100,'Stroma':50,'Margin':0},'F2':{'Tumor':10,'Stroma':0,'Margin':30}}
+        cells = [('F1','Tumor','CD8+',1),('F1','Tumor','CD8+',1),('F1','Tumor','TUMOR',0),('F1','Stroma','CD8+',0),
+                 ('F2','Tumor','TUMOR',1),('F2','Margin','CD8+',1)]
+        self.cells = pd.DataFrame([{'frame_name':frame_name,'region_label':region_label,'phenotype_label':phenotype_label,
+                                    'scored_calls':{'PD1':pd1},'regions':regions[frame_name]} \
+                                   for frame_name, region_label, phenotype_label, pd1 in cells])
+        self.report = {
+            'parameters':{'minimum_density_region_size_pixels':20,'minimum_denominator_count':2},
+            'region_selection':[{'report_region_name':'Tumor','regions_to_combine':['Tumor']},
+                                {'report_region_name':'Any','regions_to_combine':['Tumor','Stroma','Margin']},
+                                {'report_region_name':'Stroma','regions_to_combine':['Stroma']}],
+            'population_densities':[{'population_name':'CD8+','mutually_exclusive_phenotypes':['CD8+'],'binary_phenotypes':[]},
+                                    {'population_name':'PD1+ CD8+','mutually_exclusive_phenotypes':['CD8+'],
+                                     'binary_phenotypes':[{'target_name':'PD1','filter_direction':'+'}]}],
+            'population_percentages':[{'population_name':'%PD1+ of CD8+',
+                                       'numerator_mutually_exclusive_phenotypes':['CD8+'],
+                                       'numerator_binary_phenotypes':[{'target_name':'PD1','filter_direction':'+'}],
+                                       'denominator_mutually_exclusive_phenotypes':['CD8+'],'denominator_binary_phenotypes':[]}]
+        }
+        self.measurements = SampleMeasurements(self.cells,0.5,phenotypes=['CD8+','TUMOR','OTHER'])
+    def test_frame_measures(self):
+        fcnts, scnts, fpcnts, spcnts = self.measurements.report_tables(self.report)
+        self.assertEqual([('Tumor','CD8+','F1'),('Tumor','CD8+','F2'),('Tumor','PD1+ CD8+','F1'),('Tumor','PD1+ CD8+','F2')],
+                         list(zip(fcnts['region_label'],fcnts['phenotype_label'],fcnts['frame_name']))[0:4])
+        # Stroma has no area in F2 so it is only measured in F1
+        self.assertEqual(['F1','F1'],fcnts.loc[fcnts['region_label']=='Stroma','frame_name'].tolist())
+        any_cd8 = fcnts.loc[(fcnts['region_label']=='Any')&(fcnts['phenotype_label']=='CD8+')]
+        self.assertEqual([150,40],any_cd8['region_area_pixels'].tolist())
+        self.assertEqual([3,1],any_cd8['count'].tolist())
+        self.assertEqual([(150/1000000)*0.25,(40/1000000)*0.25],any_cd8['region_area_mm2'].tolist())
+        self.assertEqual([80000.0,100000.0],[round(x,6) for x in any_cd8['density_mm2']])
+        # F2 Tumor is smaller than the minimum region size
+        tumor_pd1 = fcnts.loc[(fcnts['region_label']=='Tumor')&(fcnts['phenotype_label']=='PD1+ CD8+')]
+        self.assertEqual(2,tumor_pd1['count'].iloc[0])
+        self.assertEqual([False,True],tumor_pd1['count'].isna().tolist())
+        self.assertTrue(tumor_pd1['density_mm2'].isna().tolist()==[False,True])
+        any_percent = fpcnts.loc[fpcnts['region_label']=='Any']
+        self.assertEqual([2,1],any_percent['numerator'].tolist())
+        self.assertEqual([3,1],any_percent['denominator'].tolist())
+        self.assertAlmostEqual(2/3,any_percent['fraction'].iloc[0])
+        self.assertAlmostEqual(200/3,any_percent['percent'].iloc[0])
+        self.assertTrue(any_percent['fraction'].isna().iloc[1])
+        self.assertTrue(fpcnts.loc[fpcnts['region_label']=='Tumor','fraction'].isna().tolist()==[False,True])
+    def test_sample_measures(self):
+        fcnts, scnts, fpcnts, spcnts = self.measurements.report_tables(self.report)
+        self.assertEqual([('Tumor','CD8+'),('Tumor','PD1+ CD8+'),('Any','CD8+'),('Any','PD1+ CD8+'),('Stroma','CD8+'),('Stroma','PD1+ CD8+')],
+                         list(zip(scnts['region_label'],scnts['phenotype_label'])))
+        any_cd8 = scnts.iloc[2]
+        self.assertEqual([2,190,4,2],[any_cd8['frame_count'],any_cd8['cumulative_region_area_pixels'],any_cd8['cumulative_count'],any_cd8['measured_frame_count']])
+        self.assertAlmostEqual(4/(190*0.25/1000000),any_cd8['cumulative_density_mm2'])
+        self.assertAlmostEqual(90000,any_cd8['mean_density_mm2'])
+        self.assertAlmostEqual(2**0.5*10000,any_cd8['stddev_density_mm2'])
+        self.assertAlmostEqual(10000,any_cd8['stderr_density_mm2'])
+        tumor_cd8 = scnts.iloc[0]
+        self.assertEqual(1,tumor_cd8['measured_frame_count'])
+        self.assertAlmostEqual(80000,tumor_cd8['mean_density_mm2'])
+        self.assertTrue(_isna(tumor_cd8['stddev_density_mm2']) and _isna(tumor_cd8['stderr_density_mm2']))
+        any_percent = spcnts.loc[spcnts['region_label']=='Any'].iloc[0]
+        self.assertEqual([3,4,1],[any_percent['cumulative_numerator'],any_percent['cumulative_denominator'],any_percent['measured_frame_count']])
+        self.assertAlmostEqual(75,any_percent['cumulative_percent'])
+        self.assertAlmostEqual(200/3,any_percent['mean_percent'])
+        # Stroma has one CD8+ cell, below the minimum denominator
+        self.assertTrue(_isna(spcnts.loc[spcnts['region_label']=='Stroma','cumulative_fraction'].iloc[0]))
+    def test_report_rows(self):
+        fcnts, scnts, fpcnts, spcnts = self.measurements.report_tables(self.report)
+        images = run_tool._report_rows(fcnts,'image_count_densities',20,group_by='frame_name')
+        self.assertEqual({'region_name':'Tumor','population_name':'CD8+','region_area_pixels':10,'region_area_mm2':(10/1000000)*0.25,
+                          'count':None,'density_mm2':None,'measure_qc_pass':False},images['F2'][0])
+        for table_name, frame, minimum in [('sample_cumulative_count_densities',scnts,20),('sample_aggregate_count_densities',scnts,None),
+                                           ('sample_cumulative_count_percentages',spcnts,2),('sample_aggregate_count_percentages',spcnts,None),
+                                           ('image_count_percentages',fpcnts,2)]:
+            json.dumps(run_tool._report_rows(frame,table_name,minimum),allow_nan=False)
+    def test_counts_shared(self):
+        self.measurements.report_tables(self.report)
+        # the percentage populations are the same as the density populations so they are counted once
+        self.assertEqual(2,len(self.measurements._counts))
+        self.assertEqual([[2,1,0],[0,0,1]],self.measurements.counts(['CD8+']).tolist())
+        self.assertEqual(6,self.measurements.population_mask([]).sum())
+        # a second report with the same populations counts nothing new
+        other = dict(self.report,population_percentages=[],region_selection=self.report['region_selection'][0:1])
+        self.measurements.report_tables(other)
+        self.assertEqual(2,len(self.measurements._counts))
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.measurements.report_tables(dict(self.report,region_selection=[{'report_region_name':'X','regions_to_combine':['Tumor','Necrosis']}]))
+        with self.assertRaises(ValueError):
+            self.measurements.counts(['CD4+'])
+        with self.assertRaises(ValueError):
+            self.measurements.counts(['CD8+'],[{'target_name':'PDL1','filter_direction':'+'}])
+        # a zeroed phenotype can be asked for and has no cells
+        self.assertEqual(0,self.measurements.counts(['OTHER']).sum())
+    def test_missing_regions(self):
+        import pandas as pd
+        # cells without a region_label are in no region, as pythologist's Counts leaves them out when grouping by region
+        unlabeled = pd.DataFrame([{'frame_name':frame_name,'region_label':region_label,'phenotype_label':'CD8+','scored_calls':{'PD1':1},
+                                   'regions':self.cells['regions'].iloc[i]} for i, frame_name, region_label in [(0,'F1',None),(0,'F1',float('nan')),(4,'F2',None)]])
+        cells = pd.concat([unlabeled.iloc[0:2],self.cells,unlabeled.iloc[2:]],ignore_index=True)
+        measurements = SampleMeasurements(cells,0.5,phenotypes=['CD8+','TUMOR','OTHER'])
+        self.assertEqual(['Tumor','Stroma','Margin'],measurements.region_names)
+        self.assertEqual([[2,1,0],[0,0,1]],measurements.counts(['CD8+']).tolist())
+        self.assertEqual(9,measurements.population_mask([]).sum())
+        for table, expected in zip(measurements.report_tables(self.report),self.measurements.report_tables(self.report)):
+            pd.testing.assert_frame_equal(expected,table)
+    def test_bitsets(self):
+        import pandas as pd
+        # more binary phenotypes than fit in one word, and a cell missing a call
+        calls = [dict([('T'+str(i),(i+j)%2) for i in range(70)]) for j in range(4)]
+        del calls[3]['T69']
+        cells = pd.DataFrame([{'frame_name':'F1','region_label':'Tumor','phenotype_label':'CD8+','scored_calls':x,
+                               'regions':{'Tumor':100}} for x in calls])
+        measurements = SampleMeasurements(cells,0.5)
+        self.assertEqual(2,measurements._words)
+        # cells 0 and 2 have the same calls and share a signature
+        self.assertEqual(3,len(measurements._signature_weights))
+        self.assertEqual([True,False,True,False],measurements.population_mask([],[{'target_name':'T69','filter_direction':'+'}]).tolist())
+        self.assertEqual([False,True,False,False],measurements.population_mask([],[{'target_name':'T69','filter_direction':'-'}]).tolist())
+        self.assertEqual([True,False,True,False],measurements.population_mask([],[{'target_name':'T0','filter_direction':'-'},
+                                                                                  {'target_name':'T1','filter_direction':'+'}]).tolist())
+        # the last direction given for a target is used
+        self.assertEqual([[2]],measurements.counts(['CD8+'],[{'target_name':'T0','filter_direction':'-'},
+                                                            {'target_name':'T0','filter_direction':'+'}]).tolist())
+
+@unittest.skipUnless(_has_module('pythologist'),'pythologist is not installed')
+class TestSampleMeasurementsParity(unittest.TestCase):
+    def setUp(self):
+        self.regions = {'F1':{'Tumor':5000,'Stroma':3000,'Margin':0},
+                        'F2':{'Tumor':15,'Stroma':2000,'Margin':400},
+                        'F3':{'Tumor':800,'Stroma':10,'Margin':25}}
+        self.report = {
+            'parameters':{'minimum_density_region_size_pixels':20,'minimum_denominator_count':3},
+            'region_selection':[{'report_region_name':'Tumor','regions_to_combine':['Tumor']},
+                                {'report_region_name':'Stroma','regions_to_combine':['Stroma']},
+                                {'report_region_name':'Margin','regions_to_combine':['Margin']},
+                                {'report_region_name':'Any','regions_to_combine':['Tumor','Stroma','Margin']}],
+            'population_densities':[{'population_name':'CD8+','mutually_exclusive_phenotypes':['CD8+'],'binary_phenotypes':[]},
+                                    {'population_name':'T cell','mutually_exclusive_phenotypes':['CD8+','CD4+'],'binary_phenotypes':[]},
+                                    {'population_name':'PD1+ PDL1- CD8+','mutually_exclusive_phenotypes':['CD8+'],
+                                     'binary_phenotypes':[{'target_name':'PD1','filter_direction':'+'},
+                                                          {'target_name':'PDL1','filter_direction':'-'}]}],
+            'population_percentages':[{'population_name':'%PD1+ of T cell',
+                                       'numerator_mutually_exclusive_phenotypes':['CD8+','CD4+'],
+                                       'numerator_binary_phenotypes':[{'target_name':'PD1','filter_direction':'+'}],
+                                       'denominator_mutually_exclusive_phenotypes':['CD8+','CD4+'],'denominator_binary_phenotypes':[]},
+                                      {'population_name':'%PDL1+ TUMOR of all',
+                                       'numerator_mutually_exclusive_phenotypes':['TUMOR'],
+                                       'numerator_binary_phenotypes':[{'target_name':'PDL1','filter_direction':'+'}],
+                                       'denominator_mutually_exclusive_phenotypes':['CD8+','CD4+','TUMOR','OTHER'],
+                                       'denominator_binary_phenotypes':[]}]
+        }
+    def _cells(self, targets, count=600, seed=0):
+        _random = random.Random(seed)
+        cells = []
+        for i in range(count):
+            frame_name = _random.choice(sorted(self.regions))
+            region_label = _random.choice(sorted([k for k, v in self.regions[frame_name].items() if v > 0]))
+            cells.append((frame_name,region_label,_random.choice(['CD8+','CD4+','TUMOR','OTHER']),
+                          dict([(x,_random.randint(0,1)) for x in targets])))
+        return cells
+    def _assert_parity(self, cdf, report):
+        import pandas as pd
+        measured = SampleMeasurements(cdf,cdf.microns_per_pixel,phenotypes=cdf.phenotypes).report_tables(report)
+        reference = _reference_report_tables(cdf,report)
+        for table, reference_table in zip(measured,reference):
+            self.assertEqual(list(reference_table.columns),list(table.columns))
+            keys = [x for x in ['region_label','phenotype_label','frame_name'] if x in table.columns]
+            table, reference_table = [x.sort_values(keys).reset_index(drop=True) for x in [table,reference_table]]
+            for column in table.columns:
+                if column in keys: continue
+                table[column], reference_table[column] = table[column].astype(float), reference_table[column].astype(float)
+            pd.testing.assert_frame_equal(reference_table,table,check_dtype=False)
+    def test_parity(self):
+        self._assert_parity(_cell_data_frame(self._cells(['PD1','PDL1','FOXP3']),self.regions),self.report)
+    def test_parity_bitsets(self):
+        # more binary phenotypes than fit in one bitset word, and OTHER and TUMOR cells missing calls
+        # on targets that are only filtered on for populations they are not part of, as pythologist needs
+        targets = ['PD1','PDL1']+['T'+str(i) for i in range(70)]
+        cells = self._cells(targets,count=900,seed=1)
+        for i, (frame_name, region_label, phenotype_label, scored_calls) in enumerate(cells):
+            if phenotype_label == 'OTHER' and i%2 == 0:
+                for target in ['T5','T66']: del scored_calls[target]
+            if phenotype_label == 'TUMOR' and i%3 == 0: del scored_calls['T69']
+        report = copy.deepcopy(self.report)
+        report['population_densities'] += [{'population_name':'T0+ T65- T66+ CD8+','mutually_exclusive_phenotypes':['CD8+'],
+                                            'binary_phenotypes':[{'target_name':'T0','filter_direction':'+'},
+                                                                 {'target_name':'T65','filter_direction':'-'},
+                                                                 {'target_name':'T66','filter_direction':'+'}]},
+                                           {'population_name':'T63+ T64+ TUMOR','mutually_exclusive_phenotypes':['TUMOR'],
+                                            'binary_phenotypes':[{'target_name':'T63','filter_direction':'+'},
+                                                                 {'target_name':'T64','filter_direction':'+'}]}]
+        report['population_percentages'] += [{'population_name':'%T67+ T5- of T cell',
+                                              'numerator_mutually_exclusive_phenotypes':['CD8+','CD4+'],
+                                              'numerator_binary_phenotypes':[{'target_name':'T67','filter_direction':'+'},
+                                                                             {'target_name':'T5','filter_direction':'-'}],
+                                              'denominator_mutually_exclusive_phenotypes':['CD8+','CD4+'],
+                                              'denominator_binary_phenotypes':[]}]
+        self._assert_parity(_cell_data_frame(cells,self.regions),report)
+    def test_parity_missing_regions(self):
+        import numpy as np
+        cells = self._cells(['PD1','PDL1'],seed=2)
+        for i in range(0,len(cells),7): cells[i] = (cells[i][0],np.nan)+cells[i][2:]
+        self._assert_parity(_cell_data_frame(cells,self.regions),self.report)
+
+class TestExportCache(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        def _file(path,digest): return {'file_path':path,'sha256_hash':digest,'last_modified_timestamp':'x'}
+        self.files_json = {'sample_name':'S','sample_directory':'/data/SAMPLES/S','exports':[
+            {'export_name':'E1','images':[{'image_name':'I1',
+                                           'image_data':{'cell_seg_data':_file('/data/SAMPLES/S/E1/I1_cell_seg_data.txt','a1')},
+                                           'image_annotations':[dict(_file('/data/SAMPLES/S/ANNOTATIONS/I1_Tumor.tif','t1'),mask_label='Tumor')]}]},
+            {'export_name':'E2','images':[{'image_name':'I1',
+                                           'image_data':{'cell_seg_data':_file('/data/SAMPLES/S/E2/I1_cell_seg_data.txt','b1')},
+                                           'image_annotations':[]}]}]}
+        self.inputs = {
+            'project':{'parameters':{'project_name':'P','microns_per_pixel':0.496}},
+            'analysis':{'parameters':dict([(x,'v') for x in run_tool.EXPORT_READING_PARAMETERS]),'inform_exports':[]},
+            'panel':{'markers':[{'full_name':'CD8 (Opal 520)','marker_name':'CD8'}]},
+            'report':{'parameters':{'minimum_denominator_count':1}}
+        }
+    def test_key(self):
+        key = run_tool._export_cache_key(self.files_json,self.inputs)
+        # moving the sample or changing the report or the phenotype logic keeps the parsed exports
+        moved = json.loads(json.dumps(self.files_json).replace('/data/','/archive/'))
+        self.assertEqual(key,run_tool._export_cache_key(moved,self.inputs))
+        changed = copy.deepcopy(self.inputs)
+        changed['report']['parameters']['minimum_denominator_count'] = 5
+        changed['analysis']['inform_exports'] = [{'export_name':'E1'}]
+        self.assertEqual(key,run_tool._export_cache_key(self.files_json,changed))
+        # the file contents and the parameters the reader takes do not
+        changed = copy.deepcopy(self.files_json)
+        changed['exports'][1]['images'][0]['image_data']['cell_seg_data']['sha256_hash'] = 'b2'
+        self.assertNotEqual(key,run_tool._export_cache_key(changed,self.inputs))
+        changed = copy.deepcopy(self.files_json)
+        changed['exports'][0]['images'][0]['image_annotations'][0]['mask_label'] = 'Stroma'
+        self.assertNotEqual(key,run_tool._export_cache_key(changed,self.inputs))
+        for name, section, parameter, value in [('analysis','parameters','draw_margin_width',2),
+                                                ('project','parameters','microns_per_pixel',0.5)]:
+            changed = copy.deepcopy(self.inputs)
+            changed[name][section][parameter] = value
+            self.assertNotEqual(key,run_tool._export_cache_key(self.files_json,changed))
+        changed = copy.deepcopy(self.inputs)
+        changed['panel']['markers'][0]['marker_name'] = 'CD8A'
+        self.assertNotEqual(key,run_tool._export_cache_key(self.files_json,changed))
+    def test_write(self):
+        import pandas as pd
+        self.assertIsNone(run_tool._read_export_cache(self.directory,self.files_json,self.inputs))
+        cdfs = OrderedDict([('E1',pd.DataFrame({'x':[1,2]})),('E2',pd.DataFrame({'x':[3]}))])
+        run_tool._write_export_cache(self.directory,self.files_json,self.inputs,cdfs,_FakeProject())
+        cache_path = run_tool._export_cache_path(self.directory,self.files_json,self.inputs)
+        self.assertEqual([os.path.basename(cache_path)],os.listdir(self.directory))
+        self.assertEqual(['EXPORT-0.h5','EXPORT-1.h5','manifest.json','project.h5'],sorted(os.listdir(cache_path)))
+        with open(os.path.join(cache_path,'manifest.json')) as inf: manifest = json.loads(inf.read())
+        self.assertEqual([['E1','EXPORT-0.h5'],['E2','EXPORT-1.h5']],manifest['exports'])
+        self.assertEqual([3],pd.read_hdf(os.path.join(cache_path,'EXPORT-1.h5'),'data')['x'].tolist())
+        # a second save of the same exports leaves the first alone
+        run_tool._write_export_cache(self.directory,self.files_json,self.inputs,cdfs,None)
+        self.assertEqual([os.path.basename(cache_path)],os.listdir(self.directory))
+    def test_invalid_entries(self):
+        cache_path = run_tool._export_cache_path(self.directory,self.files_json,self.inputs)
+        os.makedirs(cache_path)
+        with open(os.path.join(cache_path,'manifest.json'),'wt') as of: of.write('{"key":')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(run_tool._read_export_cache(self.directory,self.files_json,self.inputs))
+        with open(os.path.join(cache_path,'manifest.json'),'wt') as of: of.write(json.dumps({'key':'other'}))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(run_tool._read_export_cache(self.directory,self.files_json,self.inputs))
+
+class TestRecomputeReport(unittest.TestCase):
+    def setUp(self):
+        self.output = _fake_report_output(sample_count=3,image_count=2)
+        self.report = {
+            'parameters':{'report_name':'new report','report_version':'2','minimum_denominator_count':1,'minimum_density_region_size_pixels':1},
+            'region_selection':[{'report_region_name':'Any','regions_to_combine':['Tumor','Stroma']}],
+            'population_densities':[{'population_name':'CD8+','mutually_exclusive_phenotypes':['CD8+'],'binary_phenotypes':[]}],
+            'population_percentages':[]
+        }
+    def test_recompute(self):
+        for workers in [1,2]:
+            headers, samples = run_tool._recompute_samples(io.StringIO(json.dumps(self.output)),self.report,'run2',workers=workers,
+                                                           function=_fake_recompute_sample)
+            self.assertEqual(['run2','new report',self.output['project_name'],self.output['panel_version']],
+                             [headers[0]['run_id'],headers[0]['report_name'],headers[0]['project_name'],headers[0]['panel_version']])
+            samples = [x[0] for x in samples]
+            self.assertEqual([x['sample_name'] for x in self.output['sample_outputs']],[x['sample_name'] for x in samples])
+            self.assertEqual(['new report'],list(set([x['report_name'] for x in samples])))
+            # the phenotype maps of the earlier run are never decoded
+            self.assertEqual(['image_name','image_reports','image_size_pixels','microns_per_pixel','region_sizes'],samples[0]['images'][0])
+        self.output['sample_outputs'] = []
+        headers, samples = run_tool._recompute_samples(io.StringIO(json.dumps(self.output)),self.report,'run2',function=_fake_recompute_sample)
+        self.assertEqual([],list(samples))
+        self.assertEqual(self.output['analysis_name'],headers[0]['analysis_name'])
+    def test_recompute_reports(self):
+        reports = [self.report,dict(self.report,parameters=dict(self.report['parameters'],report_name='other report'))]
+        headers, samples = run_tool._recompute_samples(io.StringIO(json.dumps(self.output)),reports,'run2',function=_fake_recompute_sample)
+        self.assertEqual(['new report','other report'],[x['report_name'] for x in headers])
+        samples = list(samples)
+        self.assertEqual(3,len(samples))
+        self.assertEqual([['new report','other report']]*3,[[y['report_name'] for y in x] for x in samples])
+        with self.assertRaises(ValueError):
+            run_tool._recompute_samples(io.StringIO(json.dumps(self.output)),[self.report,self.report],'run2',function=_fake_recompute_sample)
+    def test_invalid_inputs(self):
+        del self.report['parameters']
+        with self.assertRaises(ValidationError):
+            run_tool._recompute_samples(io.StringIO(json.dumps(self.output)),self.report,'run2',function=_fake_recompute_sample)
+    def test_missing_celldataframe(self):
+        sample_output = self.output['sample_outputs'][0]
+        with self.assertRaises(ValueError):
+            run_tool.recompute_sample(sample_output,{'report':self.report},'run2')
+        sample_output['intermediate_files']['celldataframe_h5'] = os.path.join(tempfile.gettempdir(),'missing-'+str(uuid.uuid4())+'.h5')
+        with self.assertRaises(ValueError):
+            run_tool.recompute_sample(sample_output,{'report':self.report},'run2')
+
+class TestMultipleReports(_DirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.output = _fake_report_output(sample_count=2,image_count=2,cell_count=10)
+        self.headers = []
+        for report_name in ['Report A','Report B']:
+            header = OrderedDict([(k,v) for k, v in self.output.items() if k != 'sample_outputs'])
+            header['report_name'] = report_name
+            self.headers.append(header)
+    def test_output_paths(self):
+        self.assertEqual(['run.json'],run_tool._report_output_paths('run.json',['Report A']))
+        self.assertEqual([os.path.join('out','run.Report_A.json'),os.path.join('out','run.B-2.json')],
+                         run_tool._report_output_paths(os.path.join('out','run.json'),['Report A','B-2']))
+        self.assertEqual(['run.A.json.gz','run.B.json.gz'],run_tool._report_output_paths('run.json.gz',['A','B']))
+        with self.assertRaises(ValueError):
+            run_tool._report_output_paths('run.json',['Report A','Report/A'])
+    def test_write_outputs(self):
+        args = _run_output_args(os.path.join(self.directory,'run.json'))
+        sample_outputs = [[x,copy.deepcopy(x)] for x in self.output['sample_outputs']]
+        run_tool._write_outputs(args,self.headers,iter(sample_outputs))
+        self.assertEqual(['run.Report_A.json','run.Report_B.json'],sorted(os.listdir(self.directory)))
+        for header, file_name in zip(self.headers,['run.Report_A.json','run.Report_B.json']):
+            with open(os.path.join(self.directory,file_name)) as inf:
+                self.assertEqual(dict(header,sample_outputs=self.output['sample_outputs']),json.loads(inf.read()))
+    def test_failed_write(self):
+        args = _run_output_args(os.path.join(self.directory,'run.json'))
+        def _samples():
+            yield [self.output['sample_outputs'][0]]*2
+            raise KeyError('failed')
+        with self.assertRaises(KeyError):
+            run_tool._write_outputs(args,self.headers,_samples())
+        self.assertEqual([],os.listdir(self.directory))
+    def test_shared_phenotype_maps(self):
+        outputs = [self.output['sample_outputs'][0],copy.deepcopy(self.output['sample_outputs'][0])]
+        for image, _image in zip(*[x['images'] for x in outputs]): _image['phenotype_map'] = image['phenotype_map']
+        outputs = run_tool._encode_phenotype_maps(outputs,'columnar')
+        self.assertEqual('columnar',outputs[0]['images'][0]['phenotype_map']['encoding'])
+        for image, _image in zip(*[x['images'] for x in outputs]): self.assertIs(image['phenotype_map'],_image['phenotype_map'])
+    def test_check_reports(self):
+        report = {'parameters':{'report_name':'A','report_version':'1','minimum_denominator_count':1,'minimum_density_region_size_pixels':1}}
+        run_tool._check_reports([report,dict(report,parameters=dict(report['parameters'],report_name='B'))])
+        with self.assertRaises(ValueError):
+            run_tool._check_reports([report,report])
+        with self.assertRaises(ValueError):
+            run_tool._check_reports([])
+        self.assertEqual([report],run_tool._reports({'report':report}))
+
+class TestMergeExportScores(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        def _cells(names,frames=['F1','F2']):
+            return [{'project_name':'P','sample_name':'S','frame_name':frame_name,'cell_index':i,'x':i*3,'y':i*7,
+                     'scored_calls':dict([(x,rng.randint(0,1)) for x in names])} for frame_name in frames for i in range(1,21)]
+        self.cdf = _fake_cell_data_frame(_cells(['PD1','CD8']))
+        # exports are read in their own cell order, the second shares a name with the primary
+        self.other_cdfs = OrderedDict([('E2',_fake_cell_data_frame(_cells(['LAG3'],frames=['F2','F1'])).iloc[::-1]),
+                                       ('E3',_fake_cell_data_frame(_cells(['CD8','TIM3','FOXP3'])))])
+    def _merge_in_turn(self):
+        return run_tool._merge_scores_in_turn(self.cdf,self.other_cdfs)
+    def test_merge(self):
+        merged = run_tool._merge_export_scores(self.cdf,self.other_cdfs)
+        expected = self._merge_in_turn()
+        self.assertEqual(expected.drop(columns='scored_calls').to_dict('records'),merged.drop(columns='scored_calls').to_dict('records'))
+        # the calls and the order of their names are the same
+        self.assertEqual([list(x.items()) for x in expected['scored_calls']],[list(x.items()) for x in merged['scored_calls']])
+        self.assertEqual(['CD8','LAG3','PD1','FOXP3','TIM3'],list(merged['scored_calls'].iloc[0].keys()))
+        self.assertEqual(self.other_cdfs['E3']['scored_calls'].iloc[5]['CD8'],merged['scored_calls'].iloc[5]['CD8'])
+    def test_mismatch(self):
+        other = self.other_cdfs['E3']
+        other.loc[[2,30],'x'] = -1
+        other.drop(index=[7],inplace=True)
+        with self.assertRaises(ValueError) as cm:
+            self._merge_in_turn()
+        self.assertEqual("segmentation mismatch error 3",str(cm.exception))
+        with self.assertRaises(ValueError) as cm:
+            run_tool._merge_export_scores(self.cdf,self.other_cdfs)
+        self.assertEqual("segmentation mismatch error 3",str(cm.exception))
+    def test_fallback(self):
+        # a repeated cell or a missing call is merged in turn
+        import pandas as pd
+        other = self.other_cdfs['E2']
+        self.other_cdfs['E2'] = pd.concat([other,other.iloc[0:1]])
+        merged = run_tool._merge_export_scores(self.cdf,self.other_cdfs)
+        self.assertEqual(self._merge_in_turn()['scored_calls'].tolist(),merged['scored_calls'].tolist())
+        self.assertEqual(41,merged.shape[0])
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -30,6 +30,7 @@ setup(
             'schema_data.inputs.platforms.InForm'
             ],
   install_requires = ['jsonschema','importlib_resources','XlsxWriter'],
+  extras_require = {'parquet':['pyarrow'],'zstd':['zstandard']},
   include_package_data = True,
   entry_points = {
     'console_scripts':['pythologist-stage=pythologist_schemas.cli.stage_tool:cli',